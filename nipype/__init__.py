@@ -15,8 +15,6 @@ logging = Logging(config)
 
 from distutils.version import LooseVersion
 
-from .fixes.numpy.testing import nosetester
-
 try:
     import faulthandler
     faulthandler.enable()
@@ -24,36 +22,36 @@ except (ImportError,IOError) as e:
     pass
 
 
-class _NoseTester(nosetester.NoseTester):
-    """ Subclass numpy's NoseTester to add doctests by default
-    """
-
-    def _get_custom_doctester(self):
-        return None
+def test(label='fast', verbose=1, extra_argv=['--exe'], doctests=True,
+         coverage=False):
+    """Run the full test suite
 
-    def test(self, label='fast', verbose=1, extra_argv=['--exe'],
-             doctests=True, coverage=False):
-        """Run the full test suite
+    Examples
+    --------
+    This will run the test suite and stop at the first failing
+    example
+    >>> from nipype import test
+    >>> test(extra_argv=['--exe', '-sx'])  # doctest: +SKIP
+    """
+    # numpy and nose are only imported when the tests are run
+    from .fixes.numpy.testing import nosetester
 
-        Examples
-        --------
-        This will run the test suite and stop at the first failing
-        example
-        >>> from nipype import test
-        >>> test(extra_argv=['--exe', '-sx'])  # doctest: +SKIP
+    class _NoseTester(nosetester.NoseTester):
+        """ Subclass numpy's NoseTester to add doctests by default
         """
-        return super(_NoseTester, self).test(label=label,
-                                             verbose=verbose,
-                                             extra_argv=extra_argv,
-                                             doctests=doctests,
-                                             coverage=coverage)
 
-try:
-    test = _NoseTester(raise_warnings="release").test
-except TypeError:
-    # Older versions of numpy do not have a raise_warnings argument
-    test = _NoseTester().test
-del nosetester
+        def _get_custom_doctester(self):
+            return None
+
+    package_path = os.path.dirname(__file__)
+    try:
+        tester = _NoseTester(package=package_path, raise_warnings="release")
+    except TypeError:
+        # Older versions of numpy do not have a raise_warnings argument
+        tester = _NoseTester(package=package_path)
+    return tester.test(label=label, verbose=verbose, extra_argv=extra_argv,
+                       doctests=doctests, coverage=coverage)
+test.__test__ = False  # not a test to be collected by nose
 
 # Set up package information function
 from .pkg_info import get_pkg_info as _get_pkg_info
@@ -67,6 +65,22 @@ except:
     pass
 
 
-from .pipeline import Node, MapNode, JoinNode, Workflow
-from .interfaces import (DataGrabber, DataSink, SelectFiles,
-                         IdentityInterface, Rename, Function, Select, Merge)
+# Workflow and interface classes (and the numpy, scipy, networkx and traits
+# imports they require) are only loaded when first used
+from .utils.misc import lazy_attributes
+lazy_attributes(__name__, {
+    'Node': 'nipype.pipeline',
+    'MapNode': 'nipype.pipeline',
+    'JoinNode': 'nipype.pipeline',
+    'Workflow': 'nipype.pipeline',
+    'DataGrabber': 'nipype.interfaces',
+    'DataSink': 'nipype.interfaces',
+    'SelectFiles': 'nipype.interfaces',
+    'IdentityInterface': 'nipype.interfaces',
+    'Rename': 'nipype.interfaces',
+    'Function': 'nipype.interfaces',
+    'Select': 'nipype.interfaces',
+    'Merge': 'nipype.interfaces',
+    'pipeline': 'nipype.pipeline',
+    'interfaces': 'nipype.interfaces'})
+del lazy_attributes
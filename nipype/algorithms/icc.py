@@ -14,10 +14,13 @@ class ICCInputSpec(BaseInterfaceInputSpec):
                                     desc="n subjects m sessions 3D stat files",
                                     mandatory=True)
     mask = File(exists=True, mandatory=True)
+    chunk_size = traits.Range(low=1, value=10000, usedefault=True,
+                              desc="number of voxels processed at once")
 
 
 class ICCOutputSpec(TraitedSpec):
     icc_map = File(exists=True)
+    sessions_F_map = File(exists=True, desc="F statistics of the session effect")
     session_var_map = File(exists=True, desc="variance between sessions")
     subject_var_map = File(exists=True, desc="variance between subjects")
 
@@ -28,6 +31,9 @@ class ICC(BaseInterface):
     P. E. Shrout & Joseph L. Fleiss (1979). "Intraclass Correlations: Uses in
     Assessing Rater Reliability". Psychological Bulletin 86 (2): 420-428. This
     particular implementation is aimed at relaibility (test-retest) studies.
+
+    The in-mask voxels are processed ``chunk_size`` at a time, reading them
+    from the (memory-mapped, if uncompressed) input images.
     '''
     input_spec = ICCInputSpec
     output_spec = ICCOutputSpec
@@ -35,34 +41,37 @@ class ICC(BaseInterface):
     def _run_interface(self, runtime):
         maskdata = nb.load(self.inputs.mask).get_data()
         maskdata = np.logical_not(np.logical_or(maskdata == 0, np.isnan(maskdata)))
-
-        session_datas = [[nb.load(fname).get_data()[maskdata].reshape(-1, 1) for fname in sessions] for sessions in self.inputs.subjects_sessions]
-        list_of_sessions = [np.dstack(session_data) for session_data in session_datas]
-        all_data = np.hstack(list_of_sessions)
-        icc = np.zeros(session_datas[0][0].shape)
-        session_F = np.zeros(session_datas[0][0].shape)
-        session_var = np.zeros(session_datas[0][0].shape)
-        subject_var = np.zeros(session_datas[0][0].shape)
-
-        for x in range(icc.shape[0]):
-            Y = all_data[x, :, :]
-            icc[x], subject_var[x], session_var[x], session_F[x], _, _ = ICC_rep_anova(Y)
+        # nifti data are stored in fortran order, so that raveling the
+        # memory-mapped arrays in that order does not copy them
+        voxels = np.flatnonzero(maskdata.ravel(order='F'))
+
+        session_datas = [[np.asanyarray(nb.load(fname).dataobj).ravel(order='F')
+                          for fname in sessions]
+                         for sessions in self.inputs.subjects_sessions]
+        nb_subjects = len(session_datas)
+        nb_conditions = len(session_datas[0])
+
+        maps = np.zeros((4, len(voxels)))
+        chunk_size = self.inputs.chunk_size
+        for start in range(0, len(voxels), chunk_size):
+            chunk = voxels[start:start + chunk_size]
+            Y = np.empty((len(chunk), nb_subjects, nb_conditions))
+            for i, sessions in enumerate(session_datas):
+                for j, data in enumerate(sessions):
+                    Y[:, i, j] = data[chunk]
+            icc, subject_var, session_var, session_F, _, _ = \
+                ICC_rep_anova_batch(Y)
+            maps[:, start:start + chunk_size] = [icc, subject_var,
+                                                 session_var, session_F]
 
         nim = nb.load(self.inputs.subjects_sessions[0][0])
-        new_data = np.zeros(nim.shape)
-        new_data[maskdata] = icc.reshape(-1,)
-        new_img = nb.Nifti1Image(new_data, nim.affine, nim.header)
-        nb.save(new_img, 'icc_map.nii')
-
-        new_data = np.zeros(nim.shape)
-        new_data[maskdata] = session_var.reshape(-1,)
-        new_img = nb.Nifti1Image(new_data, nim.affine, nim.header)
-        nb.save(new_img, 'session_var_map.nii')
-
-        new_data = np.zeros(nim.shape)
-        new_data[maskdata] = subject_var.reshape(-1,)
-        new_img = nb.Nifti1Image(new_data, nim.affine, nim.header)
-        nb.save(new_img, 'subject_var_map.nii')
+        voxels = np.unravel_index(voxels, maskdata.shape, order='F')
+        for name, values in zip(['icc_map', 'subject_var_map',
+                                 'session_var_map', 'sessions_F_map'], maps):
+            new_data = np.zeros(nim.shape)
+            new_data[voxels] = values
+            new_img = nb.Nifti1Image(new_data, nim.affine, nim.header)
+            nb.save(new_img, name + '.nii')
 
         return runtime
 
@@ -97,13 +106,9 @@ def ICC_rep_anova(Y):
     mean_Y = mean(Y)
     SST = ((Y - mean_Y) ** 2).sum()
 
-    # create the design matrix for the different levels
-    x = kron(eye(nb_conditions), ones((nb_subjects, 1)))  # sessions
-    x0 = tile(eye(nb_subjects), (nb_conditions, 1))  # subjects
-    X = hstack([x, x0])
-
     # Sum Square Error
-    predicted_Y = dot(dot(dot(X, pinv(dot(X.T, X))), X.T), Y.flatten('F'))
+    predicted_Y = dot(_rep_anova_hat(nb_subjects, nb_conditions),
+                      Y.flatten('F'))
     residuals = Y.flatten('F') - predicted_Y
     SSE = (residuals ** 2).sum()
 
@@ -128,3 +133,62 @@ def ICC_rep_anova(Y):
     r_var = (MSR - MSE) / nb_conditions  # variance between subjects
 
     return ICC, r_var, e_var, session_effect_F, dfc, dfe
+
+
+def ICC_rep_anova_batch(Y):
+    '''
+    Vectorized version of ICC_rep_anova for many tables at once
+
+    Y is an array of shape (n_tables, nb_subjects, nb_conditions), e.g. one
+    table per voxel. The design matrix and its pseudo-inverse are computed
+    once for all the tables. Returns arrays of ICC, r_var, e_var and
+    session_effect_F (one value per table), dfc and dfe.
+    '''
+
+    [_, nb_subjects, nb_conditions] = Y.shape
+    dfc = nb_conditions - 1
+    dfe = (nb_subjects - 1) * dfc
+    dfr = nb_subjects - 1
+
+    # one row per table, flattened in the same (column-major) order as the
+    # design matrix
+    Y = Y.transpose(0, 2, 1).reshape(Y.shape[0], -1)
+    mean_Y = Y.mean(1)
+
+    # Sum Square Total
+    SST = ((Y - mean_Y[:, None]) ** 2).sum(1)
+
+    # Sum Square Error
+    residuals = Y - dot(Y, _rep_anova_hat(nb_subjects, nb_conditions).T)
+    SSE = (residuals ** 2).sum(1)
+    MSE = SSE / dfe
+
+    # Sum square session effect - between colums/sessions
+    session_means = Y.reshape(Y.shape[0], nb_conditions, nb_subjects).mean(2)
+    SSC = ((session_means - mean_Y[:, None]) ** 2).sum(1) * nb_subjects
+    MSC = SSC / dfc / nb_subjects
+
+    session_effect_F = MSC / MSE
+
+    # Sum square subject effect - between rows/subjects
+    SSR = SST - SSC - SSE
+    MSR = SSR / dfr
+
+    ICC = (MSR - MSE) / (MSR + dfc * MSE)
+
+    e_var = MSE  # variance of error
+    r_var = (MSR - MSE) / nb_conditions  # variance between subjects
+
+    return ICC, r_var, e_var, session_effect_F, dfc, dfe
+
+
+def _rep_anova_hat(nb_subjects, nb_conditions):
+    '''
+    Projection (hat) matrix of the repeated measure design, for data
+    flattened in column-major order (one session after the other)
+    '''
+    # create the design matrix for the different levels
+    x = kron(eye(nb_conditions), ones((nb_subjects, 1)))  # sessions
+    x0 = tile(eye(nb_subjects), (nb_conditions, 1))  # subjects
+    X = hstack([x, x0])
+    return dot(dot(X, pinv(dot(X.T, X))), X.T)
@@ -22,11 +22,14 @@ from builtins import zip
 from .. import logging
 from ..external.six import string_types
 from ..interfaces.base import (BaseInterface, traits, TraitedSpec, File,
-                               BaseInterfaceInputSpec)
+                               BaseInterfaceInputSpec, InputMultiPath,
+                               OutputMultiPath)
 from ..interfaces.vtkbase import tvtk
 from ..interfaces import vtkbase as VTKInfo
 IFLOGGER = logging.getLogger('interface')
 
+_INTERP_ORDER = {'nearest': 0, 'linear': 1, 'cubic': 3}
+
 
 class TVTKBaseInterface(BaseInterface):
     """ A base class for interfaces using VTK """
@@ -40,8 +43,10 @@ class TVTKBaseInterface(BaseInterface):
 
 
 class WarpPointsInputSpec(BaseInterfaceInputSpec):
-    points = File(exists=True, mandatory=True,
-                  desc='file containing the point set')
+    points = InputMultiPath(
+        File(exists=True), mandatory=True,
+        desc=('file(s) containing the point set(s), all of them are warped '
+              'with a single load of the deformation field'))
     warp = File(exists=True, mandatory=True,
                 desc='dense deformation field to be applied')
     interp = traits.Enum('cubic', 'nearest', 'linear', usedefault=True,
@@ -52,7 +57,7 @@ class WarpPointsInputSpec(BaseInterfaceInputSpec):
 
 
 class WarpPointsOutputSpec(TraitedSpec):
-    out_points = File(desc='the warped point set')
+    out_points = OutputMultiPath(File(), desc='the warped point set(s)')
 
 
 class WarpPoints(TVTKBaseInterface):
@@ -90,47 +95,37 @@ class WarpPoints(TVTKBaseInterface):
         return op.abspath('%s_%s.%s' % (fname, suffix, ext))
 
     def _run_interface(self, runtime):
-        import nibabel as nb
-        from scipy import ndimage
-
-        r = tvtk.PolyDataReader(file_name=self.inputs.points)
-        r.update()
-        mesh = VTKInfo.vtk_output(r)
-        points = np.array(mesh.points)
-        warp_dims = nb.funcs.four_to_three(nb.load(self.inputs.warp))
-
-        affine = warp_dims[0].affine
-        # voxsize = warp_dims[0].header.get_zooms()
-        vox2ras = affine[0:3, 0:3]
-        ras2vox = np.linalg.inv(vox2ras)
-        origin = affine[0:3, 3]
-        voxpoints = np.array([np.dot(ras2vox, (p - origin)) for p in points])
-
-        warps = []
-        for axis in warp_dims:
-            wdata = axis.get_data()
-            if np.any(wdata != 0):
-
-                warp = ndimage.map_coordinates(wdata,
-                                               voxpoints.transpose())
-            else:
-                warp = np.zeros((points.shape[0],))
-
-            warps.append(warp)
-
-        disps = np.squeeze(np.dstack(warps))
-        newpoints = [p + d for p, d in zip(points, disps)]
-        mesh.points = newpoints
-        w = tvtk.PolyDataWriter()
-        VTKInfo.configure_input_data(w, mesh)
-        w.file_name = self._gen_fname(self.inputs.points, suffix='warped', ext='.vtk')
-        w.write()
+        meshes = []
+        for in_file in self._in_files():
+            r = tvtk.PolyDataReader(file_name=in_file)
+            r.update()
+            meshes.append(VTKInfo.vtk_output(r))
+
+        points = [np.array(mesh.points) for mesh in meshes]
+        disps = warp_displacements(
+            np.vstack(points), self.inputs.warp,
+            order=_INTERP_ORDER[self.inputs.interp])
+        disps = np.split(disps, np.cumsum([len(p) for p in points])[:-1])
+
+        for in_file, mesh, p, d in zip(self._in_files(), meshes, points, disps):
+            mesh.points = p + d
+            w = tvtk.PolyDataWriter()
+            VTKInfo.configure_input_data(w, mesh)
+            w.file_name = self._gen_fname(in_file, suffix='warped', ext='.vtk')
+            w.write()
         return runtime
 
+    def _in_files(self):
+        in_files = self.inputs.points
+        if isinstance(in_files, string_types):
+            in_files = [in_files]
+        return in_files
+
     def _list_outputs(self):
         outputs = self._outputs().get()
-        outputs['out_points'] = self._gen_fname(self.inputs.points, suffix='warped',
-                                                ext='.vtk')
+        outputs['out_points'] = [
+            self._gen_fname(f, suffix='warped', ext='.vtk')
+            for f in self._in_files()]
         return outputs
 
 
@@ -187,16 +182,6 @@ class ComputeMeshWarp(TVTKBaseInterface):
     input_spec = ComputeMeshWarpInputSpec
     output_spec = ComputeMeshWarpOutputSpec
 
-    def _triangle_area(self, A, B, C):
-        A = np.array(A)
-        B = np.array(B)
-        C = np.array(C)
-        ABxAC = nla.norm(A - B) * nla.norm(A - C)
-        prod = np.dot(B - A, C - A)
-        angle = np.arccos(prod / ABxAC)
-        area = 0.5 * ABxAC * np.sin(angle)
-        return area
-
     def _run_interface(self, runtime):
         r1 = tvtk.PolyDataReader(file_name=self.inputs.surface1)
         r2 = tvtk.PolyDataReader(file_name=self.inputs.surface2)
@@ -223,17 +208,7 @@ class ComputeMeshWarp(TVTKBaseInterface):
         if self.inputs.weighting == 'area':
             faces = vtk1.polys.to_array().reshape(-1, 4).astype(int)[:, 1:]
 
-            for i, p1 in enumerate(points2):
-                # compute surfaces, set in weight
-                w = 0.0
-                point_faces = faces[(faces[:, :] == i).any(axis=1)]
-
-                for idset in point_faces:
-                    fp1 = points1[int(idset[0])]
-                    fp2 = points1[int(idset[1])]
-                    fp3 = points1[int(idset[2])]
-                    w += self._triangle_area(fp1, fp2, fp3)
-                weights[i] = w
+            weights = vertex_areas(points1, faces)
 
         result = np.vstack([errvector, weights])
         np.save(op.abspath(self.inputs.out_file), result.transpose())
@@ -392,3 +367,88 @@ class P2PDistance(ComputeMeshWarp):
         super(P2PDistance, self).__init__(**inputs)
         IFLOGGER.warn('This interface has been deprecated since 1.0, please use '
                       'ComputeMeshWarp')
+
+
+def warp_displacements(points, warp, order=3):
+    """
+    Samples a dense deformation field at an array of points
+
+    Parameters
+    ----------
+    points : array_like, shape (N, 3)
+        point coordinates, in physical (RAS) space
+    warp : str
+        path to a 4D image with the x, y and z displacements (in
+        physical units) as volumes
+    order : int
+        order of the spline interpolation (0: nearest, 1: linear, 3: cubic)
+
+    Returns
+    -------
+    disps : ndarray, shape (N, 3)
+        displacement of each point
+
+    """
+    import nibabel as nb
+    from scipy import ndimage
+
+    points = np.atleast_2d(points)
+    warp_dims = nb.funcs.four_to_three(nb.load(warp))
+    affine = warp_dims[0].affine
+    ras2vox = np.linalg.inv(affine[0:3, 0:3])
+    voxpoints = np.dot(points - affine[0:3, 3], ras2vox.T)
+
+    disps = np.zeros((points.shape[0], len(warp_dims)))
+    for i, axis in enumerate(warp_dims):
+        wdata = axis.get_data()
+        if np.any(wdata != 0):
+            disps[:, i] = ndimage.map_coordinates(wdata, voxpoints.T,
+                                                  order=order)
+    return disps
+
+
+def triangle_areas(points, faces):
+    """
+    Computes the area of every triangle of a mesh
+
+    Parameters
+    ----------
+    points : array_like, shape (N, 3)
+        vertex coordinates
+    faces : array_like, shape (M, 3)
+        vertex indices of each triangle
+
+    Returns
+    -------
+    areas : ndarray, shape (M,)
+
+    """
+    points = np.asarray(points, dtype=float)
+    faces = np.asarray(faces, dtype=int)
+    A, B, C = (points[faces[:, i]] for i in range(3))
+    cross = np.cross(B - A, C - A)
+    return 0.5 * np.sqrt((cross ** 2).sum(axis=1))
+
+
+def vertex_areas(points, faces):
+    """
+    Computes, for each vertex, the total area of the triangles it belongs to
+
+    Parameters
+    ----------
+    points : array_like, shape (N, 3)
+        vertex coordinates
+    faces : array_like, shape (M, 3)
+        vertex indices of each triangle
+
+    Returns
+    -------
+    weights : ndarray, shape (N,)
+
+    """
+    faces = np.asarray(faces, dtype=int)
+    areas = triangle_areas(points, faces)
+    weights = np.zeros(len(points))
+    for i in range(faces.shape[1]):
+        np.add.at(weights, faces[:, i], areas)
+    return weights
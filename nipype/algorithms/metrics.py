@@ -21,11 +21,11 @@ import os.path as op
 import nibabel as nb
 import numpy as np
 from scipy.ndimage.morphology import binary_erosion
-from scipy.spatial.distance import cdist, euclidean, dice, jaccard
+from scipy.spatial import cKDTree
+from scipy.spatial.distance import cdist, euclidean
 from scipy.ndimage.measurements import center_of_mass, label
 
 from .. import logging
-from ..utils.misc import package_check
 
 from ..interfaces.base import (BaseInterface, traits, TraitedSpec, File,
                                InputMultiPath,
@@ -96,9 +96,11 @@ class Distance(BaseInterface):
 
         set2_coordinates = self._get_coordinates(border2, nii2.affine)
 
-        dist_matrix = cdist(set1_coordinates.T, set2_coordinates.T)
-        (point1, point2) = np.unravel_index(
-            np.argmin(dist_matrix), dist_matrix.shape)
+        # nearest border2 point of each border1 point
+        distances, nearest = cKDTree(set2_coordinates.T).query(
+            set1_coordinates.T)
+        point1 = np.argmin(distances)
+        point2 = nearest[point1]
         return (euclidean(set1_coordinates.T[point1, :],
                           set2_coordinates.T[point2, :]),
                 set1_coordinates.T[point1, :],
@@ -134,8 +136,9 @@ class Distance(BaseInterface):
         set1_coordinates = self._get_coordinates(border1, nii1.affine)
         set2_coordinates = self._get_coordinates(origdata2, nii2.affine)
 
-        dist_matrix = cdist(set1_coordinates.T, set2_coordinates.T)
-        min_dist_matrix = np.amin(dist_matrix, axis=0)
+        # distance of each volume2 voxel to the closest border1 point
+        min_dist_matrix, _ = cKDTree(set1_coordinates.T).query(
+            set2_coordinates.T)
         import matplotlib.pyplot as plt
         plt.figure()
         plt.hist(min_dist_matrix, 50, normed=1, facecolor='green')
@@ -174,9 +177,9 @@ class Distance(BaseInterface):
 
         set1_coordinates = self._get_coordinates(border1, nii1.affine)
         set2_coordinates = self._get_coordinates(border2, nii2.affine)
-        distances = cdist(set1_coordinates.T, set2_coordinates.T)
         mins = np.concatenate(
-            (np.amin(distances, axis=0), np.amin(distances, axis=1)))
+            (cKDTree(set1_coordinates.T).query(set2_coordinates.T)[0],
+             cKDTree(set2_coordinates.T).query(set1_coordinates.T)[0]))
 
         return np.max(mins)
 
@@ -213,6 +216,77 @@ class Distance(BaseInterface):
         return outputs
 
 
+class LabelOverlap(object):
+    """Overlap of each label of a reference label map with test label maps
+
+    The reference is prepared once, so that many test maps can be compared
+    with it. The volumes and intersections of all the labels are counted in
+    a single pass over the voxels, with histograms of the labels of each map
+    and of the labels on which both maps agree.
+
+    Parameters
+    ----------
+    data1 : array of labels of the reference
+    mask_volume : only compare the maps within this mask image
+    bg_overlap : consider zeros as a label
+
+    Examples
+    --------
+    >>> overlap = LabelOverlap(np.array([[1, 1, 2], [0, 2, 2]]))
+    >>> labels, jaccard, volumes1, volumes2, _ = overlap.compare(
+    ...     np.array([[1, 2, 2], [0, 2, 0]]))
+    >>> labels.tolist(), jaccard.tolist()
+    ([1, 2], [0.5, 0.5])
+    >>> volumes1.tolist(), volumes2.tolist()
+    ([2.0, 3.0], [1.0, 3.0])
+
+    """
+
+    def __init__(self, data1, mask_volume=None, bg_overlap=False):
+        data1 = np.array(data1)
+        data1[np.logical_or(data1 < 0, np.isnan(data1))] = 0
+        self._dtype = np.min_scalar_type(int(data1.max()))
+        data1 = data1.astype(self._dtype)
+        self._mask = None
+        if mask_volume is not None:
+            maskdata = nb.load(mask_volume).get_data()
+            self._mask = ~np.logical_or(maskdata == 0, np.isnan(maskdata))
+            data1[~self._mask] = 0
+        self._shape = data1.shape
+        self._data1 = data1.ravel()
+        self._counts1 = np.bincount(self._data1)
+        labels = np.flatnonzero(self._counts1)
+        self.labels = labels[labels > 0]
+        if bg_overlap:
+            self.labels = np.hstack(([0], self.labels))
+
+    def compare(self, data2):
+        """Compare a test label map with the reference
+
+        Returns the labels of the reference, their Jaccard index, their
+        volumes (in voxels) in the reference and in the test map and a
+        boolean map of the voxels where the labels differ.
+        """
+        data2 = np.asarray(data2).astype(self._dtype)
+        if self._mask is not None:
+            data2[~self._mask] = 0
+        data2 = data2.ravel()
+        nbins = max(len(self._counts1), int(data2.max()) + 1)
+        counts1 = np.zeros(nbins, dtype=np.intp)
+        counts1[:len(self._counts1)] = self._counts1
+        counts2 = np.bincount(data2, minlength=nbins)
+        agree = self._data1 == data2
+        both = np.bincount(self._data1[agree], minlength=nbins)
+
+        labels = self.labels
+        union = counts1[labels] + counts2[labels] - both[labels]
+        jaccard = np.zeros(len(labels))
+        np.divide(both[labels], union, out=jaccard, where=union > 0)
+        return (labels, jaccard, counts1[labels].astype(np.float64),
+                counts2[labels].astype(np.float64),
+                ~agree.reshape(self._shape))
+
+
 class OverlapInputSpec(BaseInterfaceInputSpec):
     volume1 = File(exists=True, mandatory=True,
                    desc='Has to have the same dimensions as volume2.')
@@ -259,6 +333,9 @@ class Overlap(BaseInterface):
     now can be reported in :math:`mm^3`, although they are given in voxels
     to keep backwards compatibility.
 
+    Use :class:`LabelOverlap` to compare many label maps with the same
+    reference without reloading it.
+
     Example
     -------
 
@@ -271,15 +348,8 @@ class Overlap(BaseInterface):
     input_spec = OverlapInputSpec
     output_spec = OverlapOutputSpec
 
-    def _bool_vec_dissimilarity(self, booldata1, booldata2, method):
-        methods = {'dice': dice, 'jaccard': jaccard}
-        if not (np.any(booldata1) or np.any(booldata2)):
-            return 0
-        return 1 - methods[method](booldata1.flat, booldata2.flat)
-
     def _run_interface(self, runtime):
         nii1 = nb.load(self.inputs.volume1)
-        nii2 = nb.load(self.inputs.volume2)
 
         scale = 1.0
 
@@ -288,37 +358,18 @@ class Overlap(BaseInterface):
             for i in range(nii1.get_data().ndim - 1):
                 scale = scale * voxvol[i]
 
-        data1 = nii1.get_data()
-        data1[np.logical_or(data1 < 0, np.isnan(data1))] = 0
-        max1 = int(data1.max())
-        data1 = data1.astype(np.min_scalar_type(max1))
-        data2 = nii2.get_data().astype(np.min_scalar_type(max1))
-        data2[np.logical_or(data1 < 0, np.isnan(data1))] = 0
-        max2 = data2.max()
-        maxlabel = max(max1, max2)
-
+        mask_volume = None
         if isdefined(self.inputs.mask_volume):
-            maskdata = nb.load(self.inputs.mask_volume).get_data()
-            maskdata = ~np.logical_or(maskdata == 0, np.isnan(maskdata))
-            data1[~maskdata] = 0
-            data2[~maskdata] = 0
-
-        res = []
-        volumes1 = []
-        volumes2 = []
-
-        labels = np.unique(data1[data1 > 0].reshape(-1)).tolist()
-        if self.inputs.bg_overlap:
-            labels.insert(0, 0)
-
-        for l in labels:
-            res.append(self._bool_vec_dissimilarity(data1 == l,
-                                                    data2 == l, method='jaccard'))
-            volumes1.append(scale * len(data1[data1 == l]))
-            volumes2.append(scale * len(data2[data2 == l]))
+            mask_volume = self.inputs.mask_volume
+        overlap = LabelOverlap(nii1.get_data(), mask_volume=mask_volume,
+                               bg_overlap=self.inputs.bg_overlap)
+        labels, jaccard, volumes1, volumes2, difference = overlap.compare(
+            nb.load(self.inputs.volume2).get_data())
+        volumes1 = scale * volumes1
+        volumes2 = scale * volumes2
 
         results = dict(jaccard=[], dice=[])
-        results['jaccard'] = np.array(res)
+        results['jaccard'] = jaccard
         results['dice'] = 2.0 * results['jaccard'] / (results['jaccard'] + 1.0)
 
         weights = np.ones((len(volumes1),), dtype=np.float32)
@@ -328,13 +379,12 @@ class Overlap(BaseInterface):
                 weights = weights**2
         weights = weights / np.sum(weights)
 
-        both_data = np.zeros(data1.shape)
-        both_data[(data1 - data2) != 0] = 1
+        both_data = difference.astype(np.float64)
 
         nb.save(nb.Nifti1Image(both_data, nii1.affine, nii1.header),
                 self.inputs.out_file)
 
-        self._labels = labels
+        self._labels = labels.tolist()
         self._ove_rois = results
         self._vol_rois = (np.array(volumes1) -
                           np.array(volumes2)) / np.array(volumes1)
@@ -603,9 +653,14 @@ class Similarity(BaseInterface):
     the same coordinate system, same space within that coordinate system and
     with the same voxel dimensions.
 
+    The similarity is computed from the joint histogram of the volumes,
+    as :py:class:`nipy.algorithms.registration.HistogramRegistration` does
+    for the identity transform, but all the volumes of 4D files are
+    binned and compared at once. Unlike nipy, large volumes are not
+    subsampled.
+
     .. note:: This interface is an extension of
               :py:class:`nipype.interfaces.nipy.utils.Similarity` to support 4D files.
-              Requires :py:mod:`nipy`
 
     Example
     -------
@@ -621,56 +676,62 @@ class Similarity(BaseInterface):
 
     input_spec = SimilarityInputSpec
     output_spec = SimilarityOutputSpec
-    _have_nipy = True
-
-    def __init__(self, **inputs):
-        try:
-            package_check('nipy')
-        except Exception as e:
-            self._have_nipy = False
-        super(Similarity, self).__init__(**inputs)
+    # number of values (voxels or histogram bins x volumes) processed at once
+    _batch_values = 2 ** 22
 
     def _run_interface(self, runtime):
-        if not self._have_nipy:
-            raise RuntimeError('nipy is not installed')
-
-        from nipy.algorithms.registration.histogram_registration import HistogramRegistration
-        from nipy.algorithms.registration.affine import Affine
-
-        vol1_nii = nb.load(self.inputs.volume1)
-        vol2_nii = nb.load(self.inputs.volume2)
-
-        dims = vol1_nii.get_data().ndim
-
-        if dims == 3 or dims == 2:
-            vols1 = [vol1_nii]
-            vols2 = [vol2_nii]
-        if dims == 4:
-            vols1 = nb.four_to_three(vol1_nii)
-            vols2 = nb.four_to_three(vol2_nii)
-
-        if dims < 2 or dims > 4:
-            raise RuntimeError('Image dimensions not supported (detected %dD file)' % dims)
-
-        if isdefined(self.inputs.mask1):
-            mask1 = nb.load(self.inputs.mask1).get_data() == 1
-        else:
-            mask1 = None
-
-        if isdefined(self.inputs.mask2):
-            mask2 = nb.load(self.inputs.mask2).get_data() == 1
-        else:
-            mask2 = None
+        if self.inputs.metric == 'slr':
+            raise ValueError('slr measure requires a joint intensity '
+                             'distribution model')
+
+        datalist = []
+        for filename in [self.inputs.volume1, self.inputs.volume2]:
+            vol = nb.load(filename)
+            dims = len(vol.shape)
+            if dims < 2 or dims > 4:
+                raise RuntimeError('Image dimensions not supported (detected '
+                                   '%dD file)' % dims)
+            # uncompressed images are read from disk as needed
+            if filename.endswith('.gz'):
+                datalist.append(vol.get_data())
+            else:
+                datalist.append(vol.dataobj)
+        nvoxels = int(np.prod(datalist[0].shape[:3]))
+        lengths = [int(np.prod(data.shape[3:])) for data in datalist]
+        if all([data.ndim == 4 for data in datalist]) and \
+                lengths[0] != lengths[1]:
+            raise RuntimeError('volume1 and volume2 have different numbers of '
+                               'volumes (%d and %d)' % tuple(lengths))
+        nvols = min(lengths)
+
+        masks = []
+        for mask in [self.inputs.mask1, self.inputs.mask2]:
+            if isdefined(mask):
+                mask = nb.load(mask).get_data().reshape(-1, order='F') == 1
+            else:
+                mask = None
+            masks.append(mask)
 
         self._similarity = []
-
-        for ts1, ts2 in zip(vols1, vols2):
-            histreg = HistogramRegistration(from_img=ts1,
-                                            to_img=ts2,
-                                            similarity=self.inputs.metric,
-                                            from_mask=mask1,
-                                            to_mask=mask2)
-            self._similarity.append(histreg.eval(Affine()))
+        # bound both the binned volumes and their (256 x 256) joint histograms
+        batch_size = int(max(1, self._batch_values // max(nvoxels, 256 ** 2)))
+        for t0 in range(0, nvols, batch_size):
+            t1 = min(t0 + batch_size, nvols)
+            clamped = []
+            for data, mask in zip(datalist, masks):
+                if data.ndim == 4:
+                    data = data[..., t0:t1]
+                clamped.append(_clamp(np.asarray(data).reshape(
+                    (nvoxels, -1), order='F'), mask))
+            hists = _joint_histograms(clamped[0][0], clamped[1][0])
+            if callable(self.inputs.metric):
+                for hist, bins1, bins2 in zip(hists, clamped[0][1],
+                                              clamped[1][1]):
+                    self._similarity.append(
+                        float(self.inputs.metric(hist[:bins1, :bins2])))
+            else:
+                self._similarity += _histogram_similarity(
+                    hists, self.inputs.metric).tolist()
 
         return runtime
 
@@ -678,3 +739,101 @@ class Similarity(BaseInterface):
         outputs = self._outputs().get()
         outputs['similarity'] = self._similarity
         return outputs
+
+
+def _clamp(data, mask=None, bins=256):
+    """Bin the values of each column (volume) of a (voxels x volumes) array
+    within the mask in the range [0..bins-1] and set the rest to -1.
+
+    Integer volumes spanning less than `bins` values are just shifted.
+    Returns the binned array and the number of bins used by each volume.
+    """
+    if mask is None:
+        mask = np.ones(data.shape[0], dtype=bool)
+    values = data[mask]
+    vmin = values.min(0)
+    span = values.max(0).astype(np.float64) - vmin
+    nbins = np.full(data.shape[1], bins, dtype=int)
+    if issubclass(data.dtype.type, np.integer):
+        scale = np.where(span < bins, 1.0, (bins - 1.0) / np.maximum(span, 1))
+        nbins[span < bins] = span[span < bins].astype(int) + 1
+    else:
+        scale = (bins - 1.0) / np.where(span > 0, span, np.inf)
+        vmin = vmin.astype(data.dtype)
+        scale = scale.astype(data.dtype)
+    clamped = -np.ones(data.shape, dtype=np.int16)
+    clamped[mask] = np.round(scale * (values - vmin))
+    return clamped, nbins
+
+
+def _joint_histograms(clamped1, clamped2, bins=256):
+    """Joint histograms of the columns of two binned (voxels x volumes)
+    arrays, as a (volumes x bins x bins) array. Voxels set to -1 in either
+    array are left out"""
+    nvols = clamped1.shape[1]
+    index = (np.arange(nvols) * bins + clamped1) * bins + clamped2
+    # left out voxels are counted in an extra bin
+    index[(clamped1 < 0) | (clamped2 < 0)] = nvols * bins * bins
+    hists = np.bincount(index.ravel(), minlength=nvols * bins * bins + 1)
+    return hists[:-1].reshape((nvols, bins, bins)).astype(np.float64)
+
+
+def _histogram_similarity(hists, metric):
+    """Similarity of a stack of joint histograms (volumes x bins1 x bins2),
+    as computed by nipy.algorithms.registration.similarity_measures:
+    'cc' (squared correlation coefficient), 'cr' and 'crl1' (correlation
+    ratios of the second volume given the first one), 'mi' (mutual
+    information) and 'nmi' (normalized mutual information)"""
+    tiny = np.finfo(np.double).tiny
+    bins1 = np.arange(hists.shape[1], dtype=np.float64)
+    bins2 = np.arange(hists.shape[2], dtype=np.float64)
+    npts = np.maximum(hists.sum((1, 2)), tiny)
+    hist1 = hists.sum(2)
+    hist2 = hists.sum(1)
+
+    if metric == 'cc':
+        mean1 = np.dot(hist1, bins1) / npts
+        mean2 = np.dot(hist2, bins2) / npts
+        var1 = np.dot(hist1, bins1 ** 2) / npts - mean1 ** 2
+        var2 = np.dot(hist2, bins2 ** 2) / npts - mean2 ** 2
+        cov = np.einsum('tij,i,j->t', hists, bins1, bins2) / npts - \
+            mean1 * mean2
+        return (cov / np.maximum(np.sqrt(var1 * var2), tiny)) ** 2
+
+    if metric == 'cr':
+        # moments of the second volume given each bin of the first one
+        npts_1 = np.maximum(hist1, tiny)
+        mean2_1 = np.dot(hists, bins2) / npts_1
+        var2_1 = np.dot(hists, bins2 ** 2) / npts_1 - mean2_1 ** 2
+        mean2 = np.dot(hist2, bins2) / npts
+        var2 = np.dot(hist2, bins2 ** 2) / npts - mean2 ** 2
+        mean_var2_1 = (hist1 * var2_1).sum(1) / npts
+        return 1. - mean_var2_1 / np.maximum(var2, tiny)
+
+    if metric == 'crl1':
+        def _l1_moments(hist):
+            # weighted median and mean absolute deviation along last axis
+            total = hist.sum(-1)
+            median = np.argmax(hist.cumsum(-1) >= total[..., None] / 2., -1)
+            dev = (hist * np.abs(bins2 - median[..., None])).sum(-1)
+            return dev / np.maximum(total, tiny)
+
+        mean_dev2_1 = (hist1 * _l1_moments(hists)).sum(1) / npts
+        return 1. - mean_dev2_1 / np.maximum(_l1_moments(hist2), tiny)
+
+    prob = hists / npts[:, None, None]
+    prob1 = prob.sum(2)
+    prob2 = prob.sum(1)
+    if metric == 'mi':
+        ratio = prob / np.maximum(prob1, tiny)[:, :, None] / \
+            np.maximum(prob2, tiny)[:, None, :]
+        return (prob * np.log(np.maximum(ratio, tiny))).sum((1, 2))
+
+    if metric == 'nmi':
+        def _entropy(prob, axes):
+            return -(prob * np.log(np.maximum(prob, tiny))).sum(axes)
+
+        return 2 * (1 - _entropy(prob, (1, 2)) / np.maximum(
+            _entropy(prob1, 1) + _entropy(prob2, 1), tiny))
+
+    raise ValueError('Unknown similarity metric %s' % metric)
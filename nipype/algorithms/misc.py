@@ -15,10 +15,10 @@ from __future__ import absolute_import
 from __future__ import division
 from builtins import zip
 from builtins import range
-from future.utils import raise_from
 
 import os
 import os.path as op
+from tempfile import TemporaryFile
 
 import nibabel as nb
 import numpy as np
@@ -38,7 +38,7 @@ from ..interfaces.base import (BaseInterface, traits, TraitedSpec, File,
                                InputMultiPath, OutputMultiPath,
                                BaseInterfaceInputSpec, isdefined,
                                DynamicTraitedSpec, Undefined)
-from nipype.utils.filemanip import fname_presuffix, split_filename
+from nipype.utils.filemanip import fname_presuffix, split_filename, slab_source
 iflogger = logging.getLogger('interface')
 
 
@@ -272,6 +272,9 @@ class TSNRInputSpec(BaseInterfaceInputSpec):
                        desc='output tSNR file')
     detrended_file = File('detrend.nii.gz', usedefault=True, hash_files=False,
                           desc='input file after detrending')
+    float64 = traits.Bool(False, usedefault=True,
+                          desc='compute in double (instead of single) '
+                               'precision')
 
 
 class TSNROutputSpec(TraitedSpec):
@@ -286,6 +289,10 @@ class TSNR(BaseInterface):
 
     Typically you want to run this on a realigned time-series.
 
+    The time series are processed in slabs of slices, read from disk if the
+    input images are uncompressed, and the detrended series is collected in
+    a temporary file, so that memory use stays bounded.
+
     Example
     -------
 
@@ -296,43 +303,96 @@ class TSNR(BaseInterface):
     """
     input_spec = TSNRInputSpec
     output_spec = TSNROutputSpec
+    # number of values (voxels x timepoints) processed at once
+    _slab_values = 2 ** 24
 
     def _run_interface(self, runtime):
         img = nb.load(self.inputs.in_file[0])
         header = img.header.copy()
-        vollist = [nb.load(filename) for filename in self.inputs.in_file]
-        data = np.concatenate([vol.get_data().reshape(
-            vol.get_shape()[:3] + (-1,)) for vol in vollist], axis=3)
-        data = np.nan_to_num(data)
+        # the slabs of uncompressed images are read from disk as needed,
+        # compressed images are read in memory once
+        datalist = []
+        for filename in self.inputs.in_file:
+            vol = nb.load(filename)
+            if filename.endswith('.gz'):
+                datalist.append(vol.get_data())
+            else:
+                datalist.append(vol.dataobj)
+        shape = img.shape[:3]
+        timepoints = sum([int(np.prod(data.shape[3:])) for data in datalist])
 
-        if data.dtype.kind == 'i':
+        # the detrended series are written to a memmap of the output type
+        if img.get_data_dtype().kind != 'f':
             header.set_data_dtype(np.float32)
-            data = data.astype(np.float32)
+        out_dtype = header.get_data_dtype()
+        dtype = np.float32
+        if self.inputs.float64:
+            dtype = np.float64
 
+        X = None
+        detrended = None
         if isdefined(self.inputs.regress_poly):
-            timepoints = img.shape[-1]
             X = np.ones((timepoints, 1))
             for i in range(self.inputs.regress_poly):
                 X = np.hstack((X, legendre(
                     i + 1)(np.linspace(-1, 1, timepoints))[:, None]))
-            betas = np.dot(np.linalg.pinv(X), np.rollaxis(data, 3, 2))
-            datahat = np.rollaxis(np.dot(X[:, 1:],
-                                         np.rollaxis(
-                                             betas[1:, :, :, :], 0, 3)),
-                                  0, 4)
-            data = data - datahat
-            img = nb.Nifti1Image(data, img.get_affine(), header)
+            pinvX = np.linalg.pinv(X).astype(dtype)
+            X = X.astype(dtype)
+            detrended = np.memmap(TemporaryFile(dir=os.getcwd()),
+                                  dtype=out_dtype, mode='w+',
+                                  shape=shape + (timepoints,), order='F')
+
+        meanimg = np.zeros(shape, dtype=dtype)
+        stddevimg = np.zeros(shape, dtype=dtype)
+        # slabs of slices along the last spatial axis
+        slab_size = int(max(1, self._slab_values //
+                            (np.prod(shape[:2]) * timepoints)))
+        for z0 in range(0, shape[2], slab_size):
+            z1 = min(z0 + slab_size, shape[2])
+            # [timepoints x voxels] time series of the slab
+            slab = np.empty((timepoints, np.prod(shape[:2]) * (z1 - z0)),
+                            dtype=dtype)
+            t0 = 0
+            for data in datalist:
+                data = np.asarray(data[:, :, z0:z1])
+                t1 = t0 + int(np.prod(data.shape[3:]))
+                slab[t0:t1] = data.reshape((-1, t1 - t0), order='F').T
+                t0 = t1
+            slab[:] = np.nan_to_num(slab)
+            if X is not None:
+                betas = np.dot(pinvX[1:], slab)
+
+            # single pass (Welford) mean and variance, detrending each
+            # timepoint in place
+            mean = np.zeros(slab.shape[1], dtype=dtype)
+            m2 = np.zeros(slab.shape[1], dtype=dtype)
+            for t, values in enumerate(slab):
+                if X is not None:
+                    values -= np.dot(X[t, 1:], betas)
+                delta = values - mean
+                mean += delta / (t + 1)
+                m2 += delta * (values - mean)
+            meanimg[:, :, z0:z1] = mean.reshape(
+                shape[:2] + (z1 - z0,), order='F')
+            stddevimg[:, :, z0:z1] = np.sqrt(m2 / timepoints).reshape(
+                shape[:2] + (z1 - z0,), order='F')
+            if detrended is not None:
+                detrended[:, :, z0:z1, :] = slab.T.reshape(
+                    shape[:2] + (z1 - z0, timepoints), order='F')
+
+        affine = img.affine
+        if detrended is not None:
+            img = nb.Nifti1Image(detrended, affine, header)
             nb.save(img, op.abspath(self.inputs.detrended_file))
+            del img, detrended
 
-        meanimg = np.mean(data, axis=3)
-        stddevimg = np.std(data, axis=3)
         tsnr = np.zeros_like(meanimg)
         tsnr[stddevimg > 1.e-3] = meanimg[stddevimg > 1.e-3] / stddevimg[stddevimg > 1.e-3]
-        img = nb.Nifti1Image(tsnr, img.get_affine(), header)
+        img = nb.Nifti1Image(tsnr, affine, header)
         nb.save(img, op.abspath(self.inputs.tsnr_file))
-        img = nb.Nifti1Image(meanimg, img.get_affine(), header)
+        img = nb.Nifti1Image(meanimg, affine, header)
         nb.save(img, op.abspath(self.inputs.mean_file))
-        img = nb.Nifti1Image(stddevimg, img.get_affine(), header)
+        img = nb.Nifti1Image(stddevimg, affine, header)
         nb.save(img, op.abspath(self.inputs.stddev_file))
         return runtime
 
@@ -497,31 +557,33 @@ class Matlab2CSV(BaseInterface):
         return outputs
 
 
-def merge_csvs(in_list):
-    for idx, in_file in enumerate(in_list):
+def _read_csv_values(in_file):
+    """Return the numeric values of a CSV file, leaving out a heading line
+    and the first and last columns if they are not numeric (labels)"""
+    import csv
+
+    def _numeric(fields):
         try:
-            in_array = np.loadtxt(in_file, delimiter=',')
-        except ValueError as ex:
-            try:
-                in_array = np.loadtxt(in_file, delimiter=',', skiprows=1)
-            except ValueError as ex:
-                first = open(in_file, 'r')
-                header_line = first.readline()
-                header_list = header_line.split(',')
-                n_cols = len(header_list)
-                try:
-                    in_array = np.loadtxt(
-                        in_file, delimiter=',', skiprows=1,
-                        usecols=list(range(1, n_cols))
-                    )
-                except ValueError as ex:
-                    in_array = np.loadtxt(
-                        in_file, delimiter=',', skiprows=1, usecols=list(range(1, n_cols - 1)))
-        if idx == 0:
-            out_array = in_array
-        else:
-            out_array = np.dstack((out_array, in_array))
-    out_array = np.squeeze(out_array)
+            [float(field) for field in fields]
+        except ValueError:
+            return False
+        return True
+
+    with open(in_file, 'r') as fhandle:
+        rows = [row for row in csv.reader(fhandle) if row]
+    if rows and not _numeric(rows[0]):
+        rows = rows[1:]
+    if rows and not _numeric([row[0] for row in rows]):
+        rows = [row[1:] for row in rows]
+    if rows and not _numeric([row[-1] for row in rows]):
+        rows = [row[:-1] for row in rows]
+    # mono-dimensional axes are squeezed, as numpy.loadtxt does
+    return np.squeeze(np.array(rows, dtype=float))
+
+
+def merge_csvs(in_list):
+    out_array = np.squeeze(np.dstack([_read_csv_values(in_file)
+                                      for in_file in in_list]))
     iflogger.info('Final output array shape:')
     iflogger.info(np.shape(out_array))
     return out_array
@@ -604,10 +666,15 @@ class MergeCSVFilesInputSpec(TraitedSpec):
     extra_field = traits.Str(
         desc='New field to add to each row. This is useful for saving the\
         group or subject ID in the file.')
+    save_npy = traits.Bool(
+        False, usedefault=True, desc='Also save the merged table as a NumPy\
+        structured array (.npy), with one field per column, next to the CSV\
+        file.')
 
 
 class MergeCSVFilesOutputSpec(TraitedSpec):
     csv_file = File(desc='Output CSV file containing columns ')
+    npy_file = File(desc='Output NumPy file containing the merged table')
 
 
 class MergeCSVFiles(BaseInterface):
@@ -632,19 +699,18 @@ class MergeCSVFiles(BaseInterface):
     output_spec = MergeCSVFilesOutputSpec
 
     def _run_interface(self, runtime):
-        extraheadingBool = False
         extraheading = ''
-        rowheadingsBool = False
         """
         This block defines the column headings.
         """
         if isdefined(self.inputs.column_headings):
             iflogger.info('Column headings have been provided:')
-            headings = self.inputs.column_headings
+            headings = list(self.inputs.column_headings)
         else:
             iflogger.info(
                 'Column headings not provided! Pulled from input filenames:')
             headings = remove_identical_paths(self.inputs.in_files)
+        value_headings = list(headings)
 
         if isdefined(self.inputs.extra_field):
             if isdefined(self.inputs.extra_column_heading):
@@ -656,7 +722,6 @@ class MergeCSVFiles(BaseInterface):
                 iflogger.info(
                     'Extra column heading was not defined. Using "type"')
             headings.append(extraheading)
-            extraheadingBool = True
 
         if len(self.inputs.in_files) == 1:
             iflogger.warn('Only one file input!')
@@ -667,7 +732,6 @@ class MergeCSVFiles(BaseInterface):
             prefix = '"{p}","'.format(p=self.inputs.row_heading_title)
             csv_headings = prefix + '","'.join(itertools.chain(
                 headings)) + '"\n'
-            rowheadingsBool = True
         else:
             iflogger.info('Row headings have not been provided.')
             csv_headings = '"' + '","'.join(itertools.chain(headings)) + '"\n'
@@ -676,56 +740,48 @@ class MergeCSVFiles(BaseInterface):
         iflogger.info(csv_headings)
 
         """
-        Next we merge the arrays and define the output text file
+        Next we merge the arrays into columns: one row per line of the input
+        files and one column per input file
         """
 
-        output_array = merge_csvs(self.inputs.in_files)
-        _, name, ext = split_filename(self.inputs.out_file)
-        if not ext == '.csv':
-            ext = '.csv'
-
-        out_file = op.abspath(name + ext)
-        file_handle = open(out_file, 'w')
-        file_handle.write(csv_headings)
-
-        shape = np.shape(output_array)
-        typelist = maketypelist(
-            rowheadingsBool, shape, extraheadingBool, extraheading)
-        fmt, output = makefmtlist(
-            output_array, typelist, rowheadingsBool, shape, extraheadingBool)
-
-        if rowheadingsBool:
-            row_heading_list = self.inputs.row_headings
-            row_heading_list_with_quotes = []
-            for row_heading in row_heading_list:
-                row_heading_with_quotes = '"' + row_heading + '"'
-                row_heading_list_with_quotes.append(row_heading_with_quotes)
-            row_headings = np.array(row_heading_list_with_quotes, dtype='|S40')
-            output['heading'] = row_headings
-
+        output_array = np.atleast_2d(merge_csvs(self.inputs.in_files))
+        nrows = output_array.shape[0]
+        names = list(value_headings)
+        columns = [output_array[:, idx]
+                   for idx in range(output_array.shape[1])]
+        fmtlist = ['%f'] * len(columns)
+        if isdefined(self.inputs.row_headings):
+            names.insert(0, self.inputs.row_heading_title)
+            columns.insert(0, np.array(self.inputs.row_headings, dtype=str))
+            fmtlist.insert(0, '"%s"')
         if isdefined(self.inputs.extra_field):
-            extrafieldlist = []
-            if len(shape) > 1:
-                mx = shape[0]
-            else:
-                mx = 1
-            for idx in range(0, mx):
-                extrafieldlist.append(self.inputs.extra_field)
-            iflogger.info(len(extrafieldlist))
-            output[extraheading] = extrafieldlist
-        iflogger.info(output)
+            names.append(extraheading)
+            columns.append(np.array([self.inputs.extra_field] * nrows))
+            fmtlist.append('%s')
+        fmt = ','.join(fmtlist)
         iflogger.info(fmt)
-        np.savetxt(file_handle, output, fmt, delimiter=',')
-        file_handle.close()
+
+        out_file = self._gen_output_filename()
+        with open(out_file, 'w') as file_handle:
+            file_handle.write(csv_headings)
+            for row in zip(*columns):
+                file_handle.write(fmt % row + '\n')
+
+        if self.inputs.save_npy:
+            table = np.rec.fromarrays(columns, names=[str(name)
+                                                     for name in names])
+            np.save(self._gen_output_filename('.npy'), table.view(np.ndarray))
         return runtime
 
+    def _gen_output_filename(self, ext='.csv'):
+        _, name, _ = split_filename(self.inputs.out_file)
+        return op.abspath(name + ext)
+
     def _list_outputs(self):
         outputs = self.output_spec().get()
-        _, name, ext = split_filename(self.inputs.out_file)
-        if not ext == '.csv':
-            ext = '.csv'
-        out_file = op.abspath(name + ext)
-        outputs['csv_file'] = out_file
+        outputs['csv_file'] = self._gen_output_filename()
+        if self.inputs.save_npy:
+            outputs['npy_file'] = self._gen_output_filename('.npy')
         return outputs
 
 
@@ -762,22 +818,22 @@ class AddCSVColumn(BaseInterface):
     output_spec = AddCSVColumnOutputSpec
 
     def _run_interface(self, runtime):
-        in_file = open(self.inputs.in_file, 'r')
         _, name, ext = split_filename(self.inputs.out_file)
         if not ext == '.csv':
             ext = '.csv'
         out_file = op.abspath(name + ext)
 
-        out_file = open(out_file, 'w')
-        firstline = in_file.readline()
-        firstline = firstline.replace('\n', '')
-        new_firstline = firstline + ',"' + \
-            self.inputs.extra_column_heading + '"\n'
-        out_file.write(new_firstline)
-        for line in in_file:
-            new_line = line.replace('\n', '')
-            new_line = new_line + ',' + self.inputs.extra_field + '\n'
-            out_file.write(new_line)
+        with open(self.inputs.in_file, 'r') as in_file, \
+                open(out_file, 'w') as out_file:
+            firstline = in_file.readline()
+            firstline = firstline.replace('\n', '')
+            new_firstline = firstline + ',"' + \
+                self.inputs.extra_column_heading + '"\n'
+            out_file.write(new_firstline)
+            for line in in_file:
+                new_line = line.replace('\n', '')
+                new_line = new_line + ',' + self.inputs.extra_field + '\n'
+                out_file.write(new_line)
         return runtime
 
     def _list_outputs(self):
@@ -814,13 +870,9 @@ class AddCSVRow(BaseInterface):
 
     """Simple interface to add an extra row to a csv file
 
-    .. note:: Requires `pandas <http://pandas.pydata.org/>`_
-
-    .. warning:: Multi-platform thread-safe execution is possible with
-        `lockfile <https://pythonhosted.org/lockfile/lockfile.html>`_. Please
-        recall that (1) this module is alpha software; and (2) it should be
-        installed for thread-safe writing.
-        If lockfile is not installed, then the interface is not thread-safe.
+    The row is appended to the file, which is locked meanwhile so that
+    several processes can add rows to the same file. The whole file is
+    rewritten only when the row adds new columns.
 
 
     Example
@@ -842,8 +894,6 @@ class AddCSVRow(BaseInterface):
         super(AddCSVRow, self).__init__(**kwargs)
         undefined_traits = {}
         self._infields = infields
-        self._have_lock = False
-        self._lock = None
 
         if infields:
             for key in infields:
@@ -856,20 +906,6 @@ class AddCSVRow(BaseInterface):
             self._always_run = True
 
     def _run_interface(self, runtime):
-        try:
-            import pandas as pd
-        except ImportError as e:
-            raise_from(ImportError('This interface requires pandas '
-                                    '(http://pandas.pydata.org/) to run.'), e)
-
-        try:
-            import lockfile as pl
-            self._have_lock = True
-        except ImportError:
-            from warnings import warn
-            warn(('Python module lockfile was not found: AddCSVRow will not be'
-                  ' thread-safe in multi-processor execution'))
-
         input_dict = {}
         for key, val in list(self.inputs._outputs.items()):
             # expand lists to several columns
@@ -882,31 +918,7 @@ class AddCSVRow(BaseInterface):
             else:
                 input_dict[key] = val
 
-        df = pd.DataFrame([input_dict])
-
-        if self._have_lock:
-            self._lock = pl.FileLock(self.inputs.in_file)
-
-            # Acquire lock
-            self._lock.acquire()
-
-        if op.exists(self.inputs.in_file):
-            formerdf = pd.read_csv(self.inputs.in_file, index_col=0)
-            df = pd.concat([formerdf, df], ignore_index=True)
-
-        with open(self.inputs.in_file, 'w') as f:
-            df.to_csv(f)
-
-        if self._have_lock:
-            self._lock.release()
-
-        # Using nipype.external.portalocker this might be something like:
-        # with pl.Lock(self.inputs.in_file, timeout=1) as fh:
-        #     if op.exists(fh):
-        #         formerdf = pd.read_csv(fh, index_col=0)
-        #         df = pd.concat([formerdf, df], ignore_index=True)
-        #         df.to_csv(fh)
-
+        _append_csv_row(self.inputs.in_file, input_dict)
         return runtime
 
     def _list_outputs(self):
@@ -921,6 +933,84 @@ class AddCSVRow(BaseInterface):
         return base
 
 
+def _csv_field(value):
+    """Format a value as a field of a CSV file"""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return ''
+    if isinstance(value, float):
+        value = repr(float(value))
+    else:
+        value = str(value)
+    if any(char in value for char in ',"\r\n'):
+        value = '"%s"' % value.replace('"', '""')
+    return value
+
+
+def _last_line(in_file):
+    """Return the last line of a text file, reading it from the end"""
+    with open(in_file, 'rb') as fhandle:
+        fhandle.seek(0, os.SEEK_END)
+        pos = fhandle.tell()
+        tail = b''
+        while pos > 0 and b'\n' not in tail.rstrip(b'\r\n'):
+            step = min(4096, pos)
+            pos -= step
+            fhandle.seek(pos)
+            tail = fhandle.read(step) + tail
+    return tail.rstrip(b'\r\n').split(b'\n')[-1].decode('utf-8')
+
+
+def _append_csv_row(in_file, row):
+    """Append a row (dictionary of values) to a CSV file with the row index
+    in its first column, as written by :py:meth:`pandas.DataFrame.to_csv`.
+
+    The file is locked while it is updated and only the new line is
+    written, unless the row brings new columns and the whole file must be
+    rewritten.
+    """
+    import csv
+    from ..external import portalocker
+
+    with open(in_file, 'a+') as fhandle:
+        portalocker.lock(fhandle, portalocker.LOCK_EX)
+        fhandle.seek(0)
+        header = fhandle.readline().rstrip('\r\n')
+        if not header:
+            columns = sorted(row.keys())
+            fhandle.write(','.join([''] + [_csv_field(col)
+                                           for col in columns]) + '\n')
+            index = 0
+        else:
+            columns = next(csv.reader([header]))[1:]
+            last = _last_line(in_file)
+            try:
+                index = int(next(csv.reader([last]))[0]) + 1
+            except ValueError:
+                index = 0
+
+        new_columns = sorted(set(row.keys()) - set(columns))
+        if new_columns:
+            iflogger.info('Rewriting %s to add columns %s' % (
+                in_file, ', '.join(new_columns)))
+            fhandle.seek(0)
+            lines = list(csv.reader(fhandle))[1:]
+            columns += new_columns
+            fhandle.seek(0)
+            fhandle.truncate()
+            fhandle.write(','.join([''] + [_csv_field(col)
+                                           for col in columns]) + '\n')
+            for line in lines:
+                line += [''] * (len(columns) + 1 - len(line))
+                fhandle.write(','.join([_csv_field(field)
+                                        for field in line]) + '\n')
+
+        fhandle.write(','.join(['%d' % index] +
+                               [_csv_field(row.get(col)) for col in columns]) +
+                      '\n')
+        fhandle.flush()
+        portalocker.unlock(fhandle)
+
+
 class CalculateNormalizedMomentsInputSpec(TraitedSpec):
     timeseries_file = File(
         exists=True, mandatory=True,
@@ -990,6 +1080,8 @@ class AddNoiseInputSpec(TraitedSpec):
     bg_dist = traits.Enum('normal', 'rayleigh', usedefault=True, mandatory=True,
                           desc=('desired noise distribution, currently '
                                 'only normal is implemented'))
+    seed = traits.Int(desc=('seed of the noise generator, the same seed '
+                            'yields the same noise'))
     out_file = File(desc='desired output filename')
 
 
@@ -1014,21 +1106,31 @@ class AddNoise(BaseInterface):
     """
     input_spec = AddNoiseInputSpec
     output_spec = AddNoiseOutputSpec
+    # number of values processed at once
+    _slab_values = 2 ** 24
 
     def _run_interface(self, runtime):
         in_image = nb.load(self.inputs.in_file)
-        in_data = in_image.get_data()
+        in_data = slab_source(self.inputs.in_file)
         snr = self.inputs.snr
 
+        in_mask = None
         if isdefined(self.inputs.in_mask):
-            in_mask = nb.load(self.inputs.in_mask).get_data()
-        else:
-            in_mask = np.ones_like(in_data)
-
-        result = self.gen_noise(in_data, mask=in_mask, snr_db=snr,
-                                dist=self.inputs.dist, bg_dist=self.inputs.bg_dist)
+            in_mask = slab_source(self.inputs.in_mask)
+
+        seed = None
+        if isdefined(self.inputs.seed):
+            seed = self.inputs.seed
+
+        out_file = self._gen_output_filename()
+        result = np.memmap(TemporaryFile(dir=op.dirname(out_file)),
+                           dtype=np.float32, mode='w+', shape=in_image.shape,
+                           order='F')
+        self.gen_noise(in_data, mask=in_mask, snr_db=snr,
+                       dist=self.inputs.dist, bg_dist=self.inputs.bg_dist,
+                       seed=seed, out=result)
         res_im = nb.Nifti1Image(result, in_image.affine, in_image.header)
-        res_im.to_filename(self._gen_output_filename())
+        res_im.to_filename(out_file)
         return runtime
 
     def _gen_output_filename(self):
@@ -1045,48 +1147,92 @@ class AddNoise(BaseInterface):
         outputs['out_file'] = self._gen_output_filename()
         return outputs
 
-    def gen_noise(self, image, mask=None, snr_db=10.0, dist='normal', bg_dist='normal'):
+    def gen_noise(self, image, mask=None, snr_db=10.0, dist='normal',
+                  bg_dist='normal', seed=None, out=None):
         """
         Generates a copy of an image with a certain amount of
         added gaussian noise (rayleigh for background in mask)
+
+        The image (and mask) are read in slabs of slices along the third
+        axis and the noise is computed in single precision. The noise of
+        each slice of each volume is drawn from its own generator, seeded
+        from ``seed`` and the indices of the slice, so the result does not
+        depend on the size of the slabs. The noise realizations differ from
+        those of versions that drew the noise of the whole image at once,
+        even with the same global numpy random state.
         """
         from math import sqrt
         snr = sqrt(np.power(10.0, snr_db / 10.0))
 
-        if mask is None:
-            mask = np.ones_like(image)
-        else:
-            mask[mask > 0] = 1
-            mask[mask < 1] = 0
-
-            if mask.ndim < image.ndim:
-                mask = np.rollaxis(np.array([mask] * image.shape[3]), 0, 4)
-
-        signal = image[mask > 0].reshape(-1)
-
-        if dist == 'normal':
-            signal = signal - signal.mean()
-            sigma_n = sqrt(signal.var() / snr)
-            noise = np.random.normal(size=image.shape, scale=sigma_n)
-
-            if (np.any(mask == 0)) and (bg_dist == 'rayleigh'):
-                bg_noise = np.random.rayleigh(size=image.shape, scale=sigma_n)
-                noise[mask == 0] = bg_noise[mask == 0]
-
-            im_noise = image + noise
-
-        elif dist == 'rician':
-            sigma_n = signal.mean() / snr
-            n_1 = np.random.normal(size=image.shape, scale=sigma_n)
-            n_2 = np.random.normal(size=image.shape, scale=sigma_n)
-            stde_1 = n_1 / sqrt(2.0)
-            stde_2 = n_2 / sqrt(2.0)
-            im_noise = np.sqrt((image + stde_1)**2 + (stde_2)**2)
-        else:
+        if dist not in ('normal', 'rician'):
             raise NotImplementedError(('Only normal and rician distributions '
                                        'are supported'))
+        if seed is None:
+            seed = np.random.randint(2 ** 31 - 1)
+        if out is None:
+            out = np.empty(image.shape, dtype=np.float32, order='F')
+
+        shape = image.shape
+        nvols = int(np.prod(shape[3:]))
+        slab_size = int(max(1, self._slab_values //
+                            (np.prod(shape) // shape[2])))
+        slabs = [slice(z0, min(z0 + slab_size, shape[2]))
+                 for z0 in range(0, shape[2], slab_size)]
+
+        def _read(slab):
+            values = np.asarray(image[:, :, slab], dtype=np.float32)
+            values = values.reshape(shape[:2] + (-1, nvols), order='F')
+            if mask is None:
+                return values, np.ones(values.shape, dtype=bool)
+            msk = np.asarray(mask[:, :, slab]) > 0
+            msk = msk.reshape(shape[:2] + (-1, int(np.prod(msk.shape[3:]))),
+                              order='F')
+            return values, np.broadcast_to(msk, values.shape)
+
+        # mean and variance of the signal, combined across slabs
+        count, mean, m2 = 0, 0.0, 0.0
+        for slab in slabs:
+            values, msk = _read(slab)
+            signal = values[msk].astype(np.float64)
+            if signal.size == 0:
+                continue
+            delta = signal.mean() - mean
+            total = count + signal.size
+            m2 += (((signal - signal.mean()) ** 2).sum() +
+                   delta ** 2 * count * signal.size / total)
+            mean += delta * signal.size / total
+            count = total
 
-        return im_noise
+        if dist == 'normal':
+            sigma_n = sqrt(m2 / count / snr)
+        else:
+            sigma_n = mean / snr
+
+        out_values = out.reshape(shape[:3] + (nvols, ), order='F')
+        for slab in slabs:
+            values, msk = _read(slab)
+            for z in range(values.shape[2]):
+                for t in range(nvols):
+                    rng = np.random.RandomState(
+                        [seed, slab.start + z, t])
+                    vol = values[:, :, z, t]
+                    if dist == 'normal':
+                        noise = rng.normal(size=vol.shape, scale=sigma_n)
+                        if bg_dist == 'rayleigh':
+                            bg_noise = rng.rayleigh(size=vol.shape,
+                                                    scale=sigma_n)
+                            bg = ~msk[:, :, z, t]
+                            noise[bg] = bg_noise[bg]
+                        vol = vol + noise.astype(np.float32)
+                    else:
+                        stde_1 = rng.normal(size=vol.shape, scale=sigma_n)
+                        stde_2 = rng.normal(size=vol.shape, scale=sigma_n)
+                        stde_1 = stde_1.astype(np.float32) / sqrt(2.0)
+                        stde_2 = stde_2.astype(np.float32) / sqrt(2.0)
+                        vol = np.sqrt((vol + stde_1)**2 + (stde_2)**2)
+                    out_values[:, :, slab.start + z, t] = vol
+
+        return out
 
 
 class NormalizeProbabilityMapSetInputSpec(TraitedSpec):
@@ -1141,7 +1287,15 @@ class SplitROIsInputSpec(TraitedSpec):
                    desc='file to be splitted')
     in_mask = File(exists=True, desc='only process files inside mask')
     roi_size = traits.Tuple(traits.Int, traits.Int, traits.Int,
-                            desc='desired ROI size')
+                            xor=['n_rois'], desc='desired ROI size')
+    n_rois = traits.Range(low=1, xor=['roi_size'],
+                          desc=('split the voxels in this number of ROIs '
+                                '(e.g., the number of parallel jobs)'))
+    out_format = traits.Enum('nifti', 'npy', usedefault=True,
+                             desc=('\'nifti\': one 4D image (and mask) per '
+                                   'ROI. \'npy\': one (voxels x volumes) '
+                                   'array per ROI, that is memory-mapped '
+                                   'when merged'))
 
 
 class SplitROIsOutputSpec(TraitedSpec):
@@ -1157,6 +1311,13 @@ class SplitROIs(BaseInterface):
     """
     Splits a 3D image in small chunks to enable parallel processing.
     ROIs keep time series structure in 4D images.
+
+    With ``out_format='npy'``, the (in-mask) voxels of each ROI are saved
+    as a (voxels x volumes) .npy array instead of a compressed 4D image,
+    which is much faster to write and merge for processing steps that are
+    implemented in Python. ``n_rois`` sets the number of ROIs instead of
+    their size, e.g., to the number of parallel jobs.
+
     >>> from nipype.algorithms import misc
     >>> rois = misc.SplitROIs()
     >>> rois.inputs.in_file = 'diffusion.nii'
@@ -1176,11 +1337,16 @@ class SplitROIs(BaseInterface):
             mask = self.inputs.in_mask
         if isdefined(self.inputs.roi_size):
             roisize = self.inputs.roi_size
+        nrois = None
+        if isdefined(self.inputs.n_rois):
+            nrois = self.inputs.n_rois
 
         res = split_rois(self.inputs.in_file,
-                         mask, roisize)
+                         mask, roisize, nrois=nrois,
+                         out_format=self.inputs.out_format)
         self._outnames['out_files'] = res[0]
-        self._outnames['out_masks'] = res[1]
+        if res[1]:
+            self._outnames['out_masks'] = res[1]
         self._outnames['out_index'] = res[2]
         return runtime
 
@@ -1208,6 +1374,9 @@ class MergeROIs(BaseInterface):
     Splits a 3D image in small chunks to enable parallel processing.
     ROIs keep time series structure in 4D images.
 
+    The ROIs can be 4D images or (voxels x volumes) .npy arrays (see
+    :class:`SplitROIs`).
+
     Example
     -------
 
@@ -1239,10 +1408,14 @@ def normalize_tpms(in_files, in_mask=None, out_files=[]):
     """
     Returns the input tissue probability maps (tpms, aka volume fractions)
     normalized to sum up 1.0 at each voxel within the mask.
+
+    The maps are processed in slabs of slices along the third axis, so
+    that only the sum of the maps is held in memory as a whole volume.
     """
     import nibabel as nib
     import numpy as np
     import os.path as op
+    from tempfile import TemporaryFile
 
     in_files = np.atleast_1d(in_files).tolist()
 
@@ -1257,47 +1430,70 @@ def normalize_tpms(in_files, in_mask=None, out_files=[]):
             out_files += [out_file]
 
     imgs = [nib.load(fim) for fim in in_files]
+    shape = imgs[0].shape
+    # number of slices along the third axis read at once (2 ** 24 values)
+    slab_size = int(max(1, 2 ** 24 // (np.prod(shape) // shape[2])))
+    slabs = [slice(z0, min(z0 + slab_size, shape[2]))
+             for z0 in range(0, shape[2], slab_size)]
 
-    if len(in_files) == 1:
-        img_data = imgs[0].get_data()
-        img_data[img_data > 0.0] = 1.0
-        hdr = imgs[0].header.copy()
+    def _save(probmap, i, out_file):
+        hdr = imgs[i].header.copy()
         hdr['data_type'] = 16
         hdr.set_data_dtype(np.float32)
-        nib.save(nib.Nifti1Image(img_data.astype(np.float32), imgs[0].affine,
-                                 hdr), out_files[0])
-        return out_files[0]
+        nib.save(nib.Nifti1Image(probmap, imgs[i].affine, hdr), out_file)
 
-    img_data = np.array([im.get_data() for im in imgs]).astype(np.float32)
-    # img_data[img_data>1.0] = 1.0
-    img_data[img_data < 0.0] = 0.0
-    weights = np.sum(img_data, axis=0)
+    def _out_volume(out_file):
+        return np.memmap(TemporaryFile(dir=op.dirname(out_file)),
+                         dtype=np.float32, mode='w+', shape=shape, order='F')
 
-    msk = np.ones_like(imgs[0].get_data())
-    msk[weights <= 0] = 0
+    if len(in_files) == 1:
+        data = slab_source(in_files[0])
+        probmap = _out_volume(out_files[0])
+        for slab in slabs:
+            values = np.array(data[:, :, slab], dtype=np.float32)
+            values[values > 0.0] = 1.0
+            probmap[:, :, slab] = values
+        _save(probmap, 0, out_files[0])
+        return out_files[0]
 
-    if in_mask is not None:
-        msk = nib.load(in_mask).get_data()
-        msk[msk <= 0] = 0
-        msk[msk > 0] = 1
+    weights = np.zeros(shape, dtype=np.float32)
+    for fim in in_files:
+        data = slab_source(fim)
+        for slab in slabs:
+            values = np.asarray(data[:, :, slab], dtype=np.float32)
+            weights[:, :, slab] += np.clip(values, 0.0, None)
+        del data
 
-    msk = np.ma.masked_equal(msk, 0)
+    msk = None
+    if in_mask is not None:
+        msk = slab_source(in_mask)
 
     for i, out_file in enumerate(out_files):
-        data = np.ma.masked_equal(img_data[i], 0)
-        probmap = data / weights
-        hdr = imgs[i].header.copy()
-        hdr['data_type'] = 16
-        hdr.set_data_dtype('float32')
-        nib.save(nib.Nifti1Image(probmap.astype(np.float32), imgs[i].affine,
-                                 hdr), out_file)
+        data = slab_source(in_files[i])
+        probmap = _out_volume(out_file)
+        for slab in slabs:
+            values = np.asarray(data[:, :, slab], dtype=np.float32)
+            valid = values > 0.0
+            if msk is not None:
+                valid &= np.asarray(msk[:, :, slab]).reshape(
+                    valid.shape[:3] + (1, ) * (valid.ndim - 3)) > 0
+            probmap[:, :, slab] = np.divide(
+                values, weights[:, :, slab], out=np.zeros_like(values),
+                where=valid)
+        _save(probmap, i, out_file)
+        del data, probmap
 
     return out_files
 
 
-def split_rois(in_file, mask=None, roishape=None):
+def split_rois(in_file, mask=None, roishape=None, nrois=None,
+               out_format='nifti'):
     """
     Splits an image in ROIs for parallel processing
+
+    If nrois is given, the voxels are split in this number of ROIs instead of
+    ROIs of shape roishape. With out_format='npy', each ROI is saved as a
+    (voxels x volumes) array, without padding, and no masks are returned.
     """
     import nibabel as nb
     import numpy as np
@@ -1311,8 +1507,6 @@ def split_rois(in_file, mask=None, roishape=None):
     imshape = im.shape
     dshape = imshape[:3]
     nvols = imshape[-1]
-    roisize = roishape[0] * roishape[1] * roishape[2]
-    droishape = (roishape[0], roishape[1], roishape[2], nvols)
 
     if mask is not None:
         mask = nb.load(mask).get_data()
@@ -1321,37 +1515,47 @@ def split_rois(in_file, mask=None, roishape=None):
     else:
         mask = np.ones(dshape)
 
-    mask = mask.reshape(-1).astype(np.uint8)
-    nzels = np.nonzero(mask)
-    els = np.sum(mask)
-    nrois = int(ceil(els / float(roisize)))
+    mask = mask.astype(np.bool)
+    nzels = np.nonzero(mask.reshape(-1))
+    els = len(nzels[0])
+    if nrois is not None:
+        # exactly nrois ROIs, whose sizes differ by one voxel at most
+        sizes = [len(idxs) for idxs in np.array_split(nzels[0], nrois)]
+        roishape = (max(1, sizes[0]), 1, 1)
+    roisize = roishape[0] * roishape[1] * roishape[2]
+    droishape = (roishape[0], roishape[1], roishape[2], nvols)
+    if nrois is None:
+        sizes = [min(roisize, els - first) for first in range(0, els, roisize)]
+        nrois = len(sizes)
+    bounds = np.cumsum([0] + sizes)
 
-    data = im.get_data().reshape((mask.size, -1))
-    data = np.squeeze(data.take(nzels, axis=0))
+    data = im.get_data()[mask].reshape((els, -1))
     nvols = data.shape[-1]
 
     roidefname = op.abspath('onesmask.nii.gz')
-    nb.Nifti1Image(np.ones(roishape, dtype=np.uint8), None,
-                   None).to_filename(roidefname)
+    if out_format == 'nifti':
+        nb.Nifti1Image(np.ones(roishape, dtype=np.uint8), None,
+                       None).to_filename(roidefname)
 
     out_files = []
     out_mask = []
     out_idxs = []
 
     for i in range(nrois):
-        first = i * roisize
-        last = (i + 1) * roisize
-        fill = 0
-
-        if last > els:
-            fill = last - els
-            last = els
+        first, last = bounds[i], bounds[i + 1]
+        fill = roisize - (last - first)
 
         droi = data[first:last, ...]
         iname = op.abspath('roi%010d_idx' % i)
         out_idxs.append(iname + '.npz')
         np.savez(iname, (nzels[0][first:last],))
 
+        if out_format == 'npy':
+            fname = op.abspath('roi%010d.npy' % i)
+            np.save(fname, droi)
+            out_files.append(fname)
+            continue
+
         if fill > 0:
             droi = np.vstack((droi, np.zeros((fill, nvols), dtype=np.float32)))
             partialmsk = np.ones((roisize,), dtype=np.uint8)
@@ -1370,15 +1574,34 @@ def split_rois(in_file, mask=None, roishape=None):
     return out_files, out_mask, out_idxs
 
 
+def _load_roi(in_file):
+    """Return the (voxels x volumes) data of a ROI produced by split_rois"""
+    import nibabel as nb
+    import numpy as np
+
+    if in_file.endswith('.npy'):
+        data = np.load(in_file, mmap_mode='r')
+    else:
+        data = nb.load(in_file).get_data()
+    if data.ndim > 2:
+        return data.reshape((-1, int(np.prod(data.shape[3:]))))
+    return data.reshape((data.shape[0], -1))
+
+
 def merge_rois(in_files, in_idxs, in_ref,
                dtype=None, out_file=None):
     """
     Re-builds an image resulting from a parallelized processing
+
+    The ROIs are written with direct slice assignment into the merged image.
+    For 300 volumes or more, the merged image is collected in a temporary
+    file instead of in memory.
     """
     import nibabel as nb
     import numpy as np
     import os.path as op
     import subprocess as sp
+    from tempfile import TemporaryFile
 
     if out_file is None:
         out_file = op.abspath('merged.nii.gz')
@@ -1401,62 +1624,33 @@ def merge_rois(in_files, in_idxs, in_ref,
     hdr = ref.header.copy()
     rsh = ref.shape
     del ref
-    npix = rsh[0] * rsh[1] * rsh[2]
-    fcdata = nb.load(in_files[0]).get_data()
-
-    if fcdata.ndim == 4:
-        ndirs = fcdata.shape[-1]
-    else:
-        ndirs = 1
+    ndirs = _load_roi(in_files[0]).shape[-1]
     newshape = (rsh[0], rsh[1], rsh[2], ndirs)
     hdr.set_data_dtype(dtype)
     hdr.set_xyzt_units('mm', 'sec')
 
     if ndirs < 300:
-        data = np.zeros((npix, ndirs))
-        for cname, iname in zip(in_files, in_idxs):
-            f = np.load(iname)
-            idxs = np.squeeze(f['arr_0'])
-            cdata = nb.load(cname).get_data().reshape(-1, ndirs)
-            nels = len(idxs)
-            idata = (idxs, )
-            try:
-                data[idata, ...] = cdata[0:nels, ...]
-            except:
-                print(('Consistency between indexes and chunks was '
-                       'lost: data=%s, chunk=%s') % (str(data.shape),
-                                                     str(cdata.shape)))
-                raise
-
-        hdr.set_data_shape(newshape)
-        nb.Nifti1Image(data.reshape(newshape).astype(dtype),
-                       aff, hdr).to_filename(out_file)
-
+        data = np.zeros(newshape, dtype=dtype)
     else:
-        hdr.set_data_shape(rsh[:3])
-        nii = []
-        for d in range(ndirs):
-            fname = op.abspath('vol%06d.nii' % d)
-            nb.Nifti1Image(np.zeros(rsh[:3]), aff, hdr).to_filename(fname)
-            nii.append(fname)
-
-        for cname, iname in zip(in_files, in_idxs):
-            f = np.load(iname)
-            idxs = np.squeeze(f['arr_0'])
-
-            for d, fname in enumerate(nii):
-                data = nb.load(fname).get_data().reshape(-1)
-                cdata = nb.load(cname).get_data().reshape(-1, ndirs)[:, d]
-                nels = len(idxs)
-                idata = (idxs, )
-                data[idata] = cdata[0:nels]
-                nb.Nifti1Image(data.reshape(rsh[:3]),
-                               aff, hdr).to_filename(fname)
-
-        imgs = [nb.load(im) for im in nii]
-        allim = nb.concat_images(imgs)
-        allim.to_filename(out_file)
+        data = np.memmap(TemporaryFile(dir=op.dirname(out_file)),
+                         dtype=dtype, mode='w+', shape=newshape, order='F')
+
+    for cname, iname in zip(in_files, in_idxs):
+        f = np.load(iname)
+        idxs = f['arr_0'].reshape(-1)
+        cdata = _load_roi(cname)
+        nels = len(idxs)
+        idata = np.unravel_index(idxs, rsh[:3])
+        try:
+            data[idata] = cdata[0:nels, ...]
+        except:
+            print(('Consistency between indexes and chunks was '
+                   'lost: data=%s, chunk=%s') % (str(data.shape),
+                                                 str(cdata.shape)))
+            raise
 
+    hdr.set_data_shape(newshape)
+    nb.Nifti1Image(data, aff, hdr).to_filename(out_file)
     return out_file
 
 
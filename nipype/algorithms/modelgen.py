@@ -26,6 +26,7 @@ import os
 
 from nibabel import load
 import numpy as np
+from scipy.signal import fftconvolve
 from scipy.special import gammaln
 
 from ..external.six import string_types
@@ -647,47 +648,48 @@ class SpecifySparseModel(SpecifyModel):
         npts = int(np.ceil(total_time / dt))
         times = np.arange(0, total_time, dt) * 1e-3
         timeline = np.zeros((npts))
-        timeline2 = np.zeros((npts))
         if isdefined(self.inputs.model_hrf) and self.inputs.model_hrf:
             hrf = spm_hrf(dt * 1e-3)
         reg_scale = 1.0
         if self.inputs.scale_regressors:
-            boxcar = np.zeros((50.0 * 1e3 / dt))
+            boxcar = np.zeros(int(50.0 * 1e3 / dt))
             if self.inputs.stimuli_as_impulses:
-                boxcar[1.0 * 1e3 / dt] = 1.0
+                boxcar[int(1.0 * 1e3 / dt)] = 1.0
                 reg_scale = float(TA / dt)
             else:
-                boxcar[(1.0 * 1e3 / dt):(2.0 * 1e3 / dt)] = 1.0
+                boxcar[int(1.0 * 1e3 / dt):int(2.0 * 1e3 / dt)] = 1.0
             if isdefined(self.inputs.model_hrf) and self.inputs.model_hrf:
-                response = np.convolve(boxcar, hrf)
+                response = fftconvolve(boxcar, hrf)
                 reg_scale = 1.0 / response.max()
                 iflogger.info('response sum: %.4f max: %.4f' % (response.sum(),
                                                                 response.max()))
             iflogger.info('reg_scale: %.4f' % reg_scale)
-        for i, t in enumerate(onsets):
-            idx = int(np.round(t / dt))
-            if i_amplitudes:
-                if len(i_amplitudes) > 1:
-                    timeline2[idx] = i_amplitudes[i]
-                else:
-                    timeline2[idx] = i_amplitudes[0]
+        # all the stimuli are added to the timeline at once, as impulses or
+        # as boxcars built from the cumulative sum of their edges
+        idx = np.round(onsets / dt).astype(int)
+        if i_amplitudes:
+            if len(i_amplitudes) > 1:
+                amplitudes = np.array(i_amplitudes, dtype=float)
             else:
-                timeline2[idx] = 1
-            if bplot:
-                plt.subplot(4, 1, 1)
-                plt.plot(times, timeline2)
-            if not self.inputs.stimuli_as_impulses:
-                if durations[i] == 0:
-                    durations[i] = TA * nvol
-                stimdur = np.ones((int(durations[i] / dt)))
-                timeline2 = np.convolve(timeline2, stimdur)[0:len(timeline2)]
-            timeline += timeline2
-            timeline2[:] = 0
+                amplitudes = i_amplitudes[0] * np.ones(len(onsets))
+        else:
+            amplitudes = np.ones(len(onsets))
+        if self.inputs.stimuli_as_impulses:
+            np.add.at(timeline, idx, amplitudes)
+        else:
+            durations[durations == 0] = TA * nvol
+            ends = np.minimum(idx + (durations / dt).astype(int), npts)
+            edges = np.zeros(npts + 1)
+            np.add.at(edges, idx, amplitudes)
+            np.add.at(edges, ends, -amplitudes)
+            timeline = np.cumsum(edges[:npts])
         if bplot:
+            plt.subplot(4, 1, 1)
+            plt.plot(times, timeline)
             plt.subplot(4, 1, 2)
             plt.plot(times, timeline)
         if isdefined(self.inputs.model_hrf) and self.inputs.model_hrf:
-            timeline = np.convolve(timeline, hrf)[0:len(timeline)]
+            timeline = fftconvolve(timeline, hrf)[0:len(timeline)]
             if isdefined(self.inputs.use_temporal_deriv) and \
                     self.inputs.use_temporal_deriv:
                 # create temporal deriv
@@ -699,22 +701,21 @@ class SpecifySparseModel(SpecifyModel):
                     self.inputs.use_temporal_deriv:
                 plt.plot(times, timederiv)
         # sample timeline
-        timeline2 = np.zeros((npts))
-        reg = []
+        trials = np.arange(nscans) // nvol
+        scanstarts = ((SCANONSET + trials * TR +
+                       (np.arange(nscans) % nvol) * TA) / dt).astype(int)
+        scanidx = scanstarts[:, None] + np.arange(int(TA / dt))
+        reg = (np.mean(timeline[scanidx], axis=1) * reg_scale).tolist()
         regderiv = []
-        for i, trial in enumerate(np.arange(nscans) / nvol):
-            scanstart = int((SCANONSET + trial * TR + (i % nvol) * TA) / dt)
-            scanidx = scanstart + np.arange(int(TA / dt))
-            timeline2[scanidx] = np.max(timeline)
-            reg.insert(i, np.mean(timeline[scanidx]) * reg_scale)
-            if isdefined(self.inputs.use_temporal_deriv) and \
-                    self.inputs.use_temporal_deriv:
-                regderiv.insert(i, np.mean(timederiv[scanidx]) * reg_scale)
         if isdefined(self.inputs.use_temporal_deriv) and \
                 self.inputs.use_temporal_deriv:
+            regderiv = (np.mean(timederiv[scanidx], axis=1) *
+                        reg_scale).tolist()
             iflogger.info('orthoganlizing derivative w.r.t. main regressor')
             regderiv = orth(reg, regderiv)
         if bplot:
+            timeline2 = np.zeros((npts))
+            timeline2[scanidx] = np.max(timeline)
             plt.subplot(4, 1, 3)
             plt.plot(times, timeline2)
             plt.subplot(4, 1, 4)
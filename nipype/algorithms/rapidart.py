@@ -23,8 +23,9 @@ from builtins import range
 
 import os
 from copy import deepcopy
+from tempfile import TemporaryFile
 
-from nibabel import load, funcs, Nifti1Image
+from nibabel import load, Nifti1Image
 import numpy as np
 from scipy import signal
 import scipy.io as sio
@@ -46,41 +47,65 @@ def _get_affine_matrix(params, source):
     source : the package that generated the parameters
              supports SPM, AFNI, FSFAST, FSL, NIPY
     """
+    return _get_affine_matrices(np.atleast_2d(params), source)[0]
+
+
+def _get_affine_matrices(params, source):
+    """Return the affine matrices of a series of parameter sets
+
+    params : np.array [n_timepoints x (upto 12)] in native package format
+    source : the package that generated the parameters
+             supports SPM, AFNI, FSFAST, FSL, NIPY
+
+    Returns an [n_timepoints x 4 x 4] array
+    """
+    params = np.array(params, dtype=float)
     if source == 'FSL':
-        params = params[[3, 4, 5, 0, 1, 2]]
+        params = params[:, [3, 4, 5, 0, 1, 2]]
     elif source in ('AFNI', 'FSFAST'):
-        params = params[np.asarray([4, 5, 3, 1, 2, 0]) + (len(params) > 6)]
-        params[3:] = params[3:] * np.pi / 180.
+        params = params[:, np.asarray([4, 5, 3, 1, 2, 0]) +
+                        (params.shape[1] > 6)]
+        params[:, 3:] = params[:, 3:] * np.pi / 180.
     if source == 'NIPY':
         # nipy does not store typical euler angles, use nipy to convert
         from nipy.algorithms.registration import to_matrix44
-        return to_matrix44(params)
+        return np.array([to_matrix44(p) for p in params])
     # process for FSL, SPM, AFNI and FSFAST
-    rotfunc = lambda x: np.array([[np.cos(x), np.sin(x)],
-                                  [-np.sin(x), np.cos(x)]])
+    n_params = params.shape[1]
     q = np.array([0, 0, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0])
-    if len(params) < 12:
-        params = np.hstack((params, q[len(params):]))
-    params.shape = (len(params),)
+    if n_params < 12:
+        params = np.hstack((params, np.tile(q[n_params:],
+                                            (params.shape[0], 1))))
+    eye = np.tile(np.eye(4), (params.shape[0], 1, 1))
+    cos = np.cos(params[:, 3:6])
+    sin = np.sin(params[:, 3:6])
     # Translation
-    T = np.eye(4)
-    T[0:3, -1] = params[0:3]
+    T = eye.copy()
+    T[:, 0:3, -1] = params[:, 0:3]
     # Rotation
-    Rx = np.eye(4)
-    Rx[1:3, 1:3] = rotfunc(params[3])
-    Ry = np.eye(4)
-    Ry[(0, 0, 2, 2), (0, 2, 0, 2)] = rotfunc(params[4]).ravel()
-    Rz = np.eye(4)
-    Rz[0:2, 0:2] = rotfunc(params[5])
+    Rx = eye.copy()
+    Rx[:, 1, 1], Rx[:, 1, 2] = cos[:, 0], sin[:, 0]
+    Rx[:, 2, 1], Rx[:, 2, 2] = -sin[:, 0], cos[:, 0]
+    Ry = eye.copy()
+    Ry[:, 0, 0], Ry[:, 0, 2] = cos[:, 1], sin[:, 1]
+    Ry[:, 2, 0], Ry[:, 2, 2] = -sin[:, 1], cos[:, 1]
+    Rz = eye.copy()
+    Rz[:, 0, 0], Rz[:, 0, 1] = cos[:, 2], sin[:, 2]
+    Rz[:, 1, 0], Rz[:, 1, 1] = -sin[:, 2], cos[:, 2]
     # Scaling
-    S = np.eye(4)
-    S[0:3, 0:3] = np.diag(params[6:9])
+    S = eye.copy()
+    S[:, [0, 1, 2], [0, 1, 2]] = params[:, 6:9]
     # Shear
-    Sh = np.eye(4)
-    Sh[(0, 0, 1), (1, 2, 2)] = params[9:12]
+    Sh = eye
+    Sh[:, [0, 0, 1], [1, 2, 2]] = params[:, 9:12]
     if source in ('AFNI', 'FSFAST'):
-        return np.dot(T, np.dot(Ry, np.dot(Rx, np.dot(Rz, np.dot(S, Sh)))))
-    return np.dot(T, np.dot(Rx, np.dot(Ry, np.dot(Rz, np.dot(S, Sh)))))
+        order = (T, Ry, Rx, Rz, S, Sh)
+    else:
+        order = (T, Rx, Ry, Rz, S, Sh)
+    affines = order[-1]
+    for matrix in order[-2::-1]:
+        affines = np.einsum('tij,tjk->tik', matrix, affines)
+    return affines
 
 
 def _calc_norm(mc, use_differences, source, brain_pts=None):
@@ -109,36 +134,64 @@ def _calc_norm(mc, use_differences, source, brain_pts=None):
         displacement = None
     else:
         all_pts = brain_pts
-    n_pts = all_pts.size - all_pts.shape[1]
-    newpos = np.zeros((mc.shape[0], n_pts))
+    n_pts = all_pts.shape[1]
+    n_timepoints = mc.shape[0]
+    # [3 * n_timepoints x 4] stack of the rows of the affines that are used
+    affines = _get_affine_matrices(mc, source)[:, 0:3, :].reshape(-1, 4)
     if brain_pts is not None:
-        displacement = np.zeros((mc.shape[0], int(n_pts / 3)))
-    for i in range(mc.shape[0]):
-        affine = _get_affine_matrix(mc[i, :], source)
-        newpos[i, :] = np.dot(affine,
-                              all_pts)[0:3, :].ravel()
+        displacement = np.zeros((n_timepoints, n_pts))
+    normdata = np.zeros(n_timepoints)
+    # the points are moved in chunks of about 2**22 coordinates at a time
+    chunk_size = max(1, 2 ** 22 // (3 * n_timepoints))
+    for start in range(0, n_pts, chunk_size):
+        pts = all_pts[:, start:start + chunk_size]
+        # [n_timepoints x 3 x n_chunk] positions of the points
+        newpos = np.dot(affines, pts).reshape(n_timepoints, 3, -1)
         if brain_pts is not None:
-            displacement[i, :] = \
-                np.sqrt(np.sum(np.power(np.reshape(newpos[i, :],
-                                                   (3, all_pts.shape[1])) -
-                                        all_pts[0:3, :],
-                                        2),
-                               axis=0))
-    # np.savez('displacement.npz', newpos=newpos, pts=all_pts)
-    normdata = np.zeros(mc.shape[0])
-    if use_differences:
-        newpos = np.concatenate((np.zeros((1, n_pts)),
-                                 np.diff(newpos, n=1, axis=0)), axis=0)
-        for i in range(newpos.shape[0]):
-            normdata[i] = \
-                np.max(np.sqrt(np.sum(np.reshape(np.power(np.abs(newpos[i, :]), 2),
-                                                 (3, all_pts.shape[1])), axis=0)))
-    else:
-        newpos = np.abs(signal.detrend(newpos, axis=0, type='constant'))
-        normdata = np.sqrt(np.mean(np.power(newpos, 2), axis=1))
+            displacement[:, start:start + chunk_size] = \
+                np.sqrt(np.sum((newpos - pts[None, 0:3, :]) ** 2, axis=1))
+        if use_differences:
+            newpos = np.diff(newpos, n=1, axis=0)
+            normdata[1:] = np.maximum(
+                normdata[1:], np.max(np.sqrt(np.sum(newpos ** 2, axis=1)),
+                                     axis=1))
+        else:
+            newpos -= np.mean(newpos, axis=0)
+            normdata += np.sum(newpos ** 2, axis=(1, 2))
+    if not use_differences:
+        normdata = np.sqrt(normdata / (3 * n_pts))
     return normdata, displacement
 
 
+def _n_volumes(img):
+    """Return the number of volumes of a 3D or 4D image"""
+    return int(np.prod(img.shape[3:]))
+
+
+def _iter_volumes(imgfiles):
+    """Yield the volumes of a list of 3D or 4D images, one at a time
+
+    The data of uncompressed images are memory-mapped, so that only the
+    current volume needs to be read in memory.
+    """
+    for fname in imgfiles:
+        data = load(fname).get_data()
+        if data.ndim == 3:
+            yield data
+        else:
+            data = data.reshape(data.shape[:3] + (-1,), order='F')
+            for t0 in range(data.shape[3]):
+                yield data[:, :, :, t0]
+
+
+def _volume_buffer(shape, dtype, dirname):
+    """Return a zero-filled 4D array, backed by a temporary file in dirname,
+    in which the volumes of an output image can be collected
+    """
+    return np.memmap(TemporaryFile(dir=dirname), dtype=dtype, mode='w+',
+                     shape=shape, order='F')
+
+
 def _nanmean(a, axis=None):
     """Return the mean excluding items that are nan
 
@@ -215,6 +268,12 @@ class ArtifactDetectInputSpec(BaseInterfaceInputSpec):
     global_threshold = traits.Float(8.0, desc=("use this threshold when mask "
                                                "type equal's spm_global"),
                                     usedefault=True)
+    sparse_displacement = traits.Bool(False, usedefault=True,
+                                      desc=("save the displacement of the "
+                                            "brain voxels (timepoints x "
+                                            "voxels) with their voxel "
+                                            "indices in a .npz file instead "
+                                            "of a 4D image"))
 
 
 class ArtifactDetectOutputSpec(TraitedSpec):
@@ -250,6 +309,12 @@ class ArtifactDetect(BaseInterface):
     True, it computes the movement of the center of each face a cuboid centered
     around the head and returns the maximal movement across the centers.
 
+    The functional volumes are read one at a time, and the 4D mask and
+    displacement images are collected in temporary files in the working
+    directory, so that long runs can be processed within bounded memory.
+    If `sparse_displacement` is True, the displacement of the brain voxels is
+    saved in a .npz file instead of a 4D image.
+
 
     Examples
     --------
@@ -298,8 +363,12 @@ class ArtifactDetect(BaseInterface):
                                                      '.txt')))
         plotfile = os.path.join(output_dir, ''.join(('plot.', filename, '.',
                                                      self.inputs.plot_type)))
+        dispext = ext
+        if self.inputs.sparse_displacement:
+            dispext = '.npz'
         displacementfile = os.path.join(output_dir, ''.join(('disp.',
-                                                             filename, ext)))
+                                                             filename,
+                                                             dispext)))
         maskfile = os.path.join(output_dir, ''.join(('mask.', filename, ext)))
         return (artifactfile, intensityfile, statsfile, normfile, plotfile,
                 displacementfile, maskfile)
@@ -351,20 +420,12 @@ class ArtifactDetect(BaseInterface):
         if not cwd:
             cwd = os.getcwd()
 
-        # read in functional image
-        if isinstance(imgfile, string_types):
-            nim = load(imgfile)
-        elif isinstance(imgfile, list):
-            if len(imgfile) == 1:
-                nim = load(imgfile[0])
-            else:
-                images = [load(f) for f in imgfile]
-                nim = funcs.concat_images(images)
-
-        # compute global intensity signal
-        (x, y, z, timepoints) = nim.shape
+        # the volumes of the functional images are read one at a time
+        imgfiles = filename_to_list(imgfile)
+        nim = load(imgfiles[0])
+        (x, y, z) = nim.shape[:3]
+        timepoints = sum([_n_volumes(load(f)) for f in imgfiles])
 
-        data = nim.get_data()
         affine = nim.affine
         g = np.zeros((timepoints, 1))
         masktype = self.inputs.mask_type
@@ -373,23 +434,20 @@ class ArtifactDetect(BaseInterface):
             intersect_mask = self.inputs.intersect_mask
             if intersect_mask:
                 mask = np.ones((x, y, z), dtype=bool)
-                for t0 in range(timepoints):
-                    vol = data[:, :, :, t0]
+                for vol in _iter_volumes(imgfiles):
                     # Use an SPM like approach
                     mask_tmp = vol > \
                         (_nanmean(vol) / self.inputs.global_threshold)
                     mask = mask * mask_tmp
-                for t0 in range(timepoints):
-                    vol = data[:, :, :, t0]
+                for t0, vol in enumerate(_iter_volumes(imgfiles)):
                     g[t0] = _nanmean(vol[mask])
                 if len(find_indices(mask)) < (np.prod((x, y, z)) / 10):
                     intersect_mask = False
                     g = np.zeros((timepoints, 1))
             if not intersect_mask:
                 iflogger.info('not intersect_mask is True')
-                mask = np.zeros((x, y, z, timepoints))
-                for t0 in range(timepoints):
-                    vol = data[:, :, :, t0]
+                mask = _volume_buffer((x, y, z, timepoints), np.uint8, cwd)
+                for t0, vol in enumerate(_iter_volumes(imgfiles)):
                     mask_tmp = vol > \
                         (_nanmean(vol) / self.inputs.global_threshold)
                     mask[:, :, :, t0] = mask_tmp
@@ -399,17 +457,16 @@ class ArtifactDetect(BaseInterface):
             mask = maskimg.get_data()
             affine = maskimg.affine
             mask = mask > 0.5
-            for t0 in range(timepoints):
-                vol = data[:, :, :, t0]
+            for t0, vol in enumerate(_iter_volumes(imgfiles)):
                 g[t0] = _nanmean(vol[mask])
         elif masktype == 'thresh':  # uses a fixed signal threshold
-            for t0 in range(timepoints):
-                vol = data[:, :, :, t0]
+            for t0, vol in enumerate(_iter_volumes(imgfiles)):
                 mask = vol > self.inputs.mask_threshold
                 g[t0] = _nanmean(vol[mask])
         else:
             mask = np.ones((x, y, z))
-            g = _nanmean(data[mask > 0, :], 1)
+            for t0, vol in enumerate(_iter_volumes(imgfiles)):
+                g[t0] = _nanmean(vol[mask > 0])
 
         # compute normalized intensity values
         gz = signal.detrend(g, axis=0)  # detrend the signal
@@ -425,7 +482,9 @@ class ArtifactDetect(BaseInterface):
 
         (artifactfile, intensityfile, statsfile, normfile, plotfile,
          displacementfile, maskfile) = self._get_output_filenames(imgfile, cwd)
-        mask_img = Nifti1Image(mask.astype(np.uint8), affine)
+        if mask.dtype != np.uint8:
+            mask = mask.astype(np.uint8)
+        mask_img = Nifti1Image(mask, affine)
         mask_img.to_filename(maskfile)
 
         if self.inputs.use_norm:
@@ -445,14 +504,20 @@ class ArtifactDetect(BaseInterface):
                                                brain_pts=brain_pts)
             tidx = find_indices(normval > self.inputs.norm_threshold)
             ridx = find_indices(normval < 0)
-            if displacement is not None:
-                dmap = np.zeros((x, y, z, timepoints), dtype=np.float)
+            if displacement is not None and \
+                    self.inputs.sparse_displacement:
+                np.savez(displacementfile, displacement=displacement,
+                         voxels=np.array(voxel_coords[:3]).T,
+                         shape=(x, y, z, timepoints), affine=affine)
+            elif displacement is not None:
+                dmap = _volume_buffer((x, y, z, timepoints), np.float64, cwd)
                 for i in range(timepoints):
                     dmap[voxel_coords[0],
                          voxel_coords[1],
                          voxel_coords[2], i] = displacement[i, :]
                 dimg = Nifti1Image(dmap, affine)
                 dimg.to_filename(displacementfile)
+                del dimg, dmap
         else:
             if self.inputs.use_differences[0]:
                 mc = np.concatenate((np.zeros((1, 6)),
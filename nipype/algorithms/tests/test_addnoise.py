@@ -0,0 +1,52 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+import nibabel as nb
+
+from nipype.testing import assert_equal, assert_true
+from nipype.algorithms.misc import AddNoise
+
+
+def test_add_noise():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    rng = np.random.RandomState(0)
+    data = (100 + rng.rand(20, 16, 12, 3)).astype(np.float32)
+    mask = np.zeros(data.shape[:3], dtype=np.uint8)
+    mask[4:16, 4:12, 2:10] = 1
+    nb.Nifti1Image(data, np.eye(4)).to_filename('image.nii')
+    nb.Nifti1Image(mask, np.eye(4)).to_filename('mask.nii.gz')
+
+    snr = 20.0
+    signal = data[mask > 0]
+    sigma_n = np.sqrt((signal - signal.mean()).var() /
+                      np.sqrt(10.0 ** (snr / 10.0)))
+
+    results = []
+    for slab_values in [2 ** 24, 20 * 16 * 3]:
+        interface = AddNoise(in_file='image.nii', in_mask='mask.nii.gz',
+                             snr=snr, bg_dist='rayleigh', seed=3,
+                             out_file='noisy_%d.nii' % slab_values)
+        # the noise does not depend on the size of the slabs
+        interface._slab_values = slab_values
+        res = interface.run()
+        results.append(nb.load(res.outputs.out_file).get_data())
+    yield assert_equal, np.array_equal(results[0], results[1]), True
+
+    noise = results[0] - data
+    yield assert_true, abs(noise[mask > 0].std() / sigma_n - 1) < 0.05
+    # rayleigh noise is positive
+    yield assert_true, np.all(noise[mask == 0] > 0)
+
+    res = AddNoise(in_file='image.nii', in_mask='mask.nii.gz', snr=snr,
+                   seed=4, out_file='other.nii').run()
+    yield (assert_equal, np.array_equal(
+        nb.load(res.outputs.out_file).get_data(), results[0]), False)
+
+    os.chdir(cwd)
+    rmtree(tempdir)
@@ -14,6 +14,7 @@ def test_AddNoise_inputs():
     ),
     in_mask=dict(),
     out_file=dict(),
+    seed=dict(),
     snr=dict(usedefault=True,
     ),
     )
@@ -32,6 +32,8 @@ def test_ArtifactDetect_inputs():
     ),
     save_plot=dict(usedefault=True,
     ),
+    sparse_displacement=dict(usedefault=True,
+    ),
     translation_threshold=dict(mandatory=True,
     xor=['norm_threshold'],
     ),
@@ -14,6 +14,8 @@ def test_MergeCSVFiles_inputs():
     row_heading_title=dict(usedefault=True,
     ),
     row_headings=dict(),
+    save_npy=dict(usedefault=True,
+    ),
     )
     inputs = MergeCSVFiles.input_spec()
 
@@ -24,6 +26,7 @@ def test_MergeCSVFiles_inputs():
 
 def test_MergeCSVFiles_outputs():
     output_map = dict(csv_file=dict(),
+    npy_file=dict(),
     )
     outputs = MergeCSVFiles.output_spec()
 
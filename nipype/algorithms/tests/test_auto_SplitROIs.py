@@ -7,7 +7,12 @@ def test_SplitROIs_inputs():
     input_map = dict(in_file=dict(mandatory=True,
     ),
     in_mask=dict(),
-    roi_size=dict(),
+    n_rois=dict(xor=['roi_size'],
+    ),
+    out_format=dict(usedefault=True,
+    ),
+    roi_size=dict(xor=['n_rois'],
+    ),
     )
     inputs = SplitROIs.input_spec()
 
@@ -7,6 +7,8 @@ def test_TSNR_inputs():
     input_map = dict(detrended_file=dict(hash_files=False,
     usedefault=True,
     ),
+    float64=dict(usedefault=True,
+    ),
     ignore_exception=dict(nohash=True,
     usedefault=True,
     ),
@@ -0,0 +1,72 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+
+from nipype.testing import assert_equal
+from nipype.algorithms.misc import MergeCSVFiles, AddCSVRow, merge_csvs
+
+
+def test_merge_csvs():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    values = np.arange(12.).reshape((4, 3)) / 4.
+    with open('plain.csv', 'w') as fhandle:
+        fhandle.write('\n'.join(['0.0', '1.0', '2.0', '3.0']) + '\n')
+    # a heading line and a column of labels
+    with open('labels.csv', 'w') as fhandle:
+        fhandle.write('"roi","value"\n')
+        for i in range(4):
+            fhandle.write('"roi%d",%f\n' % (i, values[i, 1]))
+    yield (assert_equal, merge_csvs(['plain.csv', 'labels.csv']).tolist(),
+           np.column_stack((np.arange(4.), values[:, 1])).tolist())
+
+    merge = MergeCSVFiles(in_files=['plain.csv', 'labels.csv'],
+                          column_headings=['a', 'b'],
+                          row_headings=['r0', 'r1', 'r2', 'r3'],
+                          extra_field='S01', save_npy=True)
+    res = merge.run()
+    with open(res.outputs.csv_file) as fhandle:
+        lines = fhandle.read().splitlines()
+    yield assert_equal, lines[0], '"label","a","b","type"'
+    yield assert_equal, lines[2], '"r1",1.000000,1.000000,S01'
+    yield assert_equal, len(lines), 5
+    table = np.load(res.outputs.npy_file)
+    yield assert_equal, table.dtype.names, ('label', 'a', 'b', 'type')
+    yield assert_equal, table['b'].tolist(), values[:, 1].tolist()
+    yield assert_equal, table['label'][3], 'r3'
+    # the column headings are not modified
+    yield assert_equal, merge.inputs.column_headings, ['a', 'b']
+
+    os.chdir(cwd)
+    rmtree(tempdir)
+
+
+def test_add_csv_row():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    in_file = os.path.abspath('scores.csv')
+    for subject_id, si in [('S01', 0.5), ('S02', 0.25)]:
+        addrow = AddCSVRow(infields=['subject_id', 'si'], in_file=in_file)
+        addrow.inputs.subject_id = subject_id
+        addrow.inputs.si = si
+        addrow.run()
+    # a new column rewrites the file
+    addrow = AddCSVRow(in_file=in_file)
+    addrow.inputs.subject_id = 'S03, retest'
+    addrow.inputs.values = [1, 2]
+    addrow.run()
+
+    with open(in_file) as fhandle:
+        lines = fhandle.read().splitlines()
+    yield assert_equal, lines, [',si,subject_id,values_0,values_1',
+                                '0,0.5,S01,,', '1,0.25,S02,,',
+                                '2,,"S03, retest",1,2']
+
+    os.chdir(cwd)
+    rmtree(tempdir)
@@ -1,7 +1,13 @@
 from __future__ import division
+from builtins import range
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
 import numpy as np
-from nipype.testing import assert_equal
-from nipype.algorithms.icc import ICC_rep_anova
+import nibabel as nb
+from nipype.testing import assert_equal, assert_true, assert_almost_equal
+from nipype.algorithms.icc import ICC, ICC_rep_anova, ICC_rep_anova_batch
 
 
 def test_ICC_rep_anova():
@@ -20,3 +26,52 @@ def test_ICC_rep_anova():
     yield assert_equal, dfc, 3
     yield assert_equal, dfe, 15
     yield assert_equal, r_var / (r_var + e_var), icc
+
+
+def test_ICC_rep_anova_batch():
+    rng = np.random.RandomState(0)
+    Y = rng.randn(50, 10, 3) + rng.randn(50, 10, 1)
+
+    batch = ICC_rep_anova_batch(Y)
+    for i in range(Y.shape[0]):
+        reference = ICC_rep_anova(Y[i])
+        for value, expected in zip(batch[:4], reference[:4]):
+            yield assert_almost_equal, value[i], expected
+    yield assert_equal, batch[4:], reference[4:]
+
+
+def test_ICC():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    rng = np.random.RandomState(0)
+    shape = (6, 5, 4)
+    subject_effect = rng.randn(8, *shape)
+    data = subject_effect[:, None] + 0.5 * rng.randn(8, 2, *shape)
+    subjects_sessions = []
+    for i in range(data.shape[0]):
+        sessions = []
+        for j in range(data.shape[1]):
+            fname = os.path.join(tempdir, 'sub%d_ses%d.nii' % (i, j))
+            nb.Nifti1Image(data[i, j], np.eye(4)).to_filename(fname)
+            sessions.append(fname)
+        subjects_sessions.append(sessions)
+    mask = np.zeros(shape)
+    mask[1:5, 1:4, :] = 1
+    nb.Nifti1Image(mask, np.eye(4)).to_filename('mask.nii')
+
+    res = ICC(subjects_sessions=subjects_sessions, mask='mask.nii',
+              chunk_size=7).run()
+
+    expected = np.zeros((4,) + shape)
+    for idx in zip(*np.nonzero(mask)):
+        Y = data[(slice(None), slice(None)) + idx]
+        expected[(slice(None),) + idx] = ICC_rep_anova(Y)[:4]
+    for i, name in enumerate(['icc_map', 'subject_var_map',
+                              'session_var_map', 'sessions_F_map']):
+        outfile = getattr(res.outputs, name)
+        yield assert_true, os.path.exists(outfile)
+        yield assert_almost_equal, nb.load(outfile).get_data(), expected[i]
+
+    os.chdir(cwd)
+    rmtree(tempdir)
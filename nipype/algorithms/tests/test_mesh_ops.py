@@ -89,6 +89,36 @@ def test_warppoints():
     rmtree(tempdir)
 
 
+def test_vertex_areas():
+    # unit square split in two triangles, plus a degenerate face
+    points = np.array([[0., 0., 0.], [1., 0., 0.], [1., 1., 0.],
+                       [0., 1., 0.]])
+    faces = np.array([[0, 1, 2], [0, 2, 3], [1, 1, 3]])
+
+    yield assert_almost_equal, m.triangle_areas(points, faces), [0.5, 0.5, 0.]
+    yield assert_almost_equal, m.vertex_areas(points, faces), [1., .5, 1., .5]
+
+
+def test_warp_displacements():
+    import nibabel as nb
+
+    tempdir = mkdtemp()
+    affine = np.diag([2., 2., 2., 1.])
+    affine[:3, 3] = [-10., 4., 2.]
+    data = np.zeros((10, 10, 10, 3), dtype=np.float32)
+    data[..., 0] = 1.5
+    data[..., 2] = np.arange(10)[np.newaxis, np.newaxis, :]
+    warp = os.path.join(tempdir, 'warp.nii')
+    nb.Nifti1Image(data, affine).to_filename(warp)
+
+    points = np.array([[-6., 8., 6.], [0., 12., 10.]])
+    for order in (0, 1, 3):
+        disps = m.warp_displacements(points, warp, order=order)
+        yield assert_almost_equal, disps, [[1.5, 0., 2.], [1.5, 0., 4.]], 4
+
+    rmtree(tempdir)
+
+
 def test_meshwarpmaths():
     tempdir = mkdtemp()
     curdir = os.getcwd()
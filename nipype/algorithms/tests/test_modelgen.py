@@ -152,3 +152,25 @@ def test_modelgen_sparse():
     yield assert_almost_equal, res.outputs.session_info[0]['regress'][0]['val'][0], 0.016675298129743384
     yield assert_almost_equal, res.outputs.session_info[1]['regress'][1]['val'][5], 0.007671459162258378
     rmtree(tempdir)
+
+
+def test_sparse_regressor():
+    s = SpecifySparseModel(time_repetition=3, time_acquisition=1,
+                           volumes_in_cluster=2, stimuli_as_impulses=False)
+    # overlapping stimuli with different amplitudes and durations, in a
+    # clustered acquisition: 2 volumes of 1s each every 3s
+    onsets = [1, 1.5, 10, 30]
+    durations = [2, 1, 0, 3]
+    amplitudes = [1, 2, 3, 1]
+    reg = s._gen_regress(onsets, durations, amplitudes, 30)
+    dt = 100.
+    timeline = np.zeros(460)
+    for onset, duration, amplitude in zip(onsets, durations, amplitudes):
+        start = int(onset * 1e3 / dt)
+        # a stimulus without duration lasts for the whole cluster
+        timeline[start:start + int((duration or 2) * 1e3 / dt)] += amplitude
+    expected = []
+    for i in range(30):
+        start = int((i // 2 * 3000 + i % 2 * 1000) / dt)
+        expected.append(timeline[start:start + 10].mean())
+    yield assert_almost_equal, reg, expected
@@ -2,12 +2,15 @@
 # -*- coding: utf-8 -*-
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
+from __future__ import division
+from builtins import range
 
 import os
 from shutil import rmtree
 from tempfile import mkdtemp
 
-from nipype.testing import (example_data)
+from nipype.testing import (example_data, assert_equal,
+                            assert_almost_equal)
 
 import numpy as np
 
@@ -49,3 +52,55 @@ def test_overlap():
 
     os.chdir(cwd)
     rmtree(tempdir)
+
+
+def test_label_overlap():
+    from nipype.algorithms.metrics import LabelOverlap
+    import nibabel as nb
+
+    rng = np.random.RandomState(0)
+    ref = rng.randint(0, 50, (20, 18, 16))
+    tests = []
+    for i in range(3):
+        tst = ref.copy()
+        changed = rng.rand(*ref.shape) < 0.1 * (i + 1)
+        tst[changed] = rng.randint(0, 55, changed.sum())
+        tests.append(tst)
+
+    overlap = LabelOverlap(ref)
+    for tst in tests:
+        labels, jaccard, volumes1, volumes2, diff = overlap.compare(tst)
+        yield assert_equal, labels.tolist(), list(range(1, 50))
+        expected = [np.sum((ref == l) & (tst == l)) /
+                    np.sum((ref == l) | (tst == l)) for l in labels]
+        yield assert_almost_equal, jaccard, expected
+        yield assert_equal, volumes1, [np.sum(ref == l) for l in labels]
+        yield assert_equal, volumes2, [np.sum(tst == l) for l in labels]
+        yield assert_equal, diff, ref != tst
+
+
+def test_distance():
+    from nipype.algorithms.metrics import Distance
+    from scipy.spatial.distance import cdist
+    import nibabel as nb
+
+    affine = np.diag([2., 2., 2.5, 1.])
+    data1 = np.zeros((30, 30, 30))
+    data1[5:15, 6:18, 4:20] = 1
+    data2 = np.zeros((30, 30, 30))
+    data2[20:27, 18:27, 21:27] = 1
+    nii1 = nb.Nifti1Image(data1, affine)
+    nii2 = nb.Nifti1Image(data2, affine)
+
+    distance = Distance()
+    border1 = distance._get_coordinates(
+        distance._find_border(data1.astype(bool)), affine)
+    border2 = distance._get_coordinates(
+        distance._find_border(data2.astype(bool)), affine)
+    dist_matrix = cdist(border1.T, border2.T)
+
+    dist, point1, point2 = distance._eucl_min(nii1, nii2)
+    yield assert_almost_equal, dist, dist_matrix.min()
+    yield assert_almost_equal, np.linalg.norm(point1 - point2), dist
+    yield (assert_almost_equal, distance._eucl_max(nii1, nii2),
+           max(dist_matrix.min(0).max(), dist_matrix.min(1).max()))
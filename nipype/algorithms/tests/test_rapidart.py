@@ -1,8 +1,13 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 from __future__ import division
+from builtins import range
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
 
 import numpy as np
+import nibabel as nb
 
 from ...testing import (assert_equal, assert_false, assert_true,
                         assert_almost_equal)
@@ -67,6 +72,138 @@ def test_ad_get_norm():
     yield assert_almost_equal, norm, np.array([0., 143.72192614, 173.92527131])
 
 
+def _reference_affine_matrix(params, source):
+    """Affine matrix of a single set of parameters, composed matrix by
+    matrix"""
+    params = np.array(params, dtype=float)
+    if source == 'FSL':
+        params = params[[3, 4, 5, 0, 1, 2]]
+    elif source in ('AFNI', 'FSFAST'):
+        params = params[np.asarray([4, 5, 3, 1, 2, 0]) + (len(params) > 6)]
+        params[3:] = params[3:] * np.pi / 180.
+    rotfunc = lambda x: np.array([[np.cos(x), np.sin(x)],
+                                  [-np.sin(x), np.cos(x)]])
+    q = np.array([0, 0, 0, 0, 0, 0, 1, 1, 1, 0, 0, 0])
+    if len(params) < 12:
+        params = np.hstack((params, q[len(params):]))
+    T = np.eye(4)
+    T[0:3, -1] = params[0:3]
+    Rx = np.eye(4)
+    Rx[1:3, 1:3] = rotfunc(params[3])
+    Ry = np.eye(4)
+    Ry[(0, 0, 2, 2), (0, 2, 0, 2)] = rotfunc(params[4]).ravel()
+    Rz = np.eye(4)
+    Rz[0:2, 0:2] = rotfunc(params[5])
+    S = np.eye(4)
+    S[0:3, 0:3] = np.diag(params[6:9])
+    Sh = np.eye(4)
+    Sh[(0, 0, 1), (1, 2, 2)] = params[9:12]
+    if source in ('AFNI', 'FSFAST'):
+        return np.dot(T, np.dot(Ry, np.dot(Rx, np.dot(Rz, np.dot(S, Sh)))))
+    return np.dot(T, np.dot(Rx, np.dot(Ry, np.dot(Rz, np.dot(S, Sh)))))
+
+
+def test_ad_get_affine_matrices():
+    rng = np.random.RandomState(0)
+    for source, ncols in [('SPM', 6), ('SPM', 12), ('FSL', 6), ('AFNI', 6),
+                          ('AFNI', 7), ('FSFAST', 7)]:
+        params = rng.randn(5, ncols)
+        matrices = ra._get_affine_matrices(params, source)
+        yield assert_equal, matrices.shape, (5, 4, 4)
+        for i in range(params.shape[0]):
+            yield (assert_almost_equal, matrices[i],
+                   _reference_affine_matrix(params[i], source))
+    # AFNI rotations are in degrees, about z, x and y
+    matrix = ra._get_affine_matrices([[90, 0, 0, 1, 2, 3]], 'AFNI')[0]
+    out = np.array([0, 1, 0, 2, -1, 0, 0, 3, 0, 0, 1, 1, 0, 0, 0, 1])
+    yield assert_almost_equal, matrix, out.reshape((4, 4))
+
+
+def test_ad_calc_norm_brain_pts():
+    rng = np.random.RandomState(0)
+    params = 0.01 * rng.randn(10, 6)
+    brain_pts = np.vstack((50 * rng.randn(3, 100), np.ones((1, 100))))
+    newpos = np.array([np.dot(ra._get_affine_matrix(p, 'SPM'),
+                              brain_pts)[0:3] for p in params])
+    norm, displacement = ra._calc_norm(params, True, 'SPM',
+                                       brain_pts=brain_pts)
+    yield (assert_almost_equal, displacement,
+           np.sqrt(np.sum((newpos - brain_pts[0:3]) ** 2, axis=1)))
+    yield (assert_almost_equal, norm[1:],
+           np.max(np.sqrt(np.sum(np.diff(newpos, axis=0) ** 2, axis=1)),
+                  axis=1))
+    yield assert_equal, norm[0], 0
+    norm, _ = ra._calc_norm(params, False, 'SPM', brain_pts=brain_pts)
+    yield (assert_almost_equal, norm,
+           np.sqrt(np.mean((newpos - newpos.mean(0)) ** 2, axis=(1, 2))))
+
+
+def _synthetic_run(tempdir):
+    rng = np.random.RandomState(0)
+    shape = (12, 10, 8)
+    timepoints = 40
+    brain = np.zeros(shape)
+    brain[2:10, 2:8, 1:7] = 1000
+    data = brain[..., None] + 20 * rng.randn(*(shape + (timepoints,)))
+    data[..., 7] += 300
+    data[..., 25] -= 250
+    affine = np.diag([3., 3., 4., 1.])
+    funcfile = os.path.join(tempdir, 'func.nii')
+    nb.Nifti1Image(data, affine).to_filename(funcfile)
+    volfiles = []
+    for t in range(timepoints):
+        volfiles.append(os.path.join(tempdir, 'vol%02d.nii' % t))
+        nb.Nifti1Image(data[..., t], affine).to_filename(volfiles[-1])
+    maskfile = os.path.join(tempdir, 'brain.nii')
+    nb.Nifti1Image((brain > 0).astype(np.uint8), affine).to_filename(maskfile)
+    # FSL parameters: 3 rotations (radians) and 3 translations (mm)
+    mc = 0.05 * rng.randn(timepoints, 6)
+    mc[:, :3] *= 0.01
+    mc[15, 3] += 2
+    motionfile = os.path.join(tempdir, 'func.par')
+    np.savetxt(motionfile, mc)
+    return funcfile, volfiles, maskfile, motionfile
+
+
+def test_ad_detect_outliers():
+    tempdir = mkdtemp()
+    funcfile, volfiles, maskfile, motionfile = _synthetic_run(tempdir)
+    ad = ra.ArtifactDetect(realigned_files=funcfile,
+                           realignment_parameters=motionfile,
+                           parameter_source='FSL', norm_threshold=1,
+                           zintensity_threshold=3, mask_type='file',
+                           mask_file=maskfile, bound_by_brainmask=True,
+                           save_plot=False)
+    outdir = os.path.join(tempdir, 'run')
+    os.mkdir(outdir)
+    ad._detect_outliers_core(funcfile, motionfile, 0, cwd=outdir)
+    outliers = np.loadtxt(os.path.join(outdir, 'art.func_outliers.txt'))
+    yield assert_equal, outliers, [7, 15, 16, 25]
+    disp = nb.load(os.path.join(outdir, 'disp.func.nii')).get_data()
+
+    # the volumes of a list of 3D images are streamed in the same way
+    outdir = os.path.join(tempdir, 'vols')
+    os.mkdir(outdir)
+    ad._detect_outliers_core(volfiles, motionfile, 0, cwd=outdir)
+    for name in ['art.vol00_outliers.txt', 'global_intensity.vol00.txt',
+                 'norm.vol00.txt']:
+        yield (assert_equal, np.loadtxt(os.path.join(outdir, name)),
+               np.loadtxt(os.path.join(tempdir, 'run',
+                                       name.replace('vol00', 'func'))))
+
+    # the sparse displacement has the values of the displacement map
+    ad.inputs.sparse_displacement = True
+    outdir = os.path.join(tempdir, 'sparse')
+    os.mkdir(outdir)
+    ad._detect_outliers_core(funcfile, motionfile, 0, cwd=outdir)
+    sparse = np.load(os.path.join(outdir, 'disp.func.npz'))
+    i, j, k = sparse['voxels'].T
+    yield assert_equal, tuple(sparse['shape']), disp.shape
+    yield assert_almost_equal, sparse['displacement'], disp[i, j, k].T
+    yield assert_equal, np.count_nonzero(disp), sparse['displacement'].size
+    rmtree(tempdir)
+
+
 def test_sc_init():
     sc = ra.StimulusCorrelation(concatenated_design=True)
     yield assert_true, sc.inputs.concatenated_design
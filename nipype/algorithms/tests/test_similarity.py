@@ -0,0 +1,59 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+import nibabel as nb
+
+from nipype.testing import assert_equal, assert_almost_equal, assert_raises
+from nipype.algorithms.metrics import Similarity
+
+
+def test_similarity():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    rng = np.random.RandomState(0)
+    data1 = rng.rand(10, 8, 6, 5).astype(np.float32)
+    data2 = data1 + 0.5 * rng.rand(10, 8, 6, 5).astype(np.float32)
+    # the first volume of the second image is the same as the first one
+    data2[..., 0] = data1[..., 0]
+    mask = np.zeros(data1.shape[:3], dtype=np.uint8)
+    mask[2:8, 2:6, 1:5] = 1
+    nb.Nifti1Image(data1, np.eye(4)).to_filename('vol1.nii')
+    nb.Nifti1Image(data2, np.eye(4)).to_filename('vol2.nii.gz')
+    nb.Nifti1Image(mask, np.eye(4)).to_filename('mask.nii')
+
+    for metric in ['cc', 'cr', 'crl1', 'nmi']:
+        res = Similarity(volume1='vol1.nii', volume2='vol2.nii.gz',
+                         metric=metric).run()
+        yield assert_equal, len(res.outputs.similarity), 5
+        yield assert_almost_equal, res.outputs.similarity[0], 1.0
+
+    # the mutual information of a volume with itself is its entropy
+    counts = np.bincount(np.round(255 * (data1[..., 0] - data1[..., 0].min()) /
+                                  np.ptp(data1[..., 0])).astype(int).ravel())
+    prob = counts[counts > 0] / float(counts.sum())
+    res = Similarity(volume1='vol1.nii', volume2='vol2.nii.gz',
+                     metric='mi').run()
+    yield (assert_almost_equal, res.outputs.similarity[0],
+           -np.sum(prob * np.log(prob)))
+
+    # all the volumes at once or one at a time, with a custom metric
+    similarity = Similarity(volume1='vol1.nii', volume2='vol2.nii.gz',
+                            mask1='mask.nii', mask2='mask.nii',
+                            metric=lambda hist: hist.max() / hist.sum())
+    expected = similarity.run().outputs.similarity
+    similarity._batch_values = 10 * 8 * 6
+    yield assert_equal, similarity.run().outputs.similarity, expected
+    yield assert_equal, len(expected), 5
+
+    # 4D volumes of different lengths are not truncated
+    nb.Nifti1Image(data2[..., :4], np.eye(4)).to_filename('vol3.nii')
+    similarity = Similarity(volume1='vol1.nii', volume2='vol3.nii')
+    yield assert_raises, RuntimeError, similarity.run
+
+    os.chdir(cwd)
+    rmtree(tempdir)
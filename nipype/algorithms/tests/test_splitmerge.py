@@ -36,3 +36,78 @@ def test_split_and_merge():
     rmtree(tmpdir)
 
     yield assert_equal, np.allclose(dwmasked, dwmerged), True
+
+
+def test_split_and_merge_npy():
+    import numpy as np
+    import nibabel as nb
+    import os.path as op
+    import os
+    cwd = os.getcwd()
+
+    from nipype.algorithms.misc import SplitROIs, MergeROIs
+    tmpdir = mkdtemp()
+
+    os.chdir(tmpdir)
+    aff = np.eye(4)
+    mskdata = np.random.uniform(size=(12, 11, 10)) > 0.3
+    in_mask = op.join(tmpdir, 'mask.nii')
+    nb.Nifti1Image(mskdata.astype(np.uint8), aff, None).to_filename(in_mask)
+
+    for nvols in [6, 300]:
+        dwfile = op.join(tmpdir, 'dwi%d.nii' % nvols)
+        dwshape = mskdata.shape[:3] + (nvols,)
+        dwdata = np.random.normal(size=dwshape).astype(np.float32)
+        nb.Nifti1Image(dwdata, aff, None).to_filename(dwfile)
+
+        split = SplitROIs(in_file=dwfile, in_mask=in_mask, n_rois=7,
+                          out_format='npy').run()
+        yield assert_equal, len(split.outputs.out_files), 7
+        yield (assert_equal, sum([np.load(f).shape[0]
+                                  for f in split.outputs.out_files]),
+               np.count_nonzero(mskdata))
+
+        merged = MergeROIs(in_files=split.outputs.out_files,
+                           in_index=split.outputs.out_index,
+                           in_reference=in_mask).run().outputs.merged_file
+        dwmerged = nb.load(merged).get_data()
+        dwmasked = dwdata * mskdata[:, :, :, np.newaxis]
+        yield assert_equal, np.allclose(dwmasked, dwmerged), True
+
+    os.chdir(cwd)
+    rmtree(tmpdir)
+
+
+def test_split_n_rois():
+    import numpy as np
+    import nibabel as nb
+    import os.path as op
+    import os
+    cwd = os.getcwd()
+
+    from nipype.algorithms.misc import SplitROIs, MergeROIs
+    tmpdir = mkdtemp()
+
+    os.chdir(tmpdir)
+    aff = np.eye(4)
+    mskdata = np.zeros((4, 3, 2), dtype=np.uint8)
+    mskdata.flat[:10] = 1
+    in_mask = op.join(tmpdir, 'mask.nii')
+    nb.Nifti1Image(mskdata, aff, None).to_filename(in_mask)
+    dwfile = op.join(tmpdir, 'dwi.nii')
+    dwdata = np.random.normal(size=mskdata.shape + (5,)).astype(np.float32)
+    nb.Nifti1Image(dwdata, aff, None).to_filename(dwfile)
+
+    for out_format in ['nifti', 'npy']:
+        split = SplitROIs(in_file=dwfile, in_mask=in_mask, n_rois=6,
+                          out_format=out_format).run()
+        yield assert_equal, len(split.outputs.out_files), 6
+        merged = MergeROIs(in_files=split.outputs.out_files,
+                           in_index=split.outputs.out_index,
+                           in_reference=in_mask).run().outputs.merged_file
+        dwmerged = nb.load(merged).get_data()
+        dwmasked = dwdata * mskdata[:, :, :, np.newaxis]
+        yield assert_equal, np.allclose(dwmasked, dwmerged), True
+
+    os.chdir(cwd)
+    rmtree(tmpdir)
@@ -0,0 +1,83 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+from builtins import range
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+import nibabel as nb
+from scipy.special import legendre
+
+from nipype.testing import assert_equal, assert_almost_equal
+from nipype.algorithms.misc import TSNR
+
+
+def test_tsnr():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    rng = np.random.RandomState(0)
+    data = 100 + np.arange(40)[None, None, None, :] / 10. + \
+        5 * rng.randn(6, 5, 4, 40)
+    data[0, 0, 0] = 0
+    data = data.astype(np.float32)
+    # two runs, the second one given as 3D volumes
+    nb.Nifti1Image(data[..., :25], np.eye(4)).to_filename('run1.nii')
+    in_files = [os.path.abspath('run1.nii')]
+    for t in range(25, 40):
+        in_files.append(os.path.abspath('vol%d.nii.gz' % t))
+        nb.Nifti1Image(data[..., t], np.eye(4)).to_filename(in_files[-1])
+
+    X = np.ones((40, 1))
+    for i in range(2):
+        X = np.hstack((X, legendre(i + 1)(np.linspace(-1, 1, 40))[:, None]))
+    betas = np.dot(np.linalg.pinv(X), data.reshape(-1, 40).T)
+    detrended = data - np.dot(X[:, 1:], betas[1:]).T.reshape(data.shape)
+    mean = detrended.mean(3)
+    std = detrended.std(3)
+    tsnr = np.zeros(mean.shape)
+    tsnr[std > 1.e-3] = mean[std > 1.e-3] / std[std > 1.e-3]
+
+    for float64 in [False, True]:
+        interface = TSNR(in_file=in_files, regress_poly=2, float64=float64)
+        # process the data in several slabs
+        interface._slab_values = 6 * 5 * 40
+        res = interface.run()
+        for name, expected in [('detrended_file', detrended),
+                               ('mean_file', mean), ('stddev_file', std),
+                               ('tsnr_file', tsnr)]:
+            img = nb.load(getattr(res.outputs, name))
+            yield assert_equal, img.get_data_dtype(), np.float32
+            yield (assert_almost_equal, img.get_data() / expected.max(),
+                   expected / expected.max(), 5)
+
+    os.chdir(cwd)
+    rmtree(tempdir)
+
+
+def test_tsnr_unsigned():
+    tempdir = mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    rng = np.random.RandomState(0)
+    data = (1000 + 50 * rng.randn(4, 3, 2, 30)).astype(np.uint16)
+    nb.Nifti1Image(data, np.eye(4)).to_filename('run.nii')
+
+    X = np.ones((30, 1))
+    X = np.hstack((X, np.linspace(-1, 1, 30)[:, None]))
+    betas = np.dot(np.linalg.pinv(X), data.reshape(-1, 30).T)
+    detrended = data - np.dot(X[:, 1:], betas[1:]).T.reshape(data.shape)
+
+    res = TSNR(in_file='run.nii', regress_poly=1).run()
+    for name, expected in [('detrended_file', detrended),
+                           ('mean_file', detrended.mean(3)),
+                           ('stddev_file', detrended.std(3))]:
+        img = nb.load(getattr(res.outputs, name))
+        yield assert_equal, img.get_data_dtype(), np.float32
+        # the residuals around the trend are not truncated
+        yield (assert_almost_equal, img.get_data() / expected.max(),
+               expected / expected.max(), 5)
+
+    os.chdir(cwd)
+    rmtree(tempdir)
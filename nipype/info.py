@@ -105,7 +105,7 @@ pipeline systems.
 # versions
 NIBABEL_MIN_VERSION = '2.0.1'
 NETWORKX_MIN_VERSION = '1.7'
-NUMPY_MIN_VERSION = '1.6.2'
+NUMPY_MIN_VERSION = '1.10.0'
 SCIPY_MIN_VERSION = '0.11'
 TRAITS_MIN_VERSION = '4.3'
 DATEUTIL_MIN_VERSION = '1.5'
@@ -9,5 +9,16 @@ Requires Packages to be installed
 from __future__ import absolute_import
 __docformat__ = 'restructuredtext'
 
-from .io import DataGrabber, DataSink, SelectFiles
-from .utility import IdentityInterface, Rename, Function, Select, Merge
+from ..utils.misc import lazy_attributes
+lazy_attributes(__name__, {
+    'DataGrabber': 'nipype.interfaces.io',
+    'DataSink': 'nipype.interfaces.io',
+    'SelectFiles': 'nipype.interfaces.io',
+    'IdentityInterface': 'nipype.interfaces.utility',
+    'Rename': 'nipype.interfaces.utility',
+    'Function': 'nipype.interfaces.utility',
+    'Select': 'nipype.interfaces.utility',
+    'Merge': 'nipype.interfaces.utility',
+    'io': 'nipype.interfaces.io',
+    'utility': 'nipype.interfaces.utility'})
+del lazy_attributes
@@ -45,7 +45,6 @@ from ..utils.filemanip import (md5, hash_infile, FileNotFoundError,
                                hash_timestamp, save_json,
                                split_filename)
 from ..utils.misc import is_container, trim, str2bool
-from ..utils.provenance import write_provenance
 from .. import config, logging, LooseVersion
 from .. import __version__
 from ..external.six import string_types, text_type
@@ -1042,6 +1041,7 @@ class BaseInterface(Interface):
                                       outputs=outputs)
             prov_record = None
             if str2bool(config.get('execution', 'write_provenance')):
+                from ..utils.provenance import write_provenance
                 prov_record = write_provenance(results)
             results.provenance = prov_record
         except Exception as e:
@@ -1080,6 +1080,7 @@ class BaseInterface(Interface):
             prov_record = None
             if str2bool(config.get('execution', 'write_provenance')):
                 try:
+                    from ..utils.provenance import write_provenance
                     prov_record = write_provenance(results)
                 except Exception:
                     prov_record = None
@@ -74,51 +74,101 @@ def length(xyz, along=False):
     return np.sum(dists)
 
 
+def _fiber_chunks(streamlines, chunk_points=2 ** 22):
+    """ Iterate over the streamlines in chunks of about chunk_points points
+
+    Yields
+    ------
+    first : index of the first fiber of the chunk
+    points : (N, 3) array with the points of all the fibers of the chunk
+    offsets : (n + 1,) array with the index of the first point of each
+        fiber in points, and the number of points
+    """
+    n_points = np.array([len(fiber[0]) for fiber in streamlines], dtype=int)
+    cum_points = np.cumsum(n_points)
+    first = 0
+    while first < len(streamlines):
+        last = max(first + 1, int(np.searchsorted(
+            cum_points, cum_points[first] - n_points[first] + chunk_points,
+            side='right')))
+        points = np.concatenate([fiber[0] for fiber in
+                                 streamlines[first:last]]).astype(np.float64)
+        offsets = np.concatenate(([0], np.cumsum(n_points[first:last])))
+        yield first, points, offsets
+        first = last
+
+
+def _voxel_labels(pointsmm, roiData, voxelSize):
+    """ Labels of the voxels of roiData holding each point (in mm) """
+    ijk = (pointsmm / np.array(voxelSize, dtype=np.float64)).astype(int)
+    return roiData[ijk[:, 0], ijk[:, 1], ijk[:, 2]]
+
+
+def _crossings_matrix(fibers, rois, n_fibers, n_rois):
+    """ Symmetric matrix counting, for each pair of different ROIs, the
+    crossings of a fiber with both of them, given the fiber and the ROI
+    (starting at 1) of every crossing """
+    from scipy import sparse
+    incidence = sparse.coo_matrix(
+        (np.ones(len(fibers), dtype=np.int64), (fibers, np.asarray(rois) - 1)),
+        shape=(n_fibers, n_rois)).tocsr()
+    connectivity_matrix = (incidence.T * incidence).toarray().astype(np.uint)
+    np.fill_diagonal(connectivity_matrix, 0)
+    return connectivity_matrix
+
+
+def fiber_lengths(streamlines):
+    """ Euclidean length of each fiber of a list of streamlines, as
+    computed by :func:`length` """
+    lengths = np.zeros(len(streamlines))
+    for first, points, offsets in _fiber_chunks(streamlines):
+        dists = np.sqrt((np.diff(points, axis=0) ** 2).sum(axis=1))
+        cum_dists = np.concatenate(([0], np.cumsum(dists)))
+        lengths[first:first + len(offsets) - 1] = \
+            cum_dists[offsets[1:] - 1] - cum_dists[offsets[:-1]]
+    return lengths
+
+
 def get_rois_crossed(pointsmm, roiData, voxelSize):
-    n_points = len(pointsmm)
-    rois_crossed = []
-    for j in range(0, n_points):
-        # store point
-        x = int(pointsmm[j, 0] / float(voxelSize[0]))
-        y = int(pointsmm[j, 1] / float(voxelSize[1]))
-        z = int(pointsmm[j, 2] / float(voxelSize[2]))
-        if not roiData[x, y, z] == 0:
-            rois_crossed.append(roiData[x, y, z])
-    rois_crossed = list(dict.fromkeys(rois_crossed).keys())  # Removed duplicates from the list
-    return rois_crossed
+    rois_crossed = _voxel_labels(np.asarray(pointsmm, dtype=np.float64),
+                                 roiData, voxelSize)
+    rois_crossed = rois_crossed[rois_crossed != 0]
+    # Removed duplicates from the list, keeping the order of the crossings
+    _, first = np.unique(rois_crossed, return_index=True)
+    return rois_crossed[np.sort(first)].tolist()
 
 
 def get_connectivity_matrix(n_rois, list_of_roi_crossed_lists):
-    connectivity_matrix = np.zeros((n_rois, n_rois), dtype=np.uint)
-    for rois_crossed in list_of_roi_crossed_lists:
-        for idx_i, roi_i in enumerate(rois_crossed):
-            for idx_j, roi_j in enumerate(rois_crossed):
-                if idx_i > idx_j:
-                    if not roi_i == roi_j:
-                        connectivity_matrix[roi_i - 1, roi_j - 1] += 1
-    connectivity_matrix = connectivity_matrix + connectivity_matrix.T
-    return connectivity_matrix
+    n_crossings = [len(rois_crossed) for rois_crossed in list_of_roi_crossed_lists]
+    fibers = np.repeat(np.arange(len(n_crossings)), n_crossings)
+    rois = np.concatenate([np.zeros(0, dtype=int)] +
+                          [np.asarray(rois_crossed, dtype=int)
+                           for rois_crossed in list_of_roi_crossed_lists])
+    return _crossings_matrix(fibers, rois, len(n_crossings), n_rois)
 
 
 def create_allpoints_cmat(streamlines, roiData, voxelSize, n_rois):
     """ Create the intersection arrays for each fiber
     """
     n_fib = len(streamlines)
-    pc = -1
-    # Computation for each fiber
+    connectivity_matrix = np.zeros((n_rois, n_rois), dtype=np.uint)
     final_fiber_ids = []
-    list_of_roi_crossed_lists = []
-    for i, fiber in enumerate(streamlines):
-        pcN = int(round(float(100 * i) / n_fib))
-        if pcN > pc and pcN % 1 == 0:
-            pc = pcN
-            print('%4.0f%%' % (pc))
-        rois_crossed = get_rois_crossed(fiber[0], roiData, voxelSize)
-        if len(rois_crossed) > 0:
-            list_of_roi_crossed_lists.append(list(rois_crossed))
-            final_fiber_ids.append(i)
-
-    connectivity_matrix = get_connectivity_matrix(n_rois, list_of_roi_crossed_lists)
+    # Computation for chunks of fibers
+    for first, points, offsets in _fiber_chunks(streamlines):
+        iflogger.info('%4.0f%%' % (100. * first / n_fib))
+        labels = _voxel_labels(points, roiData, voxelSize).astype(np.int64)
+        fibers = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+        crossed = labels != 0
+        if not np.any(crossed):
+            continue
+        # each ROI crossed by each fiber, once
+        n_labels = int(labels[crossed].max()) + 1
+        crossings = np.unique(fibers[crossed] * n_labels + labels[crossed])
+        fibers, rois = crossings // n_labels, crossings % n_labels
+        connectivity_matrix += _crossings_matrix(
+            fibers, rois, len(offsets) - 1, n_rois)
+        final_fiber_ids += (first + np.unique(fibers)).tolist()
+
     dis = n_fib - len(final_fiber_ids)
     iflogger.info("Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (dis, dis * 100.0 / n_fib, n_fib))
     iflogger.info("Valid fibers: %i (%f percent)" % (n_fib - dis, 100 - dis * 100.0 / n_fib))
@@ -143,29 +193,14 @@ def create_endpoints_array(fib, voxelSize):
     n = len(fib)
     endpoints = np.zeros((n, 2, 3))
     endpointsmm = np.zeros((n, 2, 3))
-    pc = -1
-
-    # Computation for each fiber
-    for i, fi in enumerate(fib):
-        f = fi[0]
-
-        # store startpoint
-        endpoints[i, 0, :] = f[0, :]
-        # store endpoint
-        endpoints[i, 1, :] = f[-1, :]
-
-        # store startpoint
-        endpointsmm[i, 0, :] = f[0, :]
-        # store endpoint
-        endpointsmm[i, 1, :] = f[-1, :]
-
-        # Translate from mm to index
-        endpoints[i, 0, 0] = int(endpoints[i, 0, 0] / float(voxelSize[0]))
-        endpoints[i, 0, 1] = int(endpoints[i, 0, 1] / float(voxelSize[1]))
-        endpoints[i, 0, 2] = int(endpoints[i, 0, 2] / float(voxelSize[2]))
-        endpoints[i, 1, 0] = int(endpoints[i, 1, 0] / float(voxelSize[0]))
-        endpoints[i, 1, 1] = int(endpoints[i, 1, 1] / float(voxelSize[1]))
-        endpoints[i, 1, 2] = int(endpoints[i, 1, 2] / float(voxelSize[2]))
+
+    # store startpoints and endpoints
+    if n > 0:
+        endpointsmm[:, 0, :] = [fi[0][0] for fi in fib]
+        endpointsmm[:, 1, :] = [fi[0][-1] for fi in fib]
+
+    # Translate from mm to index
+    endpoints[:] = (endpointsmm / np.array(voxelSize, dtype=np.float64)).astype(int)
 
     # Return the matrices
     iflogger.info('Returning the endpoint matrix')
@@ -201,8 +236,6 @@ def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_
 
     # Create empty fiber label array
     fiberlabels = np.zeros((n, 2))
-    final_fiberlabels = []
-    final_fibers_idx = []
 
     # Add node information from specified parcellation scheme
     path, name, ext = split_filename(resolution_network_file)
@@ -236,62 +269,49 @@ def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_
         H = nx.relabel_nodes(H, lambda x: x + 1)  # relabel nodes so they start at 1
         I.add_weighted_edges_from(((u, v, d['weight']) for u, v, d in H.edges(data=True)))
 
-    dis = 0
-    for i in range(endpoints.shape[0]):
-
-        # ROI start => ROI end
-        try:
-            startROI = int(roiData[endpoints[i, 0, 0], endpoints[i, 0, 1], endpoints[i, 0, 2]])
-            endROI = int(roiData[endpoints[i, 1, 0], endpoints[i, 1, 1], endpoints[i, 1, 2]])
-        except IndexError:
-            iflogger.error(("AN INDEXERROR EXCEPTION OCCURED FOR FIBER %s. PLEASE CHECK ENDPOINT GENERATION" % i))
-            break
-
-        # Filter
-        if startROI == 0 or endROI == 0:
-            dis += 1
-            fiberlabels[i, 0] = -1
-            continue
-
-        if startROI > nROIs or endROI > nROIs:
-            iflogger.error("Start or endpoint of fiber terminate in a voxel which is labeled higher")
-            iflogger.error("than is expected by the parcellation node information.")
-            iflogger.error("Start ROI: %i, End ROI: %i" % (startROI, endROI))
-            iflogger.error("This needs bugfixing!")
-            continue
-
-        # Update fiber label
-        # switch the rois in order to enforce startROI < endROI
-        if endROI < startROI:
-            tmp = startROI
-            startROI = endROI
-            endROI = tmp
-
-        fiberlabels[i, 0] = startROI
-        fiberlabels[i, 1] = endROI
-
-        final_fiberlabels.append([startROI, endROI])
-        final_fibers_idx.append(i)
-
-        # Add edge to graph
-        if G.has_edge(startROI, endROI) and 'fiblist' in G.edge[startROI][endROI]:
-            G.edge[startROI][endROI]['fiblist'].append(i)
-        else:
-            G.add_edge(startROI, endROI, fiblist=[i])
+    # ROI start => ROI end
+    ijk = endpoints.astype(int)
+    shape = np.array(roiData.shape[:3])
+    in_volume = np.all((ijk < shape) & (ijk >= -shape), axis=(1, 2))
+    n_labeled = n
+    if not np.all(in_volume):
+        n_labeled = int(np.argmin(in_volume))
+        iflogger.error(("AN INDEXERROR EXCEPTION OCCURED FOR FIBER %s. PLEASE CHECK ENDPOINT GENERATION" % n_labeled))
+    rois = np.zeros((n, 2), dtype=int)
+    rois[:n_labeled] = roiData[ijk[:n_labeled, :, 0], ijk[:n_labeled, :, 1],
+                               ijk[:n_labeled, :, 2]]
+
+    # Filter
+    orphans = np.any(rois == 0, axis=1)
+    orphans[n_labeled:] = False
+    dis = int(orphans.sum())
+    fiberlabels[orphans, 0] = -1
+
+    higher = np.any(rois > nROIs, axis=1) & ~orphans
+    if np.any(higher):
+        iflogger.error("Start or endpoint of %i fibers terminate in a voxel which is labeled higher" % higher.sum())
+        iflogger.error("than is expected by the parcellation node information.")
+        iflogger.error("Start ROIs: %s, End ROIs: %s" % (rois[higher, 0], rois[higher, 1]))
+        iflogger.error("This needs bugfixing!")
+
+    # Update fiber label
+    # switch the rois in order to enforce startROI < endROI
+    rois.sort(axis=1)
+    final = ~orphans & ~higher
+    final[n_labeled:] = False
+    final_fibers_idx = np.nonzero(final)[0].tolist()
+    final_fiberlabels = rois[final_fibers_idx]
+    fiberlabels[final_fibers_idx] = final_fiberlabels
 
     # create a final fiber length array
-    finalfiberlength = []
+    fiberlength = fiber_lengths(fib)
     if intersections:
         final_fibers_indices = final_fiber_ids
     else:
         final_fibers_indices = final_fibers_idx
 
-    for idx in final_fibers_indices:
-        # compute length of fiber
-        finalfiberlength.append(length(fib[idx][0]))
-
     # convert to array
-    final_fiberlength_array = np.array(finalfiberlength)
+    final_fiberlength_array = fiberlength[final_fibers_indices]
 
     # make final fiber labels as array
     final_fiberlabels_array = np.array(final_fiberlabels, dtype=int)
@@ -299,32 +319,48 @@ def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_
     iflogger.info("Found %i (%f percent out of %i fibers) fibers that start or terminate in a voxel which is not labeled. (orphans)" % (dis, dis * 100.0 / n, n))
     iflogger.info("Valid fibers: %i (%f percent)" % (n - dis, 100 - dis * 100.0 / n))
 
+    # number and length statistics of the fibers connecting each pair of ROIs
+    edges, edge_idx, number_of_fibers = np.unique(
+        final_fiberlabels_array.reshape(-1, 2).dot([nROIs + 1, 1]),
+        return_inverse=True, return_counts=True)
+    edge_lengths = fiberlength[final_fibers_idx]
+    fiber_length_mean = np.bincount(edge_idx, weights=edge_lengths) / \
+        np.maximum(number_of_fibers, 1)
+    fiber_length_std = np.sqrt(np.bincount(
+        edge_idx, weights=(edge_lengths - fiber_length_mean[edge_idx]) ** 2) /
+        np.maximum(number_of_fibers, 1))
+    sorted_lengths = edge_lengths[np.lexsort((edge_lengths, edge_idx))]
+    edge_start = np.cumsum(number_of_fibers) - number_of_fibers
+    fiber_length_median = (
+        sorted_lengths[edge_start + (number_of_fibers - 1) // 2] +
+        sorted_lengths[edge_start + number_of_fibers // 2]) / 2.
+
     numfib = nx.Graph()
     numfib.add_nodes_from(G)
     fibmean = numfib.copy()
     fibmedian = numfib.copy()
     fibdev = numfib.copy()
-    for u, v, d in G.edges_iter(data=True):
+    for u, v in G.edges():
         G.remove_edge(u, v)
-        di = {}
-        if 'fiblist' in d:
-            di['number_of_fibers'] = len(d['fiblist'])
-            idx = np.where((final_fiberlabels_array[:, 0] == int(u)) & (final_fiberlabels_array[:, 1] == int(v)))[0]
-            di['fiber_length_mean'] = float(np.mean(final_fiberlength_array[idx]))
-            di['fiber_length_median'] = float(np.median(final_fiberlength_array[idx]))
-            di['fiber_length_std'] = float(np.std(final_fiberlength_array[idx]))
-        else:
-            di['number_of_fibers'] = 0
-            di['fiber_length_mean'] = 0
-            di['fiber_length_median'] = 0
-            di['fiber_length_std'] = 0
         if not u == v:  # Fix for self loop problem
-            G.add_edge(u, v, di)
-            if 'fiblist' in d:
-                numfib.add_edge(u, v, weight=di['number_of_fibers'])
-                fibmean.add_edge(u, v, weight=di['fiber_length_mean'])
-                fibmedian.add_edge(u, v, weight=di['fiber_length_median'])
-                fibdev.add_edge(u, v, weight=di['fiber_length_std'])
+            G.add_edge(u, v, {'number_of_fibers': 0,
+                              'fiber_length_mean': 0,
+                              'fiber_length_median': 0,
+                              'fiber_length_std': 0})
+    for i, edge in enumerate(edges):
+        u, v = divmod(int(edge), nROIs + 1)
+        if u == v:  # Fix for self loop problem
+            continue
+        di = {}
+        di['number_of_fibers'] = int(number_of_fibers[i])
+        di['fiber_length_mean'] = float(fiber_length_mean[i])
+        di['fiber_length_median'] = float(fiber_length_median[i])
+        di['fiber_length_std'] = float(fiber_length_std[i])
+        G.add_edge(u, v, di)
+        numfib.add_edge(u, v, weight=di['number_of_fibers'])
+        fibmean.add_edge(u, v, weight=di['fiber_length_mean'])
+        fibmedian.add_edge(u, v, weight=di['fiber_length_median'])
+        fibdev.add_edge(u, v, weight=di['fiber_length_std'])
 
     iflogger.info('Writing network as {ntwk}'.format(ntwk=matrix_name))
     nx.write_gpickle(G, op.abspath(matrix_name))
@@ -386,7 +422,8 @@ def cmat(track_file, roi_file, resolution_network_file, matrix_name, matrix_mat_
     finalfibers_fname = op.abspath(endpoint_name + '_streamline_final.trk')
     stats['endpoint_n_fib'] = save_fibers(hdr, fib, finalfibers_fname, final_fibers_idx)
     stats['endpoints_percent'] = float(stats['endpoint_n_fib']) / float(stats['orig_n_fib']) * 100
-    stats['intersections_percent'] = float(stats['intersections_n_fib']) / float(stats['orig_n_fib']) * 100
+    if intersections:
+        stats['intersections_percent'] = float(stats['intersections_n_fib']) / float(stats['orig_n_fib']) * 100
 
     out_stats_file = op.abspath(endpoint_name + '_statistics.mat')
     iflogger.info("Saving matrix creation statistics as %s" % out_stats_file)
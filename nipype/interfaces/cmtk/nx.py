@@ -97,10 +97,62 @@ def add_dicts_by_key(in_dict1, in_dict2):
     return both
 
 
+def _grow_accumulators(size, *groups):
+    """
+    Pads the (square or flat) accumulators in each dictionary of ``groups``
+    with zeros up to ``size`` nodes
+    """
+    for group in groups:
+        for key, array in list(group.items()):
+            pad = [(0, size - dim) for dim in array.shape]
+            group[key] = np.pad(array, pad, mode='constant')
+
+
+def _network_arrays(ntwk, index):
+    """
+    Converts the edges and node values of a network to arrays
+
+    Returns the row and column positions (in the node ordering given by
+    ``index``) of every edge, a dictionary with the positions and values of
+    every numeric edge attribute, and the positions and values of the
+    numeric node ``value`` attributes. Nodes missing from ``index`` are
+    appended to it.
+    """
+    for node in ntwk.nodes_iter():
+        index.setdefault(node, len(index))
+    edges = list(ntwk.edges_iter(data=True))
+    rows = np.array([index[u] for u, _, _ in edges], dtype=np.intp)
+    cols = np.array([index[v] for _, v, _ in edges], dtype=np.intp)
+    if not ntwk.is_directed():
+        rows, cols = np.minimum(rows, cols), np.maximum(rows, cols)
+    data = [edge[2] for edge in edges]
+    attributes = {}
+    for key in set().union(*data) - set(['count']):
+        try:
+            values = np.array([di.get(key, np.nan) for di in data],
+                              dtype=np.float64)
+        except (TypeError, ValueError):
+            continue
+        present = ~np.isnan(values)
+        attributes[key] = (rows[present], cols[present], values[present])
+    node_data = ntwk.node
+    nodes = [node for node in ntwk.nodes_iter() if 'value' in node_data[node]]
+    values = np.array([node_data[node]['value'] for node in nodes],
+                      dtype=np.float64)
+    return (rows, cols, attributes,
+            np.array([index[node] for node in nodes], dtype=np.intp), values)
+
+
 def average_networks(in_files, ntwk_res_file, group_id):
     """
     Sums the edges of input networks and divides by the number of networks
     Writes the average network as .pck and .gexf and returns the name of the written networks
+
+    The networks are read one at a time and their edge attributes are
+    accumulated in node x node arrays (one per attribute), so that the
+    networkx graph of the average is only built once, after thresholding.
+    An edge attribute is kept only if every network containing the edge
+    defines it.
     """
     import networkx as nx
     import os.path as op
@@ -118,68 +170,73 @@ def average_networks(in_files, ntwk_res_file, group_id):
         ntwk_res_file = read_unknown_ntwk(ntwk_res_file)
         iflogger.info(("{n} Nodes found in network resolution "
                        "file").format(n=ntwk_res_file.number_of_nodes()))
-        ntwk = remove_all_edges(ntwk_res_file)
-        counting_ntwk = ntwk.copy()
+        node_data = dict(ntwk_res_file.nodes_iter(data=True))
+        index = dict((node, idx) for idx, node in
+                     enumerate(ntwk_res_file.nodes_iter()))
+        size = len(index)
         # Sums all the relevant variables
-        for index, subject in enumerate(in_files):
-            tmp = nx.read_gpickle(subject)
+        counts = {'count': np.zeros((size, size), dtype=np.int64)}
+        sums = {}
+        node_sums = {'value': np.zeros(size), 'count': np.zeros(size, dtype=np.int64)}
+        for subject in in_files:
+            tmp = read_unknown_ntwk(subject)
             iflogger.info(('File {s} has {n} '
                            'edges').format(s=subject, n=tmp.number_of_edges()))
-            edges = tmp.edges_iter()
-            for edge in edges:
-                data = {}
-                data = tmp.edge[edge[0]][edge[1]]
-                data['count'] = 1
-                if ntwk.has_edge(edge[0], edge[1]):
-                    current = {}
-                    current = ntwk.edge[edge[0]][edge[1]]
-                    data = add_dicts_by_key(current, data)
-                ntwk.add_edge(edge[0], edge[1], data)
-            nodes = tmp.nodes_iter()
-            for node in nodes:
-                data = {}
-                data = ntwk.node[node]
-                if 'value' in tmp.node[node]:
-                    data['value'] = data['value'] + tmp.node[node]['value']
-                ntwk.add_node(node, data)
+            rows, cols, attributes, nodes, values = _network_arrays(tmp, index)
+            for node, data in tmp.nodes_iter(data=True):
+                node_data.setdefault(node, data)
+            if len(index) > size:
+                size = len(index)
+                _grow_accumulators(size, counts, sums, node_sums)
+            counts['count'][rows, cols] += 1
+            for key, (i, j, value) in attributes.items():
+                if key not in sums:
+                    sums[key] = np.zeros((size, size))
+                    counts[key] = np.zeros((size, size), dtype=np.int64)
+                sums[key][i, j] += value
+                counts[key][i, j] += 1
+            node_sums['value'][nodes] += values
+            node_sums['count'][nodes] += 1
 
         # Divides each value by the number of files
-        nodes = ntwk.nodes_iter()
-        edges = ntwk.edges_iter()
+        edge_count = counts.pop('count')
         iflogger.info(('Total network has {n} '
-                       'edges').format(n=ntwk.number_of_edges()))
+                       'edges').format(n=np.count_nonzero(edge_count)))
+        nodes = sorted(index, key=index.get)
         avg_ntwk = nx.Graph()
-        newdata = {}
-        for node in nodes:
-            data = ntwk.node[node]
-            newdata = data
-            if 'value' in data:
-                newdata['value'] = data['value'] / len(in_files)
-                ntwk.node[node]['value'] = newdata
-            avg_ntwk.add_node(node, newdata)
-
-        edge_dict = {}
-        edge_dict['count'] = np.zeros((avg_ntwk.number_of_nodes(),
-                                       avg_ntwk.number_of_nodes()))
-        for edge in edges:
-            data = ntwk.edge[edge[0]][edge[1]]
-            if ntwk.edge[edge[0]][edge[1]]['count'] >= count_to_keep_edge:
-                for key in list(data.keys()):
-                    if not key == 'count':
-                        data[key] = data[key] / len(in_files)
-                ntwk.edge[edge[0]][edge[1]] = data
-                avg_ntwk.add_edge(edge[0], edge[1], data)
-            edge_dict['count'][edge[0] - 1][edge[1] - 1] = ntwk.edge[edge[0]][edge[1]]['count']
+        for idx, node in enumerate(nodes):
+            data = dict(node_data.get(node, {}))
+            if node_sums['count'][idx]:
+                data['value'] = float(node_sums['value'][idx]) / len(in_files)
+            avg_ntwk.add_node(node, data)
+
+        rows, cols = np.nonzero(edge_count >= count_to_keep_edge)
+        averages = {}
+        for key in sums:
+            kept = counts[key][rows, cols] == edge_count[rows, cols]
+            if np.any(kept):
+                averages[key] = (kept, sums[key][rows, cols] / len(in_files))
+        for k, (i, j) in enumerate(zip(rows, cols)):
+            data = {'count': int(edge_count[i, j])}
+            for key, (kept, average) in averages.items():
+                if kept[k]:
+                    data[key] = float(average[k])
+            avg_ntwk.add_edge(nodes[i], nodes[j], data)
 
         iflogger.info('After thresholding, the average network has has {n} edges'.format(n=avg_ntwk.number_of_edges()))
 
-        avg_edges = avg_ntwk.edges_iter()
-        for edge in avg_edges:
-            data = avg_ntwk.edge[edge[0]][edge[1]]
-            for key in list(data.keys()):
-                if not key == 'count':
-                    edge_dict[key] = np.zeros((avg_ntwk.number_of_nodes(), avg_ntwk.number_of_nodes()))
-                    edge_dict[key][edge[0] - 1][edge[1] - 1] = data[key]
+        # Matrices are indexed by node number, as in the parcellation
+        positions = np.array([int(node) - 1 for node in nodes])
+        edge_dict = {}
+        edge_dict['count'] = np.zeros((size, size))
+        all_rows, all_cols = np.nonzero(edge_count)
+        edge_dict['count'][positions[all_rows], positions[all_cols]] = \
+            edge_count[all_rows, all_cols]
+        for key in sorted(averages):
+            kept, average = averages[key]
+            edge_dict[key] = np.zeros((size, size))
+            edge_dict[key][positions[rows[kept]], positions[cols[kept]]] = \
+                average[kept]
 
         for key in list(edge_dict.keys()):
             tmp = {}
@@ -0,0 +1,55 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import numpy as np
+
+from nipype.testing import assert_equal, assert_almost_equal
+from nipype.interfaces.cmtk.cmtk import (length, fiber_lengths,
+                                         get_rois_crossed,
+                                         get_connectivity_matrix,
+                                         create_allpoints_cmat,
+                                         create_endpoints_array,
+                                         _fiber_chunks)
+
+
+def test_connectivity():
+    rng = np.random.RandomState(0)
+    roi_data = rng.randint(0, 6, size=(8, 8, 8))
+    voxel_size = (2., 2., 2.)
+    fibers = [(rng.rand(n, 3).astype(np.float32) * 15.9, None, None)
+              for n in rng.randint(1, 20, size=50)]
+
+    # chunks of a few points hold every fiber once
+    chunks = list(_fiber_chunks(fibers, chunk_points=30))
+    yield assert_equal, [first for first, _, _ in chunks][0], 0
+    yield (assert_equal, sum([len(offsets) - 1 for _, _, offsets in chunks]),
+           len(fibers))
+
+    rois_crossed = []
+    expected = np.zeros((5, 5), dtype=np.uint)
+    for fiber in fibers:
+        labels = [roi_data[tuple(ijk)]
+                  for ijk in (fiber[0] / 2.).astype(int)]
+        rois = []
+        for label in labels:
+            if label != 0 and label not in rois:
+                rois.append(label)
+        rois_crossed.append(get_rois_crossed(fiber[0], roi_data, voxel_size))
+        yield assert_equal, rois_crossed[-1], rois
+        for roi_i in rois:
+            for roi_j in rois:
+                if roi_i != roi_j:
+                    expected[roi_i - 1, roi_j - 1] += 1
+
+    matrix = get_connectivity_matrix(5, rois_crossed)
+    yield assert_equal, matrix.tolist(), expected.tolist()
+    matrix, fiber_ids = create_allpoints_cmat(fibers, roi_data, voxel_size, 5)
+    yield assert_equal, matrix.tolist(), expected.tolist()
+    yield (assert_equal, fiber_ids,
+           [i for i, rois in enumerate(rois_crossed) if rois])
+
+    endpoints, endpointsmm = create_endpoints_array(fibers, voxel_size)
+    yield assert_equal, endpointsmm[3, 1].tolist(), fibers[3][0][-1].tolist()
+    yield (assert_equal, endpoints[3, 0].tolist(),
+           (fibers[3][0][0] / 2.).astype(int).tolist())
+    yield (assert_almost_equal, fiber_lengths(fibers),
+           [length(fiber[0]) for fiber in fibers], 4)
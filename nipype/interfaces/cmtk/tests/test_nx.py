@@ -0,0 +1,62 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import networkx as nx
+import numpy as np
+import scipy.io as sio
+
+from nipype.testing import assert_equal, assert_almost_equal
+from nipype.interfaces.cmtk.nx import average_networks
+
+
+def test_average_networks():
+    tempdir = mkdtemp()
+    origdir = os.getcwd()
+    os.chdir(tempdir)
+
+    edges = [[(1, 2, 4., 10.), (2, 3, 2., 20.), (1, 4, 9., None)],
+             [(2, 1, 6., 30.), (3, 4, 1., 5.)],
+             [(1, 2, 8., 20.), (2, 3, 4., 10.), (4, 1, 3., 7.)]]
+    in_files = []
+    for idx, subject in enumerate(edges):
+        ntwk = nx.Graph()
+        for node in range(1, 5):
+            ntwk.add_node(node, dn_fsname='roi%d' % node, value=float(idx))
+        for u, v, fibers, length in subject:
+            data = {'number_of_fibers': fibers}
+            if length is not None:
+                data['fiber_length_mean'] = length
+            ntwk.add_edge(u, v, data)
+        in_files.append('subj%d.pck' % idx)
+        nx.write_gpickle(ntwk, in_files[-1])
+
+    _, matlab = average_networks(in_files, in_files[0], 'grp')
+    avg = nx.read_gpickle('grp_average.pck')
+
+    # edges present in at least two of the three networks are kept
+    yield assert_equal, sorted(map(sorted, avg.edges())), [[1, 2], [1, 4], [2, 3]]
+    yield assert_equal, avg.edge[1][2]['count'], 3
+    yield assert_almost_equal, avg.edge[1][2]['number_of_fibers'], 6.
+    yield assert_almost_equal, avg.edge[1][2]['fiber_length_mean'], 20.
+    yield assert_almost_equal, avg.edge[2][3]['fiber_length_mean'], 10.
+    # attributes missing from one of the networks are dropped
+    yield assert_equal, sorted(avg.edge[1][4]), ['count', 'number_of_fibers']
+    yield assert_almost_equal, avg.edge[1][4]['number_of_fibers'], 4.
+    yield assert_equal, avg.node[3]['dn_fsname'], 'roi3'
+    yield assert_almost_equal, avg.node[3]['value'], 1.
+
+    yield assert_equal, len(matlab), 3
+    count = sio.loadmat('grp_count_average.mat')['count']
+    yield assert_equal, count[2, 3], 1
+    yield assert_equal, count.sum(), 8
+    fibers = sio.loadmat('grp_number_of_fibers_average.mat')['number_of_fibers']
+    yield assert_almost_equal, fibers[0, 1], 6.
+    yield assert_almost_equal, fibers[1, 2], 2.
+    yield assert_almost_equal, fibers[0, 3], 4.
+    yield assert_equal, np.count_nonzero(fibers), 3
+
+    os.chdir(origdir)
+    rmtree(tempdir)
@@ -13,6 +13,8 @@ from __future__ import absolute_import
 import os
 import string
 import errno
+import hashlib
+from multiprocessing.pool import ThreadPool
 from os import path as op
 from glob import glob
 
@@ -24,6 +26,7 @@ from .base import (TraitedSpec, DynamicTraitedSpec,
                    traits, BaseInterface)
 from .traits_extension import isdefined, Undefined
 from ..external.six import string_types
+from ..utils.filemanip import publish_file
 
 have_dcmstack = True
 try:
@@ -37,7 +40,7 @@ except ImportError:
 def sanitize_path_comp(path_comp):
     result = []
     for char in path_comp:
-        if char not in string.letters + string.digits + '-_.':
+        if char not in string.ascii_letters + string.digits + '-_.':
             result.append('_')
         else:
             result.append(char)
@@ -105,6 +108,15 @@ class DcmStackInputSpec(NiftiGeneratorBaseInputSpec):
                                   "exclude filters")
     force_read = traits.Bool(True, usedefault=True,
                              desc=('Force reading files without DICM marker'))
+    num_threads = traits.Int(1, usedefault=True, nohash=True,
+                             desc=('Number of threads reading the DICOM '
+                                   'files (DcmStack only)'))
+    cache_dir = Directory(nohash=True,
+                          desc=('Directory where stacked series are kept, '
+                                'keyed by the path, size and modification '
+                                'time of their DICOM files, so that they are '
+                                'not parsed again when only embed_meta or '
+                                'the output name change (DcmStack only)'))
 
 
 class DcmStackOutputSpec(TraitedSpec):
@@ -137,23 +149,54 @@ class DcmStack(NiftiGeneratorBase):
 
         return trait_input
 
+    def _cache_file(self, src_paths, include_regexes, exclude_regexes):
+        '''Return the path of the stacked series in the cache directory'''
+        key = [dcmstack.__version__, self.inputs.force_read,
+               list(include_regexes), list(exclude_regexes)]
+        for src_path in src_paths:
+            stat = os.stat(src_path)
+            key.append((op.abspath(src_path), stat.st_size,
+                        repr(stat.st_mtime)))
+        key = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return op.join(op.abspath(self.inputs.cache_dir), key + '.nii.gz')
+
     def _run_interface(self, runtime):
         src_paths = self._get_filelist(self.inputs.dicom_files)
-        include_regexes = dcmstack.default_key_incl_res
+        include_regexes = list(dcmstack.default_key_incl_res)
         if isdefined(self.inputs.include_regexes):
             include_regexes += self.inputs.include_regexes
-        exclude_regexes = dcmstack.default_key_excl_res
+        exclude_regexes = list(dcmstack.default_key_excl_res)
         if isdefined(self.inputs.exclude_regexes):
             exclude_regexes += self.inputs.exclude_regexes
-        meta_filter = dcmstack.make_key_regex_filter(exclude_regexes,
-                                                     include_regexes)
-        stack = dcmstack.DicomStack(meta_filter=meta_filter)
-        for src_path in src_paths:
-            if not imghdr.what(src_path) == "gif":
-                src_dcm = dicom.read_file(src_path, force=self.inputs.force_read)
-                stack.add_dcm(src_dcm)
-        nii = stack.to_nifti(embed_meta=True)
-        nw = NiftiWrapper(nii)
+
+        cache_file = None
+        if isdefined(self.inputs.cache_dir):
+            cache_file = self._cache_file(src_paths, include_regexes,
+                                          exclude_regexes)
+        if cache_file is not None and op.exists(cache_file):
+            nw = NiftiWrapper.from_filename(cache_file)
+        else:
+            meta_filter = dcmstack.make_key_regex_filter(exclude_regexes,
+                                                         include_regexes)
+            stack = dcmstack.DicomStack(meta_filter=meta_filter)
+            args = [(src_path, self.inputs.force_read)
+                    for src_path in src_paths]
+            if self.inputs.num_threads > 1:
+                pool = ThreadPool(self.inputs.num_threads)
+                src_dcms = pool.imap(_read_dicom, args)
+            else:
+                src_dcms = (_read_dicom(arg) for arg in args)
+            for src_dcm in src_dcms:
+                if src_dcm is not None:
+                    stack.add_dcm(src_dcm)
+            if self.inputs.num_threads > 1:
+                pool.close()
+                pool.join()
+            nw = NiftiWrapper(stack.to_nifti(embed_meta=True))
+            if cache_file is not None:
+                publish_file(cache_file,
+                             lambda tmp_file: nb.save(nw.nii_img, tmp_file))
+        nii = nw.nii_img
         self.out_path = \
             self._get_out_path(nw.meta_ext.get_class_dict(('global', 'const')))
         if not self.inputs.embed_meta:
@@ -167,6 +210,14 @@ class DcmStack(NiftiGeneratorBase):
         return outputs
 
 
+def _read_dicom(args):
+    '''Read a DICOM file, skipping GIF images'''
+    src_path, force_read = args
+    if imghdr.what(src_path) == "gif":
+        return None
+    return dicom.read_file(src_path, force=force_read)
+
+
 class GroupAndStackOutputSpec(TraitedSpec):
     out_list = traits.List(desc="List of output nifti files")
 
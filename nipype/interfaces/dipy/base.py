@@ -47,6 +47,9 @@ class DipyBaseInterfaceInputSpec(BaseInterfaceInputSpec):
     in_bvec = File(exists=True, mandatory=True, desc=('input b-vectors table'))
     b0_thres = traits.Int(700, usedefault=True, desc=('b0 threshold'))
     out_prefix = traits.Str(desc=('output prefix for file names'))
+    n_procs = traits.Int(1, usedefault=True, nohash=True,
+                         desc=('number of processes used to fit the model '
+                               'over slabs of the volume'))
 
 
 class DipyDiffusionInterface(DipyBaseInterface):
@@ -55,6 +58,7 @@ class DipyDiffusionInterface(DipyBaseInterface):
     A base interface for py:mod:`dipy` computations
     """
     input_spec = DipyBaseInterfaceInputSpec
+    _slab_values = 2 ** 24
 
     def _get_gradient_table(self):
         bval = np.loadtxt(self.inputs.in_bval)
@@ -80,3 +84,71 @@ class DipyDiffusionInterface(DipyBaseInterface):
             ext = fext
 
         return out_prefix + '_' + name + ext
+
+    def _fit_slabs(self, model, data, mask, maps):
+        """
+        Fits ``model`` over z-slabs of ``data`` (restricted to ``mask``,
+        if given) using ``n_procs`` processes, and returns the float32
+        volumes of the dictionary computed by ``maps(fit)`` on each slab.
+        The volumes are filled as the slabs are fitted.
+        """
+        shape = data.shape
+        nslice = int(np.prod(shape[:2]) * np.prod(shape[3:]))
+        nz = max(1, self._slab_values // max(1, nslice))
+        n_procs = self.inputs.n_procs
+        if n_procs > 1:
+            nz = min(nz, -(-shape[2] // n_procs))
+        slabs = [(z, min(z + nz, shape[2])) for z in range(0, shape[2], nz)]
+
+        initargs = (model, data, mask, maps)
+        pool = None
+        if n_procs > 1 and len(slabs) > 1:
+            from multiprocessing import Pool
+            pool = Pool(processes=n_procs, initializer=_init_fit,
+                        initargs=initargs)
+            fits = pool.imap_unordered(_fit_slab, slabs)
+        else:
+            _init_fit(*initargs)
+            fits = (_fit_slab(slab) for slab in slabs)
+
+        volumes = {}
+        try:
+            for z0, z1, values in fits:
+                for key, value in list(values.items()):
+                    if key not in volumes:
+                        volumes[key] = np.zeros(
+                            shape[:3] + value.shape[3:], dtype=np.float32)
+                    volumes[key][:, :, z0:z1] = value
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+            _FIT.clear()
+        return volumes
+
+
+_FIT = {}
+
+
+def _init_fit(model, data, mask, maps):
+    """
+    Set the model, data and mask shared by all the slabs fitted in one
+    process
+    """
+    _FIT.update(model=model, data=data, mask=mask, maps=maps)
+
+
+def _fit_slab(args):
+    """
+    Fit the model on the slab of slices ``[z0, z1)``, returning the float32
+    maps of the fit
+    """
+    z0, z1 = args
+    data = np.asanyarray(_FIT['data'][:, :, z0:z1])
+    mask = _FIT['mask']
+    if mask is not None:
+        mask = mask[:, :, z0:z1]
+    fit = _FIT['model'].fit(data, mask)
+    values = _FIT['maps'](fit)
+    return z0, z1, dict([(key, np.asarray(value, dtype=np.float32))
+                         for key, value in list(values.items())])
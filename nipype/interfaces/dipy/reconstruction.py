@@ -4,12 +4,14 @@ Interfaces to the reconstruction algorithms in dipy
 
 """
 import os.path as op
+from functools import partial
 
 import numpy as np
 import nibabel as nb
 
 from nipype.interfaces.base import TraitedSpec, File, traits, isdefined
 from .base import DipyDiffusionInterface, DipyBaseInterfaceInputSpec
+from ...utils.filemanip import slab_source
 
 from nipype import logging
 IFLOGGER = logging.getLogger('interface')
@@ -71,7 +73,7 @@ class RESTORE(DipyDiffusionInterface):
         img = nb.load(self.inputs.in_file)
         hdr = img.get_header().copy()
         affine = img.get_affine()
-        data = img.get_data()
+        data = slab_source(self.inputs.in_file)
         gtab = self._get_gradient_table()
 
         if isdefined(self.inputs.in_mask):
@@ -86,25 +88,28 @@ class RESTORE(DipyDiffusionInterface):
             noise_msk[noise_msk < 1.0] = 0
             noise_msk = noise_msk.astype(np.uint8)
             try_b0 = False
-        elif np.all(data[msk == 0, 0] == 0):
+        elif np.all(np.asanyarray(data[..., 0])[msk == 0] == 0):
             IFLOGGER.info('Input data are masked.')
             noise_msk = msk.reshape(-1).astype(np.uint8)
         else:
             noise_msk = (1 - msk).reshape(-1).astype(np.uint8)
 
         nb0 = np.sum(gtab.b0s_mask)
-        dsample = data.reshape(-1, data.shape[-1])
 
         if try_b0 and (nb0 > 1):
-            noise_data = dsample.take(np.where(gtab.b0s_mask),
-                                      axis=-1)[noise_msk == 0, ...]
+            idxs = np.where(gtab.b0s_mask)[0]
+            noise_msk = noise_msk == 0
             n = nb0
         else:
             nodiff = np.where(~gtab.b0s_mask)
             nodiffidx = nodiff[0].tolist()
             n = 20 if len(nodiffidx) >= 20 else len(nodiffidx)
             idxs = np.random.choice(nodiffidx, size=n, replace=False)
-            noise_data = dsample.take(idxs, axis=-1)[noise_msk == 1, ...]
+            noise_msk = noise_msk == 1
+
+        # Only the volumes used to estimate the noise are read
+        noise_data = np.stack([np.asanyarray(data[..., int(i)]).reshape(-1)[
+            noise_msk] for i in idxs], axis=-1)
 
         # Estimate sigma required by RESTORE
         mean_std = np.median(noise_data.std(-1))
@@ -128,19 +133,19 @@ class RESTORE(DipyDiffusionInterface):
             dti = TensorModel(gtab, fit_method='RESTORE', sigma=sigma)
 
         try:
-            fit_restore = dti.fit(data, msk)
+            maps = self._fit_slabs(dti, data, msk, _restore_maps)
         except TypeError:
             dti = TensorModel(gtab)
-            fit_restore = dti.fit(data, msk)
+            maps = self._fit_slabs(dti, data, msk, _restore_maps)
 
         hdr.set_data_dtype(np.float32)
         hdr['data_type'] = 16
 
         for k in self._outputs().get():
-            scalar = getattr(fit_restore, k)
+            scalar = maps[k]
             hdr.set_data_shape(np.shape(scalar))
-            nb.Nifti1Image(scalar.astype(np.float32),
-                           affine, hdr).to_filename(self._gen_filename(k))
+            nb.Nifti1Image(scalar, affine,
+                           hdr).to_filename(self._gen_filename(k))
 
         return runtime
 
@@ -169,6 +174,9 @@ class EstimateResponseSHInputSpec(DipyBaseInterfaceInputSpec):
     response = File(
         'response.txt', usedefault=True, desc=('the output response file'))
     out_mask = File('wm_mask.nii.gz', usedefault=True, desc='computed wm mask')
+    n_procs = traits.Int(0, usedefault=True, nohash=True,
+                         desc=('number of processes used by the recursive '
+                               'response estimation (0: all the CPUs)'))
 
 
 class EstimateResponseSHOutputSpec(TraitedSpec):
@@ -207,24 +215,27 @@ class EstimateResponseSH(DipyDiffusionInterface):
 
         img = nb.load(self.inputs.in_file)
         affine = img.get_affine()
+        data = slab_source(self.inputs.in_file)
 
         if isdefined(self.inputs.in_mask):
             msk = nb.load(self.inputs.in_mask).get_data()
             msk[msk > 0] = 1
             msk[msk < 0] = 0
         else:
-            msk = np.ones(imref.get_shape())
+            msk = np.ones(data.shape[:3])
 
-        data = img.get_data().astype(np.float32)
         gtab = self._get_gradient_table()
 
         evals = np.nan_to_num(nb.load(self.inputs.in_evals).get_data())
         FA = np.nan_to_num(fractional_anisotropy(evals)) * msk
         indices = np.where(FA > self.inputs.fa_thresh)
-        S0s = data[indices][:, np.nonzero(gtab.b0s_mask)[0]]
+        S0s = np.stack([
+            np.asanyarray(data[..., int(i)], dtype=np.float32)[indices]
+            for i in np.nonzero(gtab.b0s_mask)[0]], axis=-1)
         S0 = np.mean(S0s)
 
         if self.inputs.auto:
+            # auto_response only reads the ROI at the center of the volume
             response, ratio = auto_response(gtab, data,
                                             roi_radius=self.inputs.roi_radius,
                                             fa_thr=self.inputs.fa_thresh)
@@ -238,7 +249,9 @@ class EstimateResponseSH(DipyDiffusionInterface):
                                           peak_thr=0.01, init_fa=0.08,
                                           init_trace=0.0021, iter=8,
                                           convergence=0.001,
-                                          parallel=True)
+                                          parallel=self.inputs.n_procs != 1,
+                                          nbr_processes=(self.inputs.n_procs or
+                                                         None))
             ratio = abs(response[1] / response[0])
         else:
             lambdas = evals[indices]
@@ -317,7 +330,7 @@ class CSD(DipyDiffusionInterface):
         from dipy.reconst.csdeconv import ConstrainedSphericalDeconvModel
         from dipy.data import get_sphere
         # import marshal as pickle
-        import cPickle as pickle
+        from ...external.six.moves import cPickle as pickle
         import gzip
 
         img = nb.load(self.inputs.in_file)
@@ -329,7 +342,7 @@ class CSD(DipyDiffusionInterface):
         else:
             msk = np.ones(imref.get_shape())
 
-        data = img.get_data().astype(np.float32)
+        data = slab_source(self.inputs.in_file)
         hdr = imref.get_header().copy()
 
         gtab = self._get_gradient_table()
@@ -345,17 +358,17 @@ class CSD(DipyDiffusionInterface):
         csd_model = ConstrainedSphericalDeconvModel(
             gtab, response, sh_order=self.inputs.sh_order)
 
-        IFLOGGER.info('Fitting CSD model')
-        csd_fit = csd_model.fit(data, msk)
-
         f = gzip.open(self._gen_filename('csdmodel', ext='.pklz'), 'wb')
         pickle.dump(csd_model, f, -1)
         f.close()
 
+        # Only the fODFs are kept from the fit
         if self.inputs.save_fods:
+            IFLOGGER.info('Fitting CSD model')
             sphere = get_sphere('symmetric724')
-            fods = csd_fit.odf(sphere)
-            nb.Nifti1Image(fods.astype(np.float32), img.get_affine(),
+            fods = self._fit_slabs(csd_model, data, msk,
+                                   partial(_fod_maps, sphere=sphere))['fods']
+            nb.Nifti1Image(fods, img.get_affine(),
                            None).to_filename(self._gen_filename('fods'))
 
         return runtime
@@ -366,3 +379,13 @@ class CSD(DipyDiffusionInterface):
         if self.inputs.save_fods:
             outputs['out_fods'] = self._gen_filename('fods')
         return outputs
+
+
+def _restore_maps(fit):
+    """ Maps of the tensors fitted by :class:`RESTORE` """
+    return dict([(k, getattr(fit, k)) for k in RESTOREOutputSpec().get()])
+
+
+def _fod_maps(fit, sphere):
+    """ fODFs of the fit of :class:`CSD`, sampled on ``sphere`` """
+    return {'fods': fit.odf(sphere)}
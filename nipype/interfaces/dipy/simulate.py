@@ -7,11 +7,11 @@
 """
 
 from __future__ import division
-from multiprocessing import (Pool, cpu_count)
+from multiprocessing import (Pool, cpu_count, RawArray)
 import os.path as op
 from builtins import range
 
-
+import numpy as np
 import nibabel as nb
 
 from ..base import (traits, TraitedSpec, BaseInterfaceInputSpec,
@@ -88,6 +88,7 @@ class SimulateMultiTensor(DipyBaseInterface):
     """
     input_spec = SimulateMultiTensorInputSpec
     output_spec = SimulateMultiTensorOutputSpec
+    _batch_values = 2 ** 20
 
     def _run_interface(self, runtime):
         from dipy.core.gradients import gradient_table
@@ -178,70 +179,62 @@ class SimulateMultiTensor(DipyBaseInterface):
         fracs = fractions[msk > 0]
 
         # Stack directions
-        dirs = None
+        sticks = np.zeros((nvox, nsticks, 3))
         for i in range(nsticks):
             f = self.inputs.in_dirs[i]
-            fd = np.nan_to_num(nb.load(f).get_data())
-            w = np.linalg.norm(fd, axis=3)[..., np.newaxis]
-            w[w < np.finfo(float).eps] = 1.0
-            fd /= w
-            if dirs is None:
-                dirs = fd[msk > 0].copy()
-            else:
-                dirs = np.hstack((dirs, fd[msk > 0]))
-
-        # Add random directions for isotropic components
-        for d in range(nballs):
-            fd = np.random.randn(nvox, 3)
-            w = np.linalg.norm(fd, axis=1)
-            fd[w < np.finfo(float).eps, ...] = np.array([1., 0., 0.])
+            fd = np.nan_to_num(nb.load(f).get_data())[msk > 0]
+            w = np.linalg.norm(fd, axis=1)[..., np.newaxis]
             w[w < np.finfo(float).eps] = 1.0
-            fd /= w[..., np.newaxis]
-            dirs = np.hstack((dirs, fd))
-
-        sf_evals = list(self.inputs.diff_sf)
-        ba_evals = list(self.inputs.diff_iso)
-
-        mevals = [sf_evals] * nsticks + \
-            [[ba_evals[d]] * 3 for d in range(nballs)]
+            sticks[:, i, :] = fd / w
 
         b0 = b0_im.get_data()[msk > 0]
-        args = []
-        for i in range(nvox):
-            args.append(
-                {'fractions': fracs[i, ...].tolist(),
-                 'sticks': [tuple(dirs[i, j:j + 3])
-                            for j in range(nsticks + nballs)],
-                 'gradients': gtab,
-                 'mevals': mevals,
-                 'S0': b0[i],
-                 'snr': self.inputs.snr
-                 })
 
         n_proc = self.inputs.n_proc
         if n_proc == 0:
             n_proc = cpu_count()
 
-        try:
-            pool = Pool(processes=n_proc, maxtasksperchild=50)
-        except TypeError:
-            pool = Pool(processes=n_proc)
+        # Voxels are simulated in blocks, written into shared memory
+        nchunk = int(max(1, self._batch_values //
+                         (ndirs * fracs.shape[1])))
+        starts = list(range(0, nvox, nchunk))
+        seeds = np.random.randint(2 ** 31 - 1, size=len(starts))
+        chunks = [(start, fracs[start:start + nchunk],
+                   sticks[start:start + nchunk], b0[start:start + nchunk],
+                   seed) for start, seed in zip(starts, seeds)]
+        output = RawArray('f', nvox * ndirs)
+        initargs = (gtab.bvals, gtab.bvecs, list(self.inputs.diff_sf),
+                    list(self.inputs.diff_iso)[:nballs], self.inputs.snr,
+                    output)
 
         # Simulate sticks using dipy
         IFLOGGER.info(('Starting simulation of %d voxels, %d diffusion'
-                       ' directions.') % (len(args), ndirs))
-        result = np.array(pool.map(_compute_voxel, args))
-        if np.shape(result)[1] != ndirs:
-            raise RuntimeError(('Computed directions do not match number'
-                                'of b-values.'))
-
-        signal = np.zeros((shape[0], shape[1], shape[2], ndirs))
-        signal[msk > 0] = result
+                       ' directions.') % (nvox, ndirs))
+        if n_proc == 1 or len(chunks) == 1:
+            _init_simulation(*initargs)
+            for chunk in chunks:
+                _compute_voxels(chunk)
+        else:
+            try:
+                pool = Pool(processes=n_proc, initializer=_init_simulation,
+                            initargs=initargs, maxtasksperchild=50)
+            except TypeError:
+                pool = Pool(processes=n_proc, initializer=_init_simulation,
+                            initargs=initargs)
+            try:
+                pool.map(_compute_voxels, chunks)
+            finally:
+                pool.terminate()
+                pool.join()
+
+        signal = np.zeros((shape[0], shape[1], shape[2], ndirs),
+                          dtype=np.float32)
+        signal[msk > 0] = np.frombuffer(output, dtype=np.float32).reshape(
+            nvox, ndirs)
 
         simhdr = hdr.copy()
         simhdr.set_data_dtype(np.float32)
         simhdr.set_xyzt_units('mm', 'sec')
-        nb.Nifti1Image(signal.astype(np.float32), aff,
+        nb.Nifti1Image(signal, aff,
                        simhdr).to_filename(op.abspath(self.inputs.out_file))
 
         return runtime
@@ -256,14 +249,92 @@ class SimulateMultiTensor(DipyBaseInterface):
         return outputs
 
 
-def _compute_voxel(args):
+_SIMULATION = {}
+
+
+def _init_simulation(bvals, bvecs, sf_evals, iso_evals, snr, output):
+    """
+    Set the gradient table, compartments and output shared by all the blocks
+    of voxels simulated in one process
+    """
+    _SIMULATION.update(bvals=np.asarray(bvals, dtype=np.float64),
+                       bvecs=np.asarray(bvecs, dtype=np.float64),
+                       sf_evals=sf_evals, iso_evals=iso_evals, snr=snr,
+                       output=output)
+
+
+def _compute_voxels(args):
+    """
+    Simulate a block of voxels, writing the signal into the shared output
+    """
+    start, fractions, sticks, S0, seed = args
+    sim = _SIMULATION
+    ndirs = len(sim['bvals'])
+    output = np.frombuffer(sim['output'], dtype=np.float32).reshape(-1, ndirs)
+    output[start:start + len(S0)] = multi_tensor_signal(
+        sim['bvals'], sim['bvecs'], fractions, sticks, S0, sim['sf_evals'],
+        sim['iso_evals'], snr=sim['snr'], rng=np.random.RandomState(seed))
+
+
+def _tensor_evecs(e0):
+    """
+    Second and third eigenvectors of the tensors with principal directions
+    ``e0`` (..., 3), as returned by :func:`dipy.sims.voxel.all_tensor_evecs`
+    """
+    vx, vy, vz = e0[..., 0], e0[..., 1], e0[..., 2]
+    wn2 = vy ** 2 + vz ** 2
+    with np.errstate(invalid='ignore', divide='ignore'):
+        sina = np.sqrt(1. - vx ** 2)
+        e1 = np.stack((-sina * vy, vx * vy ** 2 + vz ** 2,
+                       vy * vz * (vx - 1.)), axis=-1)
+        e2 = np.stack((-sina * vz, vy * vz * (vx - 1.),
+                       vx * vz ** 2 + vy ** 2), axis=-1)
+        e1[..., 0] /= np.sqrt(wn2)
+        e2[..., 0] /= np.sqrt(wn2)
+        e1[..., 1:] /= wn2[..., np.newaxis]
+        e2[..., 1:] /= wn2[..., np.newaxis]
+    # Collinear directions leave the y and z axes unrotated
+    degenerate = ((np.sqrt(wn2) < np.finfo(float).eps) |
+                  np.any(np.isnan(e1), axis=-1) |
+                  np.any(np.isnan(e2), axis=-1))
+    e1[degenerate] = [0., 1., 0.]
+    e2[degenerate] = [0., 0., 1.]
+    return e1, e2
+
+
+def multi_tensor_signal(bvals, bvecs, fractions, sticks, S0, sf_evals,
+                        iso_evals, snr=0, rng=None):
     """
-    Simulate DW signal for one voxel. Uses the multi-tensor model and
-    three isotropic compartments.
+    Simulate DW signal for a block of voxels. Uses the multi-tensor model
+    (see :func:`dipy.sims.voxel.multi_tensor`) with one tensor per stick and
+    isotropic compartments.
 
     Apparent diffusivity tensors are taken from [Alexander2002]_
     and [Pierpaoli1996]_.
 
+    Parameters
+    ----------
+    bvals : array (ndirs,)
+    bvecs : array (ndirs, 3)
+    fractions : array (nvox, nsticks + nballs)
+        Volume fractions of the sticks followed by those of the isotropic
+        compartments. Voxels with no volume get no signal.
+    sticks : array (nvox, nsticks, 3)
+        Principal directions of the sticks
+    S0 : array (nvox,)
+        Unweighted signal
+    sf_evals : sequence of 3 floats
+        Eigenvalues of the stick tensor
+    iso_evals : sequence of nballs floats
+        Diffusivities of the isotropic compartments
+    snr : float
+        If positive, Rician noise with sigma ``S0 / snr`` is added
+    rng : numpy.random.RandomState
+
+    Returns
+    -------
+    signal : float32 array (nvox, ndirs)
+
     .. [Alexander2002] Alexander et al., Detection and modeling of non-Gaussian
       apparent diffusion coefficient profiles in human brain data, MRM
       48(2):331-340, 2002, doi: `10.1002/mrm.10209
@@ -271,27 +342,36 @@ def _compute_voxel(args):
     .. [Pierpaoli1996] Pierpaoli et al., Diffusion tensor MR imaging
       of the human brain, Radiology 201:637-648. 1996.
     """
-    from dipy.sims.voxel import multi_tensor
-
-    ffs = args['fractions']
-    gtab = args['gradients']
-    signal = np.zeros_like(gtab.bvals, dtype=np.float32)
-
-    # Simulate dwi signal
-    sf_vf = np.sum(ffs)
-    if sf_vf > 0.0:
-        ffs = ((np.array(ffs) / sf_vf) * 100)
-        snr = args['snr'] if args['snr'] > 0 else None
-
-        try:
-            signal, _ = multi_tensor(
-                gtab, args['mevals'], S0=args['S0'],
-                angles=args['sticks'], fractions=ffs, snr=snr)
-        except Exception as e:
-            pass
-            # IFLOGGER.warn('Exception simulating dwi signal: %s' % e)
-
-    return signal.tolist()
+    fractions = np.asarray(fractions, dtype=np.float64)
+    S0 = np.asarray(S0, dtype=np.float64)
+    nsticks = sticks.shape[1]
+    total = fractions.sum(axis=1)
+    valid = total > 0.0
+    weights = fractions[valid] / total[valid, np.newaxis]
+
+    # b * g' D g for every voxel, compartment and gradient
+    e0 = sticks[valid]
+    e1, e2 = _tensor_evecs(e0)
+    adc = sum(evals * np.dot(evecs, bvecs.T) ** 2
+              for evals, evecs in zip(sf_evals, (e0, e1, e2)))
+    attenuation = np.einsum('vk,vkn->vn', weights[:, :nsticks],
+                            np.exp(-bvals * adc))
+    norms = (bvecs ** 2).sum(axis=1)
+    for i, diff in enumerate(iso_evals):
+        attenuation += (weights[:, nsticks + i, np.newaxis] *
+                        np.exp(-bvals * diff * norms))
+
+    signal = S0[valid, np.newaxis] * attenuation
+    if snr > 0:
+        if rng is None:
+            rng = np.random
+        sigma = S0[valid, np.newaxis] / snr
+        signal = np.sqrt((signal + sigma * rng.standard_normal(signal.shape)) ** 2 +
+                         (sigma * rng.standard_normal(signal.shape)) ** 2)
+
+    out = np.zeros((len(S0), len(bvals)), dtype=np.float32)
+    out[valid] = signal
+    return out
 
 
 def _generate_gradients(ndirs=64, values=[1000, 3000], nb0s=1):
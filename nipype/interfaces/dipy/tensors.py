@@ -5,10 +5,12 @@
    >>> datadir = os.path.realpath(os.path.join(filepath, '../../testing/data'))
    >>> os.chdir(datadir)
 """
+import numpy as np
 import nibabel as nb
 
 from ..base import TraitedSpec, File, isdefined
 from .base import DipyDiffusionInterface, DipyBaseInterfaceInputSpec
+from ...utils.filemanip import slab_source
 
 from ... import logging
 IFLOGGER = logging.getLogger('interface')
@@ -50,7 +52,7 @@ class DTI(DipyDiffusionInterface):
         gtab = self._get_gradient_table()
 
         img = nb.load(self.inputs.in_file)
-        data = img.get_data()
+        data = slab_source(self.inputs.in_file)
         affine = img.affine
         mask = None
         if isdefined(self.inputs.mask_file):
@@ -58,18 +60,16 @@ class DTI(DipyDiffusionInterface):
 
         # Fit it
         tenmodel = dti.TensorModel(gtab)
-        ten_fit = tenmodel.fit(data, mask)
-        lower_triangular = ten_fit.lower_triangular()
-        img = nifti1_symmat(lower_triangular, affine)
+        maps = self._fit_slabs(tenmodel, data, mask, _dti_maps)
+        img = nifti1_symmat(maps['dti'], affine)
         out_file = self._gen_filename('dti')
         nb.save(img, out_file)
         IFLOGGER.info('DTI parameters image saved as {i}'.format(i=out_file))
 
         #FA MD RD and AD
         for metric in ["fa", "md", "rd", "ad"]:
-            data = getattr(ten_fit,metric).astype("float32")
             out_name = self._gen_filename(metric)
-            nb.Nifti1Image(data, affine).to_filename(out_name)
+            nb.Nifti1Image(maps[metric], affine).to_filename(out_name)
             IFLOGGER.info('DTI {metric} image saved as {i}'.format(i=out_name, metric=metric))
 
         return runtime
@@ -124,7 +124,7 @@ class TensorMode(DipyDiffusionInterface):
 
         # Load the 4D image files
         img = nb.load(self.inputs.in_file)
-        data = img.get_data()
+        data = slab_source(self.inputs.in_file)
         affine = img.get_affine()
 
         # Load the gradient strengths and directions
@@ -132,14 +132,12 @@ class TensorMode(DipyDiffusionInterface):
 
         # Mask the data so that tensors are not fit for
         # unnecessary voxels
-        mask = data[..., 0] > 50
+        mask = np.asanyarray(data[..., 0]) > 50
 
-        # Fit the tensors to the data
+        # Fit the tensors to the data and calculate the mode of each
+        # voxel's tensor
         tenmodel = dti.TensorModel(gtab)
-        tenfit = tenmodel.fit(data, mask)
-
-        # Calculate the mode of each voxel's tensor
-        mode_data = tenfit.mode
+        mode_data = self._fit_slabs(tenmodel, data, mask, _mode_maps)['mode']
 
         # Write as a 3D Nifti image with the original affine
         img = nb.Nifti1Image(mode_data, affine)
@@ -152,3 +150,16 @@ class TensorMode(DipyDiffusionInterface):
         outputs = self._outputs().get()
         outputs['out_file'] = self._gen_filename('mode')
         return outputs
+
+
+def _dti_maps(fit):
+    """ Tensor parameters and scalar maps computed by :class:`DTI` """
+    maps = dict([(metric, getattr(fit, metric))
+                 for metric in ["fa", "md", "rd", "ad"]])
+    maps['dti'] = fit.lower_triangular()
+    return maps
+
+
+def _mode_maps(fit):
+    """ Tensor mode computed by :class:`TensorMode` """
+    return {'mode': fit.mode}
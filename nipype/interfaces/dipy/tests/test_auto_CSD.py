@@ -16,6 +16,9 @@ def test_CSD_inputs():
     in_file=dict(mandatory=True,
     ),
     in_mask=dict(),
+    n_procs=dict(nohash=True,
+    usedefault=True,
+    ),
     out_fods=dict(),
     out_prefix=dict(),
     response=dict(),
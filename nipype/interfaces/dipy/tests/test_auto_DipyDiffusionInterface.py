@@ -15,6 +15,9 @@ def test_DipyDiffusionInterface_inputs():
     ),
     in_file=dict(mandatory=True,
     ),
+    n_procs=dict(nohash=True,
+    usedefault=True,
+    ),
     out_prefix=dict(),
     )
     inputs = DipyDiffusionInterface.input_spec()
@@ -23,6 +23,9 @@ def test_EstimateResponseSH_inputs():
     in_file=dict(mandatory=True,
     ),
     in_mask=dict(),
+    n_procs=dict(nohash=True,
+    usedefault=True,
+    ),
     out_mask=dict(usedefault=True,
     ),
     out_prefix=dict(),
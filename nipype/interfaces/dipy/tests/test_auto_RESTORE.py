@@ -16,6 +16,9 @@ def test_RESTORE_inputs():
     in_file=dict(mandatory=True,
     ),
     in_mask=dict(),
+    n_procs=dict(nohash=True,
+    usedefault=True,
+    ),
     noise_mask=dict(),
     out_prefix=dict(),
     )
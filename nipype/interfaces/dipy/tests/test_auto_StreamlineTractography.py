@@ -27,6 +27,8 @@ def test_StreamlineTractography_inputs():
     peak_threshold=dict(mandatory=True,
     usedefault=True,
     ),
+    peaks_cache_dir=dict(nohash=True,
+    ),
     save_seeds=dict(mandatory=True,
     usedefault=True,
     ),
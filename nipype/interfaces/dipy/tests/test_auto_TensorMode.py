@@ -16,6 +16,9 @@ def test_TensorMode_inputs():
     in_file=dict(mandatory=True,
     ),
     mask_file=dict(),
+    n_procs=dict(nohash=True,
+    usedefault=True,
+    ),
     out_prefix=dict(),
     )
     inputs = TensorMode.input_spec()
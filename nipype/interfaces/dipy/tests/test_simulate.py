@@ -0,0 +1,49 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+
+from nipype.testing import assert_equal, assert_almost_equal, skipif
+from nipype.interfaces.dipy.base import no_dipy
+from nipype.interfaces.dipy.simulate import multi_tensor_signal
+
+
+@skipif(no_dipy)
+def test_multi_tensor_signal():
+    from dipy.core.gradients import gradient_table
+    from dipy.sims.voxel import multi_tensor
+
+    rng = np.random.RandomState(0)
+    bvecs = rng.randn(20, 3)
+    bvecs /= np.linalg.norm(bvecs, axis=1)[:, np.newaxis]
+    bvecs[0] = 0
+    bvals = np.r_[0, [1000] * 10, [3000] * 9]
+    gtab = gradient_table(bvals, bvecs)
+
+    sticks = rng.randn(30, 2, 3)
+    sticks /= np.linalg.norm(sticks, axis=2)[..., np.newaxis]
+    sticks[0, 0] = [1., 0., 0.]
+    sticks[1, 1] = [-1., 0., 0.]
+    fractions = rng.rand(30, 4)
+    fractions[2] = 0
+    S0 = rng.rand(30) * 1000
+    sf_evals = [1700e-6, 300e-6, 200e-6]
+    iso_evals = [3000e-6, 960e-6]
+
+    signal = multi_tensor_signal(bvals, bvecs, fractions, sticks, S0,
+                                 sf_evals, iso_evals)
+    yield assert_equal, signal.dtype, np.float32
+    yield assert_equal, signal[2].tolist(), [0.] * 20
+    mevals = [sf_evals] * 2 + [[d] * 3 for d in iso_evals]
+    angles = [(1., 0., 0.)] * 4
+    for i in (0, 1, 3, 29):
+        angles[:2] = sticks[i]
+        expected, _ = multi_tensor(
+            gtab, mevals, S0=S0[i], angles=angles, snr=None,
+            fractions=fractions[i] / fractions[i].sum() * 100)
+        yield assert_almost_equal, signal[i] / S0[i], expected / S0[i], 6
+
+    noisy = multi_tensor_signal(bvals, bvecs, fractions, sticks, S0,
+                                sf_evals, iso_evals, snr=20,
+                                rng=np.random.RandomState(0))
+    yield assert_equal, noisy[2].tolist(), [0.] * 20
+    yield assert_equal, np.all(noisy >= 0), True
+    yield assert_equal, np.allclose(noisy, signal), False
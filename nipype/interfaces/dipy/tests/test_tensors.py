@@ -0,0 +1,75 @@
+# -*- coding: utf-8 -*-
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+import nibabel as nb
+
+from nipype.testing import assert_equal, skipif
+from nipype.interfaces.dipy.base import no_dipy
+from nipype.interfaces.dipy.simulate import multi_tensor_signal
+
+
+def _write_dwi(tempdir, ext='.nii'):
+    rng = np.random.RandomState(0)
+    bvecs = rng.randn(22, 3)
+    bvecs /= np.linalg.norm(bvecs, axis=1)[:, np.newaxis]
+    bvecs[:2] = 0
+    bvals = np.r_[0, 0, [1000] * 20]
+    np.savetxt(os.path.join(tempdir, 'bvals'), bvals[np.newaxis])
+    np.savetxt(os.path.join(tempdir, 'bvecs'), bvecs.T)
+
+    shape = (6, 5, 7)
+    nvox = int(np.prod(shape))
+    sticks = rng.randn(nvox, 1, 3)
+    sticks /= np.linalg.norm(sticks, axis=2)[..., np.newaxis]
+    fractions = np.ones((nvox, 2))
+    fractions[:, 0] = rng.rand(nvox)
+    fractions[:, 1] -= fractions[:, 0]
+    signal = multi_tensor_signal(bvals, bvecs, fractions, sticks,
+                                 np.ones(nvox) * 1000, (1700e-6, 200e-6,
+                                                        200e-6), [3000e-6],
+                                 snr=30, rng=rng).reshape(shape + (-1,))
+    in_file = os.path.join(tempdir, 'dwi' + ext)
+    nb.Nifti1Image(signal, np.eye(4)).to_filename(in_file)
+
+    mask = np.ones(shape, dtype=np.uint8)
+    mask[0] = 0
+    mask_file = os.path.join(tempdir, 'mask.nii')
+    nb.Nifti1Image(mask, np.eye(4)).to_filename(mask_file)
+    return in_file, mask_file
+
+
+@skipif(no_dipy)
+def test_dti_slabs():
+    from dipy.core.gradients import gradient_table
+    from dipy.reconst.dti import TensorModel
+    from nipype.interfaces.dipy import DTI
+
+    tempdir = mkdtemp()
+    for ext in ('.nii', '.nii.gz'):
+        in_file, mask_file = _write_dwi(tempdir, ext)
+        gtab = gradient_table(np.loadtxt(os.path.join(tempdir, 'bvals')),
+                              np.loadtxt(os.path.join(tempdir, 'bvecs')).T)
+        expected = TensorModel(gtab).fit(
+            nb.load(in_file).get_data(), nb.load(mask_file).get_data())
+
+        for n_procs in (1, 2):
+            dti = DTI(in_file=in_file, mask_file=mask_file,
+                      in_bval=os.path.join(tempdir, 'bvals'),
+                      in_bvec=os.path.join(tempdir, 'bvecs'),
+                      out_prefix=os.path.join(tempdir, 'p%d' % n_procs),
+                      n_procs=n_procs)
+            # Three slabs of two slices, and the last one
+            dti._slab_values = 2 * 6 * 5 * 22
+            res = dti.run()
+
+            fa = nb.load(res.outputs.fa_file).get_data()
+            yield assert_equal, fa.dtype, np.float32
+            yield (assert_equal, fa.tolist(),
+                   expected.fa.astype(np.float32).tolist())
+            tensor = nb.load(res.outputs.out_file).get_data()
+            yield (assert_equal, np.squeeze(tensor).tolist(),
+                   expected.lower_triangular().astype(np.float32).tolist())
+    rmtree(tempdir)
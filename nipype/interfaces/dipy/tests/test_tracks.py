@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import os
+import gzip
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import numpy as np
+
+from nipype.testing import assert_equal, assert_raises, skipif
+from nipype.interfaces.dipy.base import no_dipy
+from nipype.interfaces.dipy.tests.test_tensors import _write_dwi
+
+
+@skipif(no_dipy)
+def test_streamline_peaks_cache():
+    from dipy.core.gradients import gradient_table
+    from dipy.reconst.csdeconv import ConstrainedSphericalDeconvModel
+    import dipy.reconst.peaks as dpk
+    from nipype.external.six.moves import cPickle as pickle
+    from nipype.interfaces.dipy import StreamlineTractography
+
+    tempdir = mkdtemp()
+    in_file, _ = _write_dwi(tempdir)
+    gtab = gradient_table(np.loadtxt(os.path.join(tempdir, 'bvals')),
+                          np.loadtxt(os.path.join(tempdir, 'bvecs')).T)
+    model = ConstrainedSphericalDeconvModel(
+        gtab, (np.array([1700e-6, 200e-6, 200e-6]), 1000.), sh_order=4)
+    in_model = os.path.join(tempdir, 'model.pklz')
+    f = gzip.open(in_model, 'wb')
+    pickle.dump(model, f, -1)
+    f.close()
+
+    cache_dir = os.path.join(tempdir, 'cache')
+    track = StreamlineTractography(
+        in_file=in_file, in_model=in_model, peaks_cache_dir=cache_dir,
+        num_seeds=20, multiprocess=False,
+        out_prefix=os.path.join(tempdir, 'first'))
+    peaks_file = track.run().outputs.odf_peaks
+    yield assert_equal, len(os.listdir(cache_dir)), 1
+
+    peaks = np.load(peaks_file)
+    yield assert_equal, peaks['peak_indices'].dtype, np.int16
+    yield assert_equal, peaks['peak_dirs'].dtype, np.float32
+    yield assert_equal, str(peaks['sphere']), 'symmetric724'
+    yield assert_equal, float(peaks['relative_peak_threshold']), 0.5
+    yield assert_equal, peaks['gfa'].shape, (6, 5, 7)
+
+    # A second run with other seeds must not extract the peaks again
+    peaks_from_model = dpk.peaks_from_model
+
+    def _no_peaks(*args, **kwargs):
+        raise RuntimeError('peaks were not reused')
+
+    dpk.peaks_from_model = _no_peaks
+    try:
+        track.inputs.num_seeds = 30
+        track.inputs.out_prefix = os.path.join(tempdir, 'second')
+        cached = np.load(track.run().outputs.odf_peaks)
+        yield (assert_equal, cached['peak_indices'].tolist(),
+               peaks['peak_indices'].tolist())
+
+        track.inputs.peak_threshold = 0.4
+        track.inputs.out_prefix = os.path.join(tempdir, 'third')
+        yield assert_raises, RuntimeError, track.run
+    finally:
+        dpk.peaks_from_model = peaks_from_model
+    rmtree(tempdir)
@@ -6,14 +6,18 @@ Change directory to provide relative paths for doctests
    >>> datadir = os.path.realpath(os.path.join(filepath, '../../testing/data'))
    >>> os.chdir(datadir)
 """
+import os
 import os.path as op
+import hashlib
+
 import numpy as np
 import nibabel as nb
 import nibabel.trackvis as nbt
 
 from ..base import (TraitedSpec, BaseInterfaceInputSpec,
-                    File, isdefined, traits)
+                    File, Directory, isdefined, traits)
 from .base import DipyBaseInterface
+from ...utils.filemanip import copyfile, hash_infile, publish_file
 from ... import logging
 IFLOGGER = logging.getLogger('interface')
 
@@ -110,7 +114,16 @@ class StreamlineTractographyInputSpec(BaseInterfaceInputSpec):
                          desc=('input mask within which perform tracking'))
     seed_mask = File(exists=True,
                      desc=('input mask within which perform seeding'))
-    in_peaks = File(exists=True, desc=('peaks computed from the odf'))
+    in_peaks = File(exists=True,
+                    desc=('peaks computed from the odf (.npz, or .pklz as '
+                          'written by previous versions)'))
+    peaks_cache_dir = Directory(nohash=True,
+                                desc=('Directory where the peaks are kept, '
+                                      'keyed by the contents of in_file and '
+                                      'in_model and by the peak extraction '
+                                      'parameters, so that they are not '
+                                      'computed again when only the seeding '
+                                      'changes'))
     seed_coord = File(exists=True,
                       desc=('file containing the list of seed voxel '
                             'coordinates (N,3)'))
@@ -134,7 +147,7 @@ class StreamlineTractographyOutputSpec(TraitedSpec):
     tracks = File(desc='TrackVis file containing extracted streamlines')
     gfa = File(desc=('The resulting GFA (generalized FA) computed using the '
                      'peaks of the ODF'))
-    odf_peaks = File(desc=('peaks computed from the odf'))
+    odf_peaks = File(desc=('peaks computed from the odf (.npz)'))
     out_seeds = File(desc=('file containing the (N,3) *voxel* coordinates used'
                            ' in seeding.'))
 
@@ -160,12 +173,25 @@ class StreamlineTractography(DipyBaseInterface):
     input_spec = StreamlineTractographyInputSpec
     output_spec = StreamlineTractographyOutputSpec
 
+    _sphere = 'symmetric724'
+
+    def _cache_file(self):
+        """Return the path of the peaks in the cache directory"""
+        from dipy import __version__ as dipy_version
+        key = [dipy_version, self._sphere,
+               hash_infile(self.inputs.in_file, crypto=hashlib.sha1),
+               hash_infile(self.inputs.in_model, crypto=hashlib.sha1),
+               self.inputs.peak_threshold, self.inputs.min_angle]
+        key = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return op.join(op.abspath(self.inputs.peaks_cache_dir),
+                       key + '_peaks.npz')
+
     def _run_interface(self, runtime):
         from dipy.reconst.peaks import peaks_from_model
         from dipy.tracking.eudx import EuDX
         from dipy.data import get_sphere
         # import marshal as pickle
-        import cPickle as pickle
+        from ...external.six.moves import cPickle as pickle
         import gzip
 
         if (not (isdefined(self.inputs.in_model) or
@@ -174,43 +200,55 @@ class StreamlineTractography(DipyBaseInterface):
                                 'be supplied'))
 
         img = nb.load(self.inputs.in_file)
-        imref = nb.four_to_three(img)[0]
         affine = img.get_affine()
 
-        data = img.get_data().astype(np.float32)
-        hdr = imref.get_header().copy()
+        hdr = img.get_header().copy()
         hdr.set_data_dtype(np.float32)
         hdr['data_type'] = 16
 
-        sphere = get_sphere('symmetric724')
+        sphere = get_sphere(self._sphere)
 
         self._save_peaks = False
         if isdefined(self.inputs.in_peaks):
             IFLOGGER.info('Peaks file found, skipping ODF peaks search...')
-            f = gzip.open(self.inputs.in_peaks, 'rb')
-            peaks = pickle.load(f)
-            f.close()
+            peaks = load_peaks(self.inputs.in_peaks)
         else:
             self._save_peaks = True
-            IFLOGGER.info('Loading model and computing ODF peaks')
-            f = gzip.open(self.inputs.in_model, 'rb')
-            odf_model = pickle.load(f)
-            f.close()
-
-            peaks = peaks_from_model(
-                model=odf_model,
-                data=data,
-                sphere=sphere,
-                relative_peak_threshold=self.inputs.peak_threshold,
-                min_separation_angle=self.inputs.min_angle,
-                parallel=self.inputs.multiprocess)
-
-            f = gzip.open(self._gen_filename('peaks', ext='.pklz'), 'wb')
-            pickle.dump(peaks, f, -1)
-            f.close()
-
-        hdr.set_data_shape(peaks.gfa.shape)
-        nb.Nifti1Image(peaks.gfa.astype(np.float32), affine,
+            out_peaks = self._gen_filename('peaks', ext='.npz')
+            cache_file = None
+            if isdefined(self.inputs.peaks_cache_dir):
+                cache_file = self._cache_file()
+
+            if cache_file is not None and op.exists(cache_file):
+                IFLOGGER.info('Cached peaks found, skipping ODF peaks '
+                              'search...')
+                copyfile(cache_file, out_peaks, copy=True, use_hardlink=True)
+            else:
+                IFLOGGER.info('Loading model and computing ODF peaks')
+                f = gzip.open(self.inputs.in_model, 'rb')
+                odf_model = pickle.load(f)
+                f.close()
+
+                peaks = peaks_from_model(
+                    model=odf_model,
+                    data=img.get_data().astype(np.float32),
+                    sphere=sphere,
+                    relative_peak_threshold=self.inputs.peak_threshold,
+                    min_separation_angle=self.inputs.min_angle,
+                    parallel=self.inputs.multiprocess)
+                save_peaks(out_peaks, peaks, sphere=self._sphere,
+                           relative_peak_threshold=self.inputs.peak_threshold,
+                           min_separation_angle=self.inputs.min_angle)
+                del peaks
+
+                if cache_file is not None:
+                    publish_file(cache_file, lambda tmp_file: copyfile(
+                        out_peaks, tmp_file, copy=True))
+            peaks = load_peaks(out_peaks)
+
+        gfa = np.asanyarray(peaks['gfa'])
+        hdr.set_data_shape(gfa.shape)
+        nb.Nifti1Image(gfa.astype(np.float32), affine,
                        hdr).to_filename(self._gen_filename('gfa'))
 
         IFLOGGER.info('Performing tractography')
@@ -220,9 +258,9 @@ class StreamlineTractography(DipyBaseInterface):
             msk[msk > 0] = 1
             msk[msk < 0] = 0
         else:
-            msk = np.ones(imref.get_shape())
+            msk = np.ones(img.shape[:3])
 
-        gfa = peaks.gfa * msk
+        gfa = gfa * msk
         seeds = self.inputs.num_seeds
 
         if isdefined(self.inputs.seed_coord):
@@ -230,7 +268,7 @@ class StreamlineTractography(DipyBaseInterface):
 
         elif isdefined(self.inputs.seed_mask):
             seedmsk = nb.load(self.inputs.seed_mask).get_data()
-            assert(seedmsk.shape == data.shape[:3])
+            assert(seedmsk.shape == img.shape[:3])
             seedmsk[seedmsk > 0] = 1
             seedmsk[seedmsk < 1] = 0
             seedps = np.array(np.where(seedmsk == 1), dtype=np.float32).T
@@ -259,7 +297,7 @@ class StreamlineTractography(DipyBaseInterface):
             a_low = self.inputs.gfa_thresh
 
         eu = EuDX(tmask,
-                  peaks.peak_indices[..., 0],
+                  peaks['peak_indices'][..., 0],
                   seeds=seeds,
                   affine=affine,
                   odf_vertices=sphere.vertices,
@@ -277,7 +315,7 @@ class StreamlineTractography(DipyBaseInterface):
         outputs['tracks'] = self._gen_filename('tracked', ext='.trk')
         outputs['gfa'] = self._gen_filename('gfa')
         if self._save_peaks:
-            outputs['odf_peaks'] = self._gen_filename('peaks', ext='.pklz')
+            outputs['odf_peaks'] = self._gen_filename('peaks', ext='.npz')
         if self.inputs.save_seeds:
             if isdefined(self.inputs.seed_coord):
                 outputs['out_seeds'] = self.inputs.seed_coord
@@ -302,3 +340,66 @@ class StreamlineTractography(DipyBaseInterface):
             ext = fext
 
         return out_prefix + '_' + name + ext
+
+
+_PEAKS_ARRAYS = ['peak_indices', 'peak_values', 'peak_dirs', 'gfa', 'qa']
+
+
+def save_peaks(out_file, peaks, sphere, **meta):
+    """
+    Writes the peaks extracted by :func:`dipy.reconst.peaks.peaks_from_model`
+    as a compressed NumPy archive, which does not depend on the Python
+    and dipy versions as pickles do
+
+    Parameters
+    ----------
+    out_file : str
+        output file name (.npz)
+    peaks : PeaksAndMetrics
+        peaks and metrics of an ODF model fit
+    sphere : str
+        name of the sphere (in :func:`dipy.data.get_sphere`) the peak
+        indices refer to
+    meta : dict
+        additional scalar parameters to be stored with the peaks
+
+    """
+    from dipy.data import get_sphere
+
+    nvertices = len(get_sphere(sphere).vertices)
+    arrays = dict([(key, np.asanyarray(getattr(peaks, key), np.float32))
+                   for key in _PEAKS_ARRAYS])
+    # GFA is kept in full precision, as it is thresholded for tracking
+    arrays['gfa'] = np.asanyarray(peaks.gfa)
+    arrays['peak_indices'] = np.asanyarray(
+        peaks.peak_indices, np.min_scalar_type(-nvertices))
+    arrays['sphere'] = np.array(sphere)
+    for key, value in list(meta.items()):
+        arrays[key] = np.array(value)
+    # np.savez_compressed appends the extension if missing
+    with open(out_file, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+
+
+def load_peaks(in_file):
+    """
+    Reads the peaks written by :func:`save_peaks`, or by previous versions
+    of :class:`StreamlineTractography` (gzipped pickle). The arrays of .npz
+    files are only read when they are accessed.
+
+    Returns
+    -------
+    peaks : dict-like
+        peak indices, values, directions, GFA and QA, by name
+
+    """
+    if in_file.endswith('.npz'):
+        return np.load(in_file)
+
+    from ...external.six.moves import cPickle as pickle
+    import gzip
+
+    f = gzip.open(in_file, 'rb')
+    peaks = pickle.load(f)
+    f.close()
+    return dict([(key, getattr(peaks, key)) for key in _PEAKS_ARRAYS])
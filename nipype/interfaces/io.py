@@ -48,22 +48,6 @@ from ..utils.misc import str2bool
 from .. import logging
 iflogger = logging.getLogger('interface')
 
-try:
-    import pyxnat
-except:
-    pass
-
-try:
-    import paramiko
-except:
-    pass
-
-try:
-    import boto
-    from boto.s3.connection import S3Connection, OrdinaryCallingFormat
-except:
-    pass
-
 
 def copytree(src, dst, use_hardlink=False):
     """Recursively copy a directory tree using
@@ -871,6 +855,7 @@ class S3DataGrabber(IOBase):
                         (self.__class__.__name__, key)
                     raise ValueError(msg)
 
+        import boto
         outputs = {}
         # get list of all files in s3 bucket
         conn = boto.connect_s3(anon=self.inputs.anon)
@@ -982,6 +967,7 @@ class S3DataGrabber(IOBase):
         localdir = os.path.split(localpath)[0]
         if not os.path.exists(localdir):
             os.makedirs(localdir)
+        import boto.s3.key
         k = boto.s3.key.Key(bkt)
         k.key = s3path
         k.get_contents_to_filename(localpath)
@@ -1739,6 +1725,7 @@ class XNATSource(IOBase):
 
         cache_dir = self.inputs.cache_dir or tempfile.gettempdir()
 
+        import pyxnat
         if self.inputs.config:
             xnat = pyxnat.Interface(config=self.inputs.config)
         else:
@@ -1901,6 +1888,7 @@ class XNATSink(IOBase):
         # setup XNAT connection
         cache_dir = self.inputs.cache_dir or tempfile.gettempdir()
 
+        import pyxnat
         if self.inputs.config:
             xnat = pyxnat.Interface(config=self.inputs.config)
         else:
@@ -2266,8 +2254,8 @@ class SSHDataGrabber(DataGrabber):
 
         """
         try:
-            paramiko
-        except NameError:
+            import paramiko
+        except ImportError:
             warn(
                 "The library paramiko needs to be installed"
                 " for this module to run."
@@ -2294,8 +2282,8 @@ class SSHDataGrabber(DataGrabber):
 
     def _list_outputs(self):
         try:
-            paramiko
-        except NameError:
+            import paramiko
+        except ImportError:
             raise ImportError(
                 "The library paramiko needs to be installed"
                 " for this module to run."
@@ -2416,6 +2404,7 @@ class SSHDataGrabber(DataGrabber):
         return outputs
 
     def _get_ssh_client(self):
+        import paramiko
         config = paramiko.SSHConfig()
         config.parse(open(os.path.expanduser('~/.ssh/config')))
         host = config.lookup(self.inputs.hostname)
@@ -25,6 +25,7 @@ if have_nipy:
 
 from ..base import (BaseInterface, TraitedSpec, traits, File, OutputMultiPath,
                     BaseInterfaceInputSpec, isdefined)
+from ...utils.filemanip import slab_source
 
 
 class FitGLMInputSpec(BaseInterfaceInputSpec):
@@ -58,6 +59,11 @@ class FitGLMInputSpec(BaseInterfaceInputSpec):
                                           usedefault=True)
     save_residuals = traits.Bool(False, usedefault=True)
     plot_design_matrix = traits.Bool(False, usedefault=True)
+    chunk_size = traits.Int(desc=("fit the model over chunks of this number "
+                                  "of voxels, instead of all at once"))
+    n_procs = traits.Int(1, usedefault=True, nohash=True,
+                         desc=("number of processes used to fit the chunks "
+                               "of voxels"))
 
 
 class FitGLMOutputSpec(TraitedSpec):
@@ -78,6 +84,7 @@ class FitGLM(BaseInterface):
     '''
     input_spec = FitGLMInputSpec
     output_spec = FitGLMOutputSpec
+    _slab_values = 2 ** 24
 
     def _run_interface(self, runtime):
 
@@ -87,25 +94,32 @@ class FitGLM(BaseInterface):
         if isinstance(functional_runs, string_types):
             functional_runs = [functional_runs]
         nii = nb.load(functional_runs[0])
-        data = nii.get_data()
 
         if isdefined(self.inputs.mask):
             mask = nb.load(self.inputs.mask).get_data() > 0
         else:
             mask = np.ones(nii.shape[:3]) == 1
 
-        timeseries = data.copy()[mask, :]
-        del data
-
-        for functional_run in functional_runs[1:]:
-            nii = nb.load(functional_run)
-            data = nii.get_data()
-            npdata = data.copy()
+        # Position of each voxel of the mask in the timeseries
+        rows = np.zeros(mask.shape, dtype=np.intp)
+        rows[mask] = np.arange(np.count_nonzero(mask))
+        runs = [nb.load(f) for f in functional_runs]
+        nscans = sum([run.shape[3] for run in runs])
+        dtype = np.result_type(*[np.asarray(run.dataobj[:1, :1, :1, :1])
+                                  for run in runs])
+        timeseries = np.empty((np.count_nonzero(mask), nscans), dtype=dtype)
+        start = 0
+        for functional_run in functional_runs:
+            data = slab_source(functional_run)
+            slab_size = int(max(1, self._slab_values //
+                                (np.prod(data.shape[:2]) * data.shape[3])))
+            for z in range(0, mask.shape[2], slab_size):
+                slab_mask = mask[:, :, z:z + slab_size]
+                timeseries[rows[:, :, z:z + slab_size][slab_mask],
+                           start:start + data.shape[3]] = \
+                    np.asarray(data[:, :, z:z + slab_size, :])[slab_mask]
+            start += data.shape[3]
             del data
-            timeseries = np.concatenate((timeseries, npdata[mask, :]), axis=1)
-            del npdata
-
-        nscans = timeseries.shape[1]
 
         if 'hpf' in list(session_info[0].keys()):
             hpf = session_info[0]['hpf']
@@ -158,34 +172,71 @@ class FitGLM(BaseInterface):
             pylab.close()
             pylab.clf()
 
-        glm = GLM.glm()
-        glm.fit(timeseries.T, design_matrix, method=self.inputs.method, model=self.inputs.model)
+        nvoxels = len(timeseries)
+        chunk_size = max(1, nvoxels)
+        if isdefined(self.inputs.chunk_size):
+            chunk_size = max(1, self.inputs.chunk_size)
+        starts = list(range(0, nvoxels, chunk_size))
+        chunks = [(timeseries[i:i + chunk_size], design_matrix,
+                   self.inputs.method, self.inputs.model) for i in starts]
+        pool = None
+        if self.inputs.n_procs > 1 and len(chunks) > 1:
+            from multiprocessing import Pool
+            pool = Pool(processes=self.inputs.n_procs)
+            fits = pool.imap(_fit_glm_chunk, chunks)
+        else:
+            fits = (_fit_glm_chunk(chunk) for chunk in chunks)
+
+        # The maps are filled as the chunks are fitted
+        voxels = np.flatnonzero(mask)
+        beta = np.zeros(mask.shape + (design_matrix.shape[1],))
+        s2 = np.zeros(mask.shape)
+        if self.inputs.model == "ar1":
+            a = np.zeros(mask.shape)
+            nvbeta = []
+        if self.inputs.save_residuals:
+            residuals = np.zeros(mask.shape + (nscans,))
+        try:
+            for i, glm in zip(starts, fits):
+                chunk = voxels[i:i + chunk_size]
+                beta.reshape(-1, beta.shape[-1])[chunk] = glm.beta.T
+                s2.reshape(-1)[chunk] = glm.s2
+                if self.inputs.save_residuals:
+                    explained = np.dot(design_matrix, glm.beta)
+                    residuals.reshape(-1, nscans)[chunk] = \
+                        timeseries[i:i + chunk_size] - explained.T
+                if self.inputs.model == "ar1":
+                    a.reshape(-1)[chunk] = glm.a.squeeze()
+                    nvbeta.append(glm.nvbeta)
+                else:
+                    nvbeta = glm.nvbeta
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        del chunks
+        del timeseries
 
         self._beta_file = os.path.abspath("beta.nii")
-        beta = np.zeros(mask.shape + (glm.beta.shape[0],))
-        beta[mask, :] = glm.beta.T
         nb.save(nb.Nifti1Image(beta, nii.affine), self._beta_file)
+        del beta
 
         self._s2_file = os.path.abspath("s2.nii")
-        s2 = np.zeros(mask.shape)
-        s2[mask] = glm.s2
         nb.save(nb.Nifti1Image(s2, nii.affine), self._s2_file)
 
         if self.inputs.save_residuals:
-            explained = np.dot(design_matrix, glm.beta)
-            residuals = np.zeros(mask.shape + (nscans,))
-            residuals[mask, :] = timeseries - explained.T
             self._residuals_file = os.path.abspath("residuals.nii")
             nb.save(nb.Nifti1Image(residuals, nii.affine), self._residuals_file)
+            del residuals
 
-        self._nvbeta = glm.nvbeta
+        if self.inputs.model == "ar1":
+            nvbeta = np.concatenate(nvbeta, axis=-1)
+        self._nvbeta = nvbeta
         self._dof = glm.dof
         self._constants = glm._constants
         self._axis = glm._axis
         if self.inputs.model == "ar1":
             self._a_file = os.path.abspath("a.nii")
-            a = np.zeros(mask.shape)
-            a[mask] = glm.a.squeeze()
             nb.save(nb.Nifti1Image(a, nii.affine), self._a_file)
         self._model = glm.model
         self._method = glm.method
@@ -208,6 +259,16 @@ class FitGLM(BaseInterface):
         return outputs
 
 
+def _fit_glm_chunk(args):
+    '''
+    Fit the GLM to a (voxels x scans) chunk of the timeseries
+    '''
+    timeseries, design_matrix, method, model = args
+    glm = GLM.glm()
+    glm.fit(timeseries.T, design_matrix, method=method, model=model)
+    return glm
+
+
 class EstimateContrastInputSpec(BaseInterfaceInputSpec):
     contrasts = traits.List(
         traits.Either(traits.Tuple(traits.Str,
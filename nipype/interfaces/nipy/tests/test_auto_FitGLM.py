@@ -6,6 +6,7 @@ from ..model import FitGLM
 def test_FitGLM_inputs():
     input_map = dict(TR=dict(mandatory=True,
     ),
+    chunk_size=dict(),
     drift_model=dict(usedefault=True,
     ),
     hrf_model=dict(usedefault=True,
@@ -18,6 +19,9 @@ def test_FitGLM_inputs():
     ),
     model=dict(usedefault=True,
     ),
+    n_procs=dict(nohash=True,
+    usedefault=True,
+    ),
     normalize_design_matrix=dict(usedefault=True,
     ),
     plot_design_matrix=dict(usedefault=True,
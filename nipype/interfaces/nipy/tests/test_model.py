@@ -0,0 +1,53 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import nibabel as nb
+import numpy as np
+
+from nipype.testing import assert_equal, assert_almost_equal, skipif
+from nipype.interfaces.nipy.model import FitGLM, have_nipy
+
+
+@skipif(not have_nipy)
+def test_fitglm_chunks():
+    tempdir = mkdtemp()
+    origdir = os.getcwd()
+    os.chdir(tempdir)
+
+    rng = np.random.RandomState(0)
+    scans = []
+    for run in range(2):
+        data = rng.randn(6, 5, 4, 40) * 10 + 100
+        scans.append(os.path.abspath('run%d.nii' % run))
+        nb.Nifti1Image(data.astype(np.float32), np.eye(4)).to_filename(scans[-1])
+    nb.Nifti1Image((rng.rand(6, 5, 4) > 0.3).astype(np.uint8),
+                   np.eye(4)).to_filename('mask.nii')
+    session_info = [{'scans': scans, 'hpf': 128., 'regress': [],
+                     'cond': [{'name': 'a', 'onset': [10., 60., 110.],
+                               'duration': [10.]}]}]
+
+    results = {}
+    for chunk_size in (None, 17):
+        os.mkdir('fit%s' % chunk_size)
+        os.chdir('fit%s' % chunk_size)
+        fit = FitGLM(session_info=session_info, TR=2., mask='../mask.nii',
+                     save_residuals=True)
+        if chunk_size:
+            fit.inputs.chunk_size = chunk_size
+        results[chunk_size] = fit.run().outputs
+        os.chdir(tempdir)
+
+    whole, chunked = results[None], results[17]
+    for output in ('beta', 's2', 'a', 'residuals'):
+        yield (assert_almost_equal,
+               nb.load(getattr(chunked, output)).get_data(),
+               nb.load(getattr(whole, output)).get_data())
+    yield assert_almost_equal, chunked.nvbeta, whole.nvbeta
+    yield assert_equal, chunked.dof, whole.dof
+    yield assert_equal, nb.load(whole.beta).shape[:3], (6, 5, 4)
+
+    os.chdir(origdir)
+    rmtree(tempdir)
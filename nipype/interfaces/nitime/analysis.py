@@ -13,13 +13,16 @@ Interfaces to functionality from nitime for time-series analysis of fmri data
 from builtins import zip
 from builtins import object
 
+import os.path as op
 import warnings
+from functools import partial
+
 import numpy as np
-import tempfile
 from ...utils.misc import package_check
 
-from ..base import (TraitedSpec, File, Undefined, traits,
-                    BaseInterface, isdefined, BaseInterfaceInputSpec)
+from ..base import (TraitedSpec, File, Undefined, traits, InputMultiPath,
+                    OutputMultiPath, BaseInterface, isdefined,
+                    BaseInterfaceInputSpec)
 
 from ...utils.filemanip import fname_presuffix
 
@@ -50,6 +53,14 @@ class CoherenceAnalyzerInputSpec(BaseInterfaceInputSpec):
 
     in_TS = traits.Any(desc='a nitime TimeSeries object')
 
+    in_files = InputMultiPath(
+        File(exists=True), xor=['in_file', 'in_TS'], requires=['TR'],
+        desc=('csv files (e.g. one per subject) with the same ROIs, formatted '
+              'as in_file and analyzed in a batch. The matrices of all the '
+              'files are stacked in coherence_stack and timedelay_stack'))
+    n_procs = traits.Int(1, usedefault=True, nohash=True,
+                         desc='number of processes used to analyze in_files')
+
     NFFT = traits.Range(low=32, value=64, usedefault=True,
                         desc=('This is the size of the window used for '
                               'the spectral estimation. Use values between '
@@ -66,9 +77,9 @@ class CoherenceAnalyzerInputSpec(BaseInterfaceInputSpec):
                                         'which the analysis will average.'
                                         '[low,high] (Default [0.02,0.15]'))
 
-    output_csv_file = File(desc='File to write outputs (coherence,time-delay) with file-names: file_name_ {coherence,timedelay}')
+    output_csv_file = File(desc='File to write outputs (coherence,time-delay) with file-names: file_name_ {coherence,timedelay}. With in_files, the index of each file is added: file_name_<index>_{coherence,timedelay}')
 
-    output_figure_file = File(desc='File to write output figures (coherence,time-delay) with file-names: file_name_{coherence,timedelay}. Possible formats: .png,.svg,.pdf,.jpg,...')
+    output_figure_file = File(desc='File to write output figures (coherence,time-delay) with file-names: file_name_{coherence,timedelay}. Possible formats: .png,.svg,.pdf,.jpg,... (not used with in_files)')
 
     figure_type = traits.Enum('matrix', 'network', usedefault=True,
                               desc=("The type of plot to generate, where "
@@ -84,11 +95,18 @@ class CoherenceAnalyzerOutputSpec(TraitedSpec):
     timedelay_array = traits.Array(desc=('The pairwise time delays between the'
                                          'ROIs (in seconds)'))
 
-    coherence_csv = File(desc=('A csv file containing the pairwise '
-                               'coherence values'))
+    coherence_csv = OutputMultiPath(File(), desc=('A csv file containing the '
+                                                  'pairwise coherence values '
+                                                  '(one per file of in_files)'))
+
+    timedelay_csv = OutputMultiPath(File(), desc=('A csv file containing the '
+                                                  'pairwise time delay values '
+                                                  '(one per file of in_files)'))
 
-    timedelay_csv = File(desc=('A csv file containing the pairwise '
-                               'time delay values'))
+    coherence_stack = File(desc=('npy file with the coherence matrices of '
+                                 'in_files (files x ROIs x ROIs)'))
+    timedelay_stack = File(desc=('npy file with the time delay matrices of '
+                                 'in_files (files x ROIs x ROIs)'))
 
     coherence_fig = File(desc=('Figure representing coherence values'))
     timedelay_fig = File(desc=('Figure representing coherence values'))
@@ -110,16 +128,7 @@ class CoherenceAnalyzer(BaseInterface):
         (TRs) will becomes the second (and last) dimension of the array
 
         """
-        # Check that input conforms to expectations:
-        first_row = open(self.inputs.in_file).readline()
-        if not first_row[1].isalpha():
-            raise ValueError("First row of in_file should contain ROI names as strings of characters")
-
-        roi_names = open(self.inputs.in_file).readline().replace('\"', '').strip('\n').split(',')
-        # Transpose, so that the time is the last dimension:
-        data = np.loadtxt(self.inputs.in_file, skiprows=1, delimiter=',').T
-
-        return data, roi_names
+        return _read_csv(self.inputs.in_file)
 
     def _csv2ts(self):
         """ Read data from the in_file and generate a nitime TimeSeries object"""
@@ -135,6 +144,10 @@ class CoherenceAnalyzer(BaseInterface):
 
     # Rewrite _run_interface, but not run
     def _run_interface(self, runtime):
+        if isdefined(self.inputs.in_files):
+            self._run_batch()
+            return runtime
+
         lb, ub = self.inputs.frequency_range
 
         if self.inputs.in_TS is Undefined:
@@ -166,6 +179,55 @@ class CoherenceAnalyzer(BaseInterface):
         self.delay = np.mean(A.delay[:, :, freq_idx], -1)
         return runtime
 
+    def _run_batch(self):
+        """
+        Compute the coherence and time delay matrices of each file of
+        in_files with ``n_procs`` processes, writing them to the stacks (and
+        to csv files, if output_csv_file is given) as the files are analyzed.
+        """
+        in_files = self.inputs.in_files
+        self._batch_csv = [None] * len(in_files)
+        if isdefined(self.inputs.output_csv_file):
+            width = len(str(len(in_files) - 1))
+            self._batch_csv = [fname_presuffix(self.inputs.output_csv_file,
+                                               suffix='_%0*d' % (width, i))
+                               for i in range(len(in_files))]
+
+        analyze = partial(_coherence_file, TR=self.inputs.TR,
+                          NFFT=self.inputs.NFFT,
+                          n_overlap=self.inputs.n_overlap,
+                          frequency_range=self.inputs.frequency_range)
+        jobs = list(zip(in_files, self._batch_csv))
+        pool = None
+        if self.inputs.n_procs > 1 and len(jobs) > 1:
+            from multiprocessing import Pool
+            pool = Pool(processes=self.inputs.n_procs)
+            results = pool.imap(analyze, jobs)
+        else:
+            results = (analyze(job) for job in jobs)
+
+        stacks = {}
+        try:
+            for i, (roi_names, coherence, delay) in enumerate(results):
+                if i == 0:
+                    self.ROIs = roi_names
+                    for name in ('coherence', 'timedelay'):
+                        stacks[name] = np.lib.format.open_memmap(
+                            op.abspath('%s_stack.npy' % name), mode='w+',
+                            dtype=np.float64,
+                            shape=(len(jobs),) + coherence.shape)
+                elif roi_names != self.ROIs:
+                    raise ValueError('ROIs of %s differ from those of %s' %
+                                     (in_files[i], in_files[0]))
+                stacks['coherence'][i] = coherence
+                stacks['timedelay'][i] = delay
+        finally:
+            if pool is not None:
+                pool.terminate()
+                pool.join()
+        for stack in list(stacks.values()):
+            stack.flush()
+
     # Rewrite _list_outputs (look at BET)
     def _list_outputs(self):
         outputs = self.output_spec().get()
@@ -175,6 +237,18 @@ class CoherenceAnalyzer(BaseInterface):
         # write to a csv file and assign a value to self.coherence_file (a
         # file name + path)
 
+        if isdefined(self.inputs.in_files):
+            outputs['coherence_stack'] = op.abspath('coherence_stack.npy')
+            outputs['timedelay_stack'] = op.abspath('timedelay_stack.npy')
+            if isdefined(self.inputs.output_csv_file):
+                outputs['coherence_csv'] = [
+                    fname_presuffix(f, suffix='_coherence')
+                    for f in self._batch_csv]
+                outputs['timedelay_csv'] = [
+                    fname_presuffix(f, suffix='_delay')
+                    for f in self._batch_csv]
+            return outputs
+
         # Always defined (the arrays):
         outputs['coherence_array'] = self.coherence
         outputs['timedelay_array'] = self.delay
@@ -201,18 +275,8 @@ class CoherenceAnalyzer(BaseInterface):
         """
         Generate the output csv files.
         """
-        for this in zip([self.coherence, self.delay], ['coherence', 'delay']):
-            tmp_f = tempfile.mkstemp()[1]
-            np.savetxt(tmp_f, this[0], delimiter=',')
-
-            fid = open(fname_presuffix(self.inputs.output_csv_file,
-                                       suffix='_%s' % this[1]), 'w+')
-            # this writes ROIs as header line
-            fid.write(',' + ','.join(self.ROIs) + '\n')
-            # this writes ROI and data to a line
-            for r, line in zip(self.ROIs, open(tmp_f)):
-                fid.write('%s,%s' % (r, line))
-            fid.close()
+        _write_csvs(self.inputs.output_csv_file, self.coherence, self.delay,
+                    self.ROIs)
 
     def _make_output_figures(self):
         """
@@ -248,6 +312,129 @@ class CoherenceAnalyzer(BaseInterface):
                                            suffix='_delay'))
 
 
+def welch_coherence(data, TR, NFFT=64, n_overlap=0,
+                    frequency_range=(0.02, 0.15), block_values=2 ** 22):
+    """
+    Compute the coherence and time delay between all the pairs of rows of
+    ``data``, averaged over the frequencies within ``frequency_range``
+
+    The results are those of :class:`nitime.analysis.CoherenceAnalyzer` with
+    the 'welch' method, but only the spectra of the frequencies within the
+    range are kept, and the cross-spectra of ``block_values`` (segment,
+    frequency, ROI, ROI) values at a time are computed with array operations.
+
+    Parameters
+    ----------
+    data : array (ROIs x time-points)
+    TR : float
+        The sampling interval of ``data`` (in seconds)
+    NFFT : int
+        The size of the windows used for the spectral estimation
+    n_overlap : int
+        The number of samples which overlap between subsequent windows
+    frequency_range : (low, high)
+        The range of frequencies (in Hz) over which the results are averaged
+
+    Returns
+    -------
+    coherence, delay : arrays (ROIs x ROIs)
+    """
+    data = np.asarray(data, dtype=np.float64)
+    n_rois, n_samples = data.shape
+    if n_samples < NFFT:
+        data = np.hstack((data, np.zeros((n_rois, NFFT - n_samples))))
+    Fs = 1. / TR
+
+    # The one-sided spectral estimate of matplotlib.mlab.csd
+    window = np.hanning(NFFT)
+    starts = np.arange(0, data.shape[1] - NFFT + 1, NFFT - n_overlap)
+    freqs = np.fft.fftfreq(NFFT, 1 / Fs)[:NFFT // 2 + 1]
+    scale = np.ones_like(freqs)
+    if NFFT % 2:
+        scale[1:] = 2
+    else:
+        scale[1:-1] = 2
+        freqs[-1] *= -1
+    lb, ub = frequency_range
+    freq_idx = np.where((freqs > lb) * (freqs < ub))[0]
+    freqs = freqs[freq_idx, np.newaxis, np.newaxis]
+    scale = scale[freq_idx, np.newaxis]
+
+    # The segments and frequencies are kept in the leading axes, so that the
+    # averages below add up the values in the same order as nitime
+    segments = data[:, starts[:, np.newaxis] + np.arange(NFFT)] * window
+    spectra = np.fft.fft(segments)[..., freq_idx].transpose(1, 2, 0).copy()
+    del segments
+
+    def csd(x, y):
+        pxy = np.conj(y) * x
+        pxy *= scale
+        pxy /= Fs
+        pxy /= (window ** 2).sum()
+        return pxy.mean(0)
+
+    psd = csd(spectra, spectra).real
+    scale = scale[..., np.newaxis]
+    coherence = np.empty((n_rois, n_rois))
+    delay = np.empty((n_rois, n_rois))
+    step = max(1, block_values // spectra.size)
+    for i in range(0, n_rois, step):
+        rows = slice(i, i + step)
+        pxy = csd(spectra[..., rows, np.newaxis], spectra[..., np.newaxis, :])
+        coherence[rows] = (np.abs(pxy) ** 2 /
+                           (psd[:, rows, np.newaxis] *
+                            psd[:, np.newaxis])).mean(0)
+        delay[rows] = (np.angle(pxy) / (2 * np.pi * freqs)).mean(0)
+    return coherence, delay
+
+
+def _read_csv(in_file):
+    """
+    Read the ROI names in the first row of the csv ``in_file`` and its data,
+    transposed so that the time is the last dimension
+    """
+    # Check that input conforms to expectations:
+    first_row = open(in_file).readline()
+    if not first_row[1].isalpha():
+        raise ValueError("First row of in_file should contain ROI names as strings of characters")
+
+    roi_names = first_row.replace('\"', '').strip('\n').split(',')
+    # Transpose, so that the time is the last dimension:
+    data = np.loadtxt(in_file, skiprows=1, delimiter=',').T
+
+    return data, roi_names
+
+
+def _write_csvs(out_file, coherence, delay, roi_names):
+    """
+    Write the coherence and delay matrices to the csv files named after
+    ``out_file``, with the ROI names on the first row and column
+    """
+    for this in zip([coherence, delay], ['coherence', 'delay']):
+        with open(fname_presuffix(out_file, suffix='_%s' % this[1]),
+                  'w+') as fid:
+            # this writes ROIs as header line
+            fid.write(',' + ','.join(roi_names) + '\n')
+            # this writes ROI and data to a line
+            for r, line in zip(roi_names, this[0]):
+                fid.write('%s,%s\n' % (r, ','.join(['%.18e' % value
+                                                      for value in line])))
+
+
+def _coherence_file(args, TR, NFFT, n_overlap, frequency_range):
+    """
+    Compute the coherence and delay matrices of one csv file, writing them to
+    the csv files named after ``out_file`` if it is not None
+    """
+    in_file, out_file = args
+    data, roi_names = _read_csv(in_file)
+    coherence, delay = welch_coherence(data, TR, NFFT, n_overlap,
+                                       frequency_range)
+    if out_file is not None:
+        _write_csvs(out_file, coherence, delay, roi_names)
+    return roi_names, coherence, delay
+
+
 class GetTimeSeriesInputSpec(object):
     pass
 
@@ -17,8 +17,14 @@ def test_CoherenceAnalyzer_inputs():
     in_TS=dict(),
     in_file=dict(requires=('TR',),
     ),
+    in_files=dict(requires=['TR'],
+    xor=['in_file', 'in_TS'],
+    ),
     n_overlap=dict(usedefault=True,
     ),
+    n_procs=dict(nohash=True,
+    usedefault=True,
+    ),
     output_csv_file=dict(),
     output_figure_file=dict(),
     )
@@ -33,9 +39,11 @@ def test_CoherenceAnalyzer_outputs():
     output_map = dict(coherence_array=dict(),
     coherence_csv=dict(),
     coherence_fig=dict(),
+    coherence_stack=dict(),
     timedelay_array=dict(),
     timedelay_csv=dict(),
     timedelay_fig=dict(),
+    timedelay_stack=dict(),
     )
     outputs = CoherenceAnalyzer.output_spec()
 
@@ -1,6 +1,7 @@
 # emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
 # vi: set ft=python sts=4 ts=4 sw=4 et:
 import os
+from shutil import rmtree
 import tempfile
 
 import numpy as np
@@ -73,3 +74,35 @@ def test_coherence_analysis():
     coh = np.mean(C.coherence[:, :, freq_idx], -1)  # Averaging on the last dimension
 
     yield assert_equal, o.outputs.coherence_array, coh
+
+
+@skipif(no_nitime)
+def test_coherence_batch():
+    """Test that the batch analysis matches the analysis of each file"""
+    CA = nitime.CoherenceAnalyzer()
+    CA.inputs.TR = 1.89
+    CA.inputs.in_file = example_data('fmri_timeseries.csv')
+    o = CA.run()
+
+    tempdir = tempfile.mkdtemp()
+    cwd = os.getcwd()
+    os.chdir(tempdir)
+    CA = nitime.CoherenceAnalyzer()
+    CA.inputs.TR = 1.89
+    CA.inputs.in_files = [example_data('fmri_timeseries.csv')] * 2
+    CA.inputs.output_csv_file = os.path.join(tempdir, 'out.csv')
+    batch = CA.run()
+    os.chdir(cwd)
+
+    coherence = np.load(batch.outputs.coherence_stack)
+    delay = np.load(batch.outputs.timedelay_stack)
+    yield assert_equal, coherence.shape, (2, 31, 31)
+    yield assert_equal, coherence[1], o.outputs.coherence_array
+    yield assert_equal, delay[0], o.outputs.timedelay_array
+    yield assert_equal, batch.outputs.coherence_csv, [
+        os.path.join(tempdir, 'out_%d_coherence.csv' % i) for i in range(2)]
+    out_csv = batch.outputs.timedelay_csv[1]
+    yield assert_equal, open(out_csv).readline().strip().split(',')[1:], CA.ROIs
+    yield assert_equal, np.loadtxt(out_csv, skiprows=1, delimiter=',',
+                                   usecols=range(1, 32)), delay[1]
+    rmtree(tempdir)
@@ -4,13 +4,18 @@ from ..dcmstack import DcmStack
 
 
 def test_DcmStack_inputs():
-    input_map = dict(dicom_files=dict(mandatory=True,
+    input_map = dict(cache_dir=dict(nohash=True,
+    ),
+    dicom_files=dict(mandatory=True,
     ),
     embed_meta=dict(),
     exclude_regexes=dict(),
     force_read=dict(usedefault=True,
     ),
     include_regexes=dict(),
+    num_threads=dict(nohash=True,
+    usedefault=True,
+    ),
     out_ext=dict(usedefault=True,
     ),
     out_format=dict(),
@@ -0,0 +1,85 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from glob import glob
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import nibabel as nb
+import numpy as np
+
+from nipype.testing import assert_equal, skipif
+from nipype.interfaces.dcmstack import DcmStack, have_dcmstack
+
+
+def _write_series(path, nvols=2, nslices=3):
+    from dicom.dataset import Dataset, FileDataset
+    rng = np.random.RandomState(0)
+    for vol in range(nvols):
+        for z in range(nslices):
+            uid = '1.2.3.%d' % (vol * nslices + z + 1)
+            file_meta = Dataset()
+            file_meta.MediaStorageSOPClassUID = '1.2.840.10008.5.1.4.1.1.4'
+            file_meta.MediaStorageSOPInstanceUID = uid
+            file_meta.TransferSyntaxUID = '1.2.840.10008.1.2.1'
+            file_meta.ImplementationClassUID = '1.2.3.4'
+            filename = os.path.join(path, '%s.dcm' % uid)
+            dcm = FileDataset(filename, {}, file_meta=file_meta,
+                              preamble=b'\0' * 128)
+            dcm.is_little_endian = True
+            dcm.is_implicit_VR = False
+            dcm.SOPClassUID = file_meta.MediaStorageSOPClassUID
+            dcm.SOPInstanceUID = uid
+            dcm.SeriesNumber = 3
+            dcm.ProtocolName = 'bold'
+            dcm.AcquisitionTime = '%06d.000' % (100000 + 2 * vol)
+            dcm.RepetitionTime = 2000.
+            dcm.ImageOrientationPatient = [1., 0., 0., 0., 1., 0.]
+            dcm.ImagePositionPatient = [0., 0., 3. * z]
+            dcm.SliceThickness = 3.
+            dcm.PixelSpacing = [2., 2.]
+            dcm.Rows = dcm.Columns = 4
+            dcm.SamplesPerPixel = 1
+            dcm.PhotometricInterpretation = 'MONOCHROME2'
+            dcm.BitsAllocated = dcm.BitsStored = 16
+            dcm.HighBit = 15
+            dcm.PixelRepresentation = 0
+            dcm.PixelData = rng.randint(0, 1000, size=(4, 4)).astype(
+                np.uint16).tobytes()
+            dcm[0x7fe00010].VR = 'OW'
+            dcm.save_as(filename)
+
+
+@skipif(not have_dcmstack)
+def test_dcmstack_cache():
+    tempdir = mkdtemp()
+    origdir = os.getcwd()
+    os.chdir(tempdir)
+    os.mkdir('series')
+    _write_series('series')
+
+    stacker = DcmStack(dicom_files='series', embed_meta=True,
+                       cache_dir='cache', num_threads=2)
+    stacked = stacker.run().outputs.out_file
+    yield assert_equal, os.path.basename(stacked), '003-bold.nii.gz'
+    yield assert_equal, len(glob('cache/*.nii.gz')), 1
+    data = nb.load(stacked).get_data()
+    yield assert_equal, data.shape, (4, 4, 3, 2)
+
+    # the cached series is reused with other output settings
+    stacker = DcmStack(dicom_files='series', embed_meta=False,
+                       cache_dir='cache', out_format='run%(SeriesNumber)d')
+    restacked = stacker.run().outputs.out_file
+    yield assert_equal, os.path.basename(restacked), 'run3.nii.gz'
+    yield assert_equal, len(glob('cache/*.nii.gz')), 1
+    yield assert_equal, nb.load(restacked).get_data().tolist(), data.tolist()
+    yield assert_equal, len(nb.load(restacked).header.extensions), 0
+
+    # modified files are read again
+    dcm_file = glob('series/*.dcm')[0]
+    os.utime(dcm_file, (1e9, 1e9))
+    DcmStack(dicom_files='series', cache_dir='cache').run()
+    yield assert_equal, len(glob('cache/*.nii.gz')), 2
+
+    os.chdir(origdir)
+    rmtree(tempdir)
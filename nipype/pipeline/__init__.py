@@ -7,4 +7,12 @@ Package contains modules for generating pipelines using interfaces
 
 from __future__ import absolute_import
 __docformat__ = 'restructuredtext'
-from .engine import Node, MapNode, JoinNode, Workflow
+from ..utils.misc import lazy_attributes
+lazy_attributes(__name__, {
+    'Node': 'nipype.pipeline.engine',
+    'MapNode': 'nipype.pipeline.engine',
+    'JoinNode': 'nipype.pipeline.engine',
+    'Workflow': 'nipype.pipeline.engine',
+    'engine': 'nipype.pipeline.engine',
+    'plugins': 'nipype.pipeline.plugins'})
+del lazy_attributes
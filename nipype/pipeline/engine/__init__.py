@@ -9,6 +9,14 @@ Package contains modules for generating pipelines using interfaces
 
 from __future__ import absolute_import
 __docformat__ = 'restructuredtext'
-from .workflows import Workflow
-from .nodes import Node, MapNode, JoinNode
-from .utils import generate_expanded_graph
+from ...utils.misc import lazy_attributes
+lazy_attributes(__name__, {
+    'Workflow': 'nipype.pipeline.engine.workflows',
+    'Node': 'nipype.pipeline.engine.nodes',
+    'MapNode': 'nipype.pipeline.engine.nodes',
+    'JoinNode': 'nipype.pipeline.engine.nodes',
+    'generate_expanded_graph': 'nipype.pipeline.engine.utils',
+    'workflows': 'nipype.pipeline.engine.workflows',
+    'nodes': 'nipype.pipeline.engine.nodes',
+    'utils': 'nipype.pipeline.engine.utils'})
+del lazy_attributes
@@ -60,13 +60,14 @@ from ...utils.misc import (getsource, create_function_from_source,
                            flatten, unflatten)
 from ...utils.filemanip import (save_json, FileNotFoundError,
                                 filename_to_list, list_to_filename,
-                                copyfiles, fnames_presuffix, loadpkl,
+                                copyfile, copyfiles, fnames_presuffix, loadpkl,
                                 split_filename, load_json, savepkl,
                                 write_rst_header, write_rst_dict,
-                                write_rst_list)
+                                write_rst_list, summarize_staging)
 from ...external.six import string_types
-from .utils import (generate_expanded_graph, modify_paths,
-                    export_graph, make_output_dir, write_workflow_prov,
+from .utils import (generate_expanded_graph, modify_paths, relocate_paths,
+                    store_outputs, load_stored_outputs, export_graph,
+                    make_output_dir, write_workflow_prov,
                     clean_working_directory, format_dot, topological_sort,
                     get_print_name, merge_dict, evaluate_connect_function)
 from .base import EngineBase
@@ -187,6 +188,7 @@ class Node(EngineBase):
         if needed_outputs:
             self.needed_outputs = sorted(needed_outputs)
         self._got_inputs = False
+        self._staging_stats = {}
 
     @property
     def interface(self):
@@ -389,7 +391,9 @@ class Node(EngineBase):
             savepkl(op.join(outdir, '_inputs.pklz'),
                     self.inputs.get_traitsfree())
             try:
-                self._run_interface()
+                if not self._load_from_store(hashed_inputs, hashvalue):
+                    self._run_interface()
+                    self._save_to_store(hashed_inputs, hashvalue)
             except:
                 os.remove(hashfile_unfinished)
                 raise
@@ -409,6 +413,45 @@ class Node(EngineBase):
         return self._result
 
     # Private functions
+    def _store_key(self, hashed_inputs, hashvalue):
+        """Returns the key of this node's outputs in the content store"""
+        store_dir = self.config['execution'].get('content_store_dir')
+        if not store_dir or isinstance(self, MapNode):
+            return None, None
+        # nodes that must always execute never reuse stored outputs
+        if self.overwrite or (self.overwrite is None and
+                              self._interface.always_run):
+            return None, None
+        ifclass = self._interface.__class__
+        hashobject = md5(('%s.%s:%s' % (ifclass.__module__, ifclass.__name__,
+                                        hashvalue)).encode())
+        # size and mtime do not identify a file: add the paths to the key
+        if self.config['execution']['hash_method'].lower() == 'timestamp':
+            hashobject.update(str(hashed_inputs).encode())
+        hashobject.update(str(sorted(self.needed_outputs)).encode())
+        return op.abspath(op.expanduser(store_dir)), hashobject.hexdigest()
+
+    def _load_from_store(self, hashed_inputs, hashvalue):
+        """Reuse outputs of an identical execution found in the content store
+        """
+        store_dir, key = self._store_key(hashed_inputs, hashvalue)
+        if key is None:
+            return False
+        outdir = self.output_dir()
+        result = load_stored_outputs(store_dir, key, outdir)
+        if result is None:
+            return False
+        logger.info('Reusing stored outputs for node %s' % self.name)
+        self._save_results(result, outdir)
+        self._result = result
+        return True
+
+    def _save_to_store(self, hashed_inputs, hashvalue):
+        store_dir, key = self._store_key(hashed_inputs, hashvalue)
+        if key is None or self._result is None:
+            return
+        store_outputs(store_dir, key, self._result, self.output_dir())
+
     def _parameterization_dir(self, param):
         """
         Returns the directory name for the given parameterization string as follows:
@@ -498,10 +541,165 @@ class Node(EngineBase):
         if updatehash:
             return
         old_cwd = os.getcwd()
-        os.chdir(self.output_dir())
-        self._result = self._run_command(execute)
+        scratch_dir = self._scratch_dir() if execute else None
+        if scratch_dir:
+            self._result = self._run_in_scratch(scratch_dir)
+        else:
+            os.chdir(self.output_dir())
+            self._result = self._run_command(execute)
         os.chdir(old_cwd)
 
+    def _scratch_dir(self):
+        """Return the node-local scratch directory to execute in, if any
+
+        The ``local_scratch_dir`` execution option may contain environment
+        variables (e.g., ``$TMPDIR``), which are expanded on the host running
+        the node.
+        """
+        scratch_dir = self.config['execution'].get('local_scratch_dir')
+        if not scratch_dir:
+            return None
+        scratch_dir = op.expandvars(op.expanduser(scratch_dir))
+        if not op.isdir(scratch_dir):
+            logger.warn(('Scratch directory %s not available, running node '
+                         '%s in %s') % (scratch_dir, self.name,
+                                        self.output_dir()))
+            return None
+        return scratch_dir
+
+    def _run_in_scratch(self, scratch_dir):
+        """Execute the interface in a temporary directory under scratch_dir
+
+        Existing input files are copied to the scratch directory, the
+        interface runs there and only the declared outputs are copied back
+        to the node directory, where the results file is written with paths
+        rewritten accordingly. Inputs refer to the original files in the
+        results file. If the interface fails, the scratch directory is kept
+        for inspection.
+        """
+        outdir = self.output_dir()
+        workdir = mkdtemp(prefix='%s_' % self.name, dir=scratch_dir)
+        logger.info('Running node %s in scratch directory %s' %
+                    (self.name, workdir))
+        # the inputs of a JoinNode include the join item fields
+        specs = [self._interface.inputs]
+        if self.inputs is not self._interface.inputs:
+            specs.append(self.inputs)
+        orig_inputs = [deepcopy(spec.get()) for spec in specs]
+        stage_in = {}
+        stage_out = {}
+        try:
+            os.chdir(workdir)
+            staged = self._stage_in(op.join(workdir, '_stagein'), stage_in)
+            result = self._run_command(True)
+            staged.update(self._wd_copies(orig_inputs[-1]))
+            result.inputs = relocate_paths(_unstage(result.inputs, staged),
+                                           workdir, outdir)
+            result = self._stage_out(result, workdir, outdir, stage_out)
+        except:
+            logger.warn('Node %s failed, keeping scratch directory %s' %
+                        (self.name, workdir))
+            raise
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+        finally:
+            os.chdir(outdir)
+            for spec, inputs in zip(specs, orig_inputs):
+                spec.trait_set(trait_change_notify=False, **inputs)
+        logger.info('Scratch staging of %s: %d bytes in, %d bytes out' %
+                    (self.name, sum(stage_in.values()),
+                     sum(stage_out.values())))
+        return result
+
+    def _stage_in(self, stagedir, stats):
+        """Copy existing input files (and related files) to stagedir
+
+        Inputs handled by ``_copyfiles_to_wd`` are left to it. Each file is
+        placed in its own subdirectory to avoid name clashes. Returns a
+        dictionary mapping the staged copies to the original files.
+        """
+        copied = {}
+        skip = []
+        if hasattr(self._interface, '_get_filecopy_info'):
+            skip = [info['key'] for info in
+                    self._interface._get_filecopy_info()]
+
+        def _stage(value):
+            if isinstance(value, list):
+                return [_stage(val) for val in value]
+            if isinstance(value, tuple):
+                return tuple([_stage(val) for val in value])
+            if not (isinstance(value, string_types) and op.isfile(value)):
+                return value
+            value = op.abspath(value)
+            if value not in copied:
+                newdir = op.join(stagedir, '%04d' % len(copied))
+                os.makedirs(newdir)
+                copied[value] = copyfile(value, op.join(newdir,
+                                                        op.basename(value)),
+                                         copy=True, stats=stats)
+            return copied[value]
+
+        for key, value in list(self.inputs.get().items()):
+            if key in skip or not isdefined(value):
+                continue
+            newvalue = _stage(value)
+            if newvalue is not value:
+                setattr(self.inputs, key, newvalue)
+        return dict([(val, key) for key, val in list(copied.items())])
+
+    def _wd_copies(self, orig_inputs):
+        """Map the copies made by ``_copyfiles_to_wd`` to the original files
+        """
+        copies = {}
+        if hasattr(self._interface, '_get_filecopy_info'):
+            for info in self._interface._get_filecopy_info():
+                files = orig_inputs.get(info['key'])
+                if not isdefined(files) or not files:
+                    continue
+                newfiles = self.inputs.get()[info['key']]
+                for orig, new in zip(filename_to_list(files),
+                                     filename_to_list(newfiles)):
+                    copies[new] = orig
+        return copies
+
+    def _stage_out(self, result, workdir, outdir, stats):
+        """Copy outputs located in workdir to outdir and save the results
+        """
+        if result.outputs:
+            try:
+                outputs = result.outputs.get()
+            except TypeError:
+                outputs = result.outputs.dictcopy()  # outputs was a bunch
+
+            def _copy_back(value):
+                if isinstance(value, (list, tuple)):
+                    for val in value:
+                        _copy_back(val)
+                    return
+                newpath = relocate_paths(value, workdir, outdir)
+                if newpath in (value, outdir) or not op.exists(value):
+                    return
+                if op.isdir(value):
+                    for root, _, files in os.walk(value):
+                        for fname in files:
+                            _copy_back(op.join(root, fname))
+                    return
+                if not op.isdir(op.dirname(newpath)):
+                    os.makedirs(op.dirname(newpath))
+                copyfile(value, newpath, copy=True, stats=stats)
+
+            for value in list(outputs.values()):
+                if isdefined(value):
+                    _copy_back(value)
+            result.outputs.set(**relocate_paths(outputs, workdir, outdir))
+        if op.exists(op.join(workdir, 'command.txt')):
+            shutil.copyfile(op.join(workdir, 'command.txt'),
+                            op.join(outdir, 'command.txt'))
+        result.runtime.cwd = outdir
+        self._save_results(result, outdir)
+        return result
+
     def _save_results(self, result, cwd):
         resultsfile = op.join(cwd, 'result_%s.pklz' % self.name)
         if result.outputs:
@@ -629,6 +827,8 @@ class Node(EngineBase):
             except Exception as msg:
                 self._result.runtime.stderr = msg
                 raise
+            if copyfiles and self._staging_stats:
+                result.runtime.staging = self._staging_stats
 
             dirs2keep = None
             if isinstance(self, MapNode):
@@ -661,6 +861,7 @@ class Node(EngineBase):
 
     def _copyfiles_to_wd(self, outdir, execute, linksonly=False):
         """ copy files over and change the inputs"""
+        stats = {}
         if hasattr(self._interface, '_get_filecopy_info'):
             logger.debug('copying files to wd [execute=%s, linksonly=%s]' %
                          (str(execute), str(linksonly)))
@@ -680,7 +881,8 @@ class Node(EngineBase):
                                 newfiles = copyfiles(infiles,
                                                      [outdir],
                                                      copy=info['copy'],
-                                                     create_new=True)
+                                                     create_new=True,
+                                                     stats=stats)
                             else:
                                 newfiles = fnames_presuffix(infiles,
                                                             newpath=outdir)
@@ -691,7 +893,8 @@ class Node(EngineBase):
                             newfiles = copyfiles(infiles,
                                                  [outdir],
                                                  copy=info['copy'],
-                                                 create_new=True)
+                                                 create_new=True,
+                                                 stats=stats)
                     else:
                         newfiles = fnames_presuffix(infiles, newpath=outdir)
                     if not isinstance(files, list):
@@ -699,6 +902,11 @@ class Node(EngineBase):
                     setattr(self.inputs, info['key'], newfiles)
             if execute and linksonly:
                 rmtree(outdir)
+            if stats:
+                linked, copied = summarize_staging(stats)
+                logger.info(('Staged inputs of %s: %d bytes linked, '
+                             '%d bytes copied') % (self.name, linked, copied))
+        self._staging_stats = stats
 
     def update(self, **opts):
         self.inputs.update(**opts)
@@ -746,6 +954,11 @@ class Node(EngineBase):
                 rst_dict['runtime_threads'] = self.result.runtime.runtime_threads
             except AttributeError:
                 logger.info('Runtime memory and threads stats unavailable')
+            if hasattr(self.result.runtime, 'staging'):
+                linked, copied = summarize_staging(
+                    self.result.runtime.staging)
+                rst_dict['staged_bytes_linked'] = linked
+                rst_dict['staged_bytes_copied'] = copied
             if hasattr(self.result.runtime, 'cmdline'):
                 rst_dict['command'] = self.result.runtime.cmdline
                 fp.writelines(write_rst_dict(rst_dict))
@@ -760,6 +973,18 @@ class Node(EngineBase):
         fp.close()
 
 
+def _unstage(value, staged):
+    """Replace the staged copies of input files by the original files"""
+    if isinstance(value, dict):
+        return dict([(key, _unstage(val, staged))
+                     for key, val in list(value.items())])
+    if isinstance(value, (list, tuple)):
+        return type(value)([_unstage(val, staged) for val in value])
+    if isinstance(value, string_types):
+        return staged.get(value, value)
+    return value
+
+
 class JoinNode(Node):
     """Wraps interface objects that join inputs into a list.
 
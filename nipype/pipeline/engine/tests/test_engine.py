@@ -11,6 +11,7 @@ from shutil import rmtree
 from tempfile import mkdtemp
 
 import networkx as nx
+import numpy as np
 
 from ....testing import (assert_raises, assert_equal, assert_true, assert_false)
 from ... import engine as pe
@@ -40,6 +41,19 @@ class TestInterface(nib.BaseInterface):
         return outputs
 
 
+
+class CopyInputSpec(nib.BaseInterfaceInputSpec):
+    in_file = nib.File(exists=True, copyfile=True)
+
+
+class CopyInterface(TestInterface):
+    input_spec = CopyInputSpec
+
+    def _list_outputs(self):
+        outputs = self._outputs().get()
+        outputs['output1'] = [1]
+        return outputs
+
 def test_init():
     yield assert_raises, Exception, pe.Workflow
     pipe = pe.Workflow(name='pipe')
@@ -746,3 +760,161 @@ def test_serial_input():
 
     os.chdir(cwd)
     rmtree(wd)
+
+
+def test_scratch_execution():
+    cwd = os.getcwd()
+    wd = mkdtemp()
+    scratch = mkdtemp()
+    os.chdir(wd)
+    from nipype import Node, Function
+
+    def func1(in_file):
+        import os
+        with open(in_file) as fp:
+            data = fp.read()
+        out_file = os.path.abspath('out.txt')
+        with open(out_file, 'wt') as fp:
+            fp.write(data + ' processed')
+        return out_file, os.path.dirname(os.getcwd())
+
+    in_file = os.path.join(wd, 'in.txt')
+    with open(in_file, 'wt') as fp:
+        fp.write('data')
+    n1 = Node(Function(input_names=['in_file'],
+                       output_names=['out_file', 'cwd'],
+                       function=func1),
+              name='n1')
+    n1.base_dir = wd
+    n1.inputs.in_file = in_file
+    n1.config = {'execution': {'local_scratch_dir': scratch,
+                               'crashdump_dir': wd}}
+    result = n1.run()
+    out_file = os.path.join(n1.output_dir(), 'out.txt')
+    yield assert_equal, result.outputs.out_file, out_file
+    yield assert_equal, result.outputs.cwd, os.path.realpath(scratch)
+    yield assert_equal, n1.inputs.in_file, in_file
+    yield assert_equal, result.inputs['in_file'], in_file
+    with open(out_file) as fp:
+        yield assert_equal, fp.read(), 'data processed'
+    yield assert_equal, os.listdir(scratch), []
+    # results are loaded from the node directory when rerunning
+    result = n1.run()
+    yield assert_equal, result.outputs.out_file, out_file
+
+    def func2(in_file, values):
+        raise RuntimeError('func2 failed')
+
+    n2 = Node(Function(input_names=['in_file', 'values'],
+                       output_names=['out_file'],
+                       function=func2),
+              name='n2')
+    n2.base_dir = wd
+    n2.inputs.in_file = in_file
+    n2.inputs.values = np.arange(3)
+    n2.config = n1.config
+    try:
+        n2.run()
+    except Exception as e:
+        error = str(e)
+    yield assert_true, 'func2 failed' in error
+    yield assert_equal, n2.inputs.in_file, in_file
+    # the scratch directory of the failed node is kept
+    yield assert_equal, len(os.listdir(scratch)), 1
+
+    # inputs copied to the working directory refer to the original files
+    n3 = Node(CopyInterface(), name='n3')
+    n3.base_dir = wd
+    n3.inputs.in_file = in_file
+    n3.config = n1.config
+    result = n3.run()
+    yield assert_equal, result.inputs['in_file'], in_file
+    yield assert_equal, n3.inputs.in_file, in_file
+    os.chdir(cwd)
+    rmtree(wd)
+    rmtree(scratch)
+
+
+def test_content_store():
+    cwd = os.getcwd()
+    wd = mkdtemp()
+    os.chdir(wd)
+    from nipype import Node, Function
+
+    def func1(log_dir, value):
+        import os
+        from tempfile import mkstemp
+        mkstemp(dir=log_dir)
+        out_file = os.path.abspath('out.txt')
+        with open(out_file, 'wt') as fp:
+            fp.write(str(value))
+        return out_file
+
+    log_dir = os.path.join(wd, 'log')
+    os.mkdir(log_dir)
+    store_dir = os.path.join(wd, 'store')
+    results = []
+    for name in ['n1', 'n2']:
+        node = Node(Function(input_names=['log_dir', 'value'],
+                             output_names=['out_file'],
+                             function=func1),
+                    name=name)
+        node.base_dir = wd
+        node.inputs.log_dir = log_dir
+        node.inputs.value = 1
+        node.config = {'execution': {'content_store_dir': store_dir,
+                                     'crashdump_dir': wd}}
+        results.append(node.run())
+        out_file = os.path.join(node.output_dir(), 'out.txt')
+        yield assert_equal, results[-1].outputs.out_file, out_file
+    # second node reused the stored outputs
+    yield assert_equal, len(os.listdir(log_dir)), 1
+    yield assert_true, os.path.samefile(results[0].outputs.out_file,
+                                        results[1].outputs.out_file)
+
+    def func2(in_file):
+        import os
+        import shutil
+        out_file = os.path.abspath('out.txt')
+        shutil.copy(in_file, out_file)
+        return out_file
+
+    # files with the same size and mtime are not mixed up by timestamp hashing
+    contents = []
+    for name in ['n3', 'n4']:
+        in_file = os.path.join(wd, '%s.txt' % name)
+        with open(in_file, 'wt') as fp:
+            fp.write(name)
+        os.utime(in_file, (0, 0))
+        node = Node(Function(input_names=['in_file'],
+                             output_names=['out_file'],
+                             function=func2),
+                    name=name)
+        node.base_dir = wd
+        node.inputs.in_file = in_file
+        node.config = {'execution': {'content_store_dir': store_dir,
+                                     'hash_method': 'timestamp',
+                                     'crashdump_dir': wd}}
+        with open(node.run().outputs.out_file) as fp:
+            contents.append(fp.read())
+    yield assert_equal, contents, ['n3', 'n4']
+
+    # nodes that must always run are executed even if their outputs are
+    # in the store
+    for name, overwrite, always_run in [('n5', True, False),
+                                        ('n6', None, True)]:
+        for base_dir in ['a', 'b']:
+            node = Node(Function(input_names=['log_dir', 'value'],
+                                 output_names=['out_file'],
+                                 function=func1),
+                        name=name, overwrite=overwrite)
+            node._interface._always_run = always_run
+            node.base_dir = os.path.join(wd, base_dir)
+            node.inputs.log_dir = log_dir
+            node.inputs.value = name
+            node.config = {'execution': {'content_store_dir': store_dir,
+                                         'crashdump_dir': wd}}
+            node.run()
+    yield assert_equal, len(os.listdir(log_dir)), 5
+    os.chdir(cwd)
+    rmtree(wd)
@@ -34,12 +34,12 @@ import networkx as nx
 
 from ...external.six import string_types
 from ...utils.filemanip import (fname_presuffix, FileNotFoundError,
-                                filename_to_list, get_related_files)
+                                filename_to_list, get_related_files,
+                                hash_infile, copyfile, savepkl, loadpkl)
 from ...utils.misc import create_function_from_source, str2bool
 from ...interfaces.base import (CommandLine, isdefined, Undefined,
                                 InterfaceResult)
 from ...interfaces.utility import IdentityInterface
-from ...utils.provenance import ProvStore, pm, nipype_ns, get_id
 
 from ... import logging, config
 logger = logging.getLogger('workflow')
@@ -200,6 +200,38 @@ def modify_paths(object, relative=True, basedir=None):
     return out
 
 
+def relocate_paths(object, src, dst):
+    """Move paths located under directory ``src`` to directory ``dst``
+
+    Supports combinations of lists, dicts, tuples, strs. Paths outside of
+    ``src`` are returned unchanged.
+
+    >>> from nipype.pipeline.engine.utils import relocate_paths
+    >>> relocate_paths({'a': ['/scratch/x/out.nii', '/data/in.nii']},
+    ...                '/scratch/x', '/work/node')
+    {'a': ['/work/node/out.nii', '/data/in.nii']}
+    """
+    if isinstance(object, dict):
+        out = {}
+        for key, val in sorted(object.items()):
+            if isdefined(val):
+                out[key] = relocate_paths(val, src, dst)
+    elif isinstance(object, (list, tuple)):
+        out = []
+        for val in object:
+            if isdefined(val):
+                out.append(relocate_paths(val, src, dst))
+        if isinstance(object, tuple):
+            out = tuple(out)
+    elif isinstance(object, string_types) and \
+            (object.rstrip(os.sep) == src.rstrip(os.sep) or
+             object.startswith(src.rstrip(os.sep) + os.sep)):
+        out = dst.rstrip(os.sep) + object[len(src.rstrip(os.sep)):]
+    else:
+        out = object
+    return out
+
+
 def get_print_name(node, simple_form=True):
     """Get the name of the node
 
@@ -1099,6 +1131,117 @@ def walk_files(cwd):
             yield os.path.join(path, f)
 
 
+def _store_paths(store_dir, key):
+    """Return the index file for ``key`` in a content-addressed store"""
+    return os.path.join(store_dir, 'index', key[:2], '%s.pklz' % key)
+
+
+def _store_object(store_dir, digest):
+    return os.path.join(store_dir, 'objects', digest[:2], digest[2:])
+
+
+def _link_or_replace(src, dst):
+    """Atomically make ``dst`` a hard link to ``src``"""
+    tmpname = '%s.%d.tmp' % (dst, os.getpid())
+    os.link(src, tmpname)
+    os.rename(tmpname, dst)
+
+
+def store_outputs(store_dir, key, result, cwd):
+    """Store the output files of a node in a content-addressed store
+
+    Every output file located in ``cwd`` is stored once under the hash of
+    its content. Files with a content already present in the store are
+    replaced by hard links to the stored copy. An index entry for ``key``
+    records the results and the location of each file relative to ``cwd``.
+
+    Returns True if all files could be stored (the store must be on the
+    same filesystem as ``cwd``).
+    """
+    if not result.outputs:
+        return False
+    try:
+        outputs = result.outputs.get()
+    except TypeError:
+        outputs = result.outputs.dictcopy()
+    cwd = os.path.abspath(cwd)
+    files = []
+    for path, pathtype in walk_outputs(outputs):
+        if pathtype == 'd':
+            files.extend(walk_files(path))
+        else:
+            files.append(path)
+    manifest = {}
+    for fname in sorted(set(files)):
+        fname = os.path.abspath(fname)
+        if os.path.islink(fname) or \
+                not fname.startswith(cwd + os.sep):
+            continue
+        digest = hash_infile(fname)
+        objfile = _store_object(store_dir, digest)
+        try:
+            if not os.path.exists(objfile):
+                if not os.path.isdir(os.path.dirname(objfile)):
+                    os.makedirs(os.path.dirname(objfile))
+                os.link(fname, objfile)
+            elif not os.path.samefile(fname, objfile):
+                logger.debug('Deduplicating %s' % fname)
+                _link_or_replace(objfile, fname)
+        except OSError as e:
+            logger.warn('Could not store %s in %s: %s' %
+                        (fname, store_dir, e))
+            return False
+        manifest[relpath(fname, start=cwd)] = digest
+    indexfile = _store_paths(store_dir, key)
+    if not os.path.isdir(os.path.dirname(indexfile)):
+        os.makedirs(os.path.dirname(indexfile))
+    savepkl(indexfile, dict(cwd=cwd, manifest=manifest, result=result))
+    return True
+
+
+def load_stored_outputs(store_dir, key, cwd):
+    """Materialize the outputs stored for ``key`` in directory ``cwd``
+
+    Returns the stored results, with paths rewritten to ``cwd``, or None
+    if nothing (or an incomplete set of files) is stored for ``key``.
+    """
+    indexfile = _store_paths(store_dir, key)
+    if not os.path.exists(indexfile):
+        return None
+    try:
+        entry = loadpkl(indexfile)
+    except Exception as e:
+        logger.debug('Could not load %s: %s' % (indexfile, e))
+        return None
+    objects = dict([(name, _store_object(store_dir, digest))
+                    for name, digest in list(entry['manifest'].items())])
+    if not all([os.path.exists(objfile) for objfile in objects.values()]):
+        return None
+    for name, objfile in list(objects.items()):
+        fname = os.path.join(cwd, name)
+        if not os.path.isdir(os.path.dirname(fname)):
+            os.makedirs(os.path.dirname(fname))
+        if os.path.lexists(fname):
+            os.unlink(fname)
+        try:
+            os.link(objfile, fname)
+        except OSError:
+            copyfile(objfile, fname, copy=True)
+    result = entry['result']
+    if result.outputs:
+        try:
+            outputs = result.outputs.get()
+        except TypeError:
+            outputs = result.outputs.dictcopy()
+        try:
+            result.outputs.set(**relocate_paths(outputs, entry['cwd'], cwd))
+        except Exception as e:
+            logger.debug('Stored outputs are not usable: %s' % e)
+            return None
+    result.runtime.cwd = cwd
+    return result
+
+
 def clean_working_directory(outputs, cwd, inputs, needed_outputs, config,
                             files2keep=None, dirs2keep=None):
     """Removes all files not needed for further analysis from the directory
@@ -1210,6 +1353,7 @@ def merge_bundles(g1, g2):
 def write_workflow_prov(graph, filename=None, format='all'):
     """Write W3C PROV Model JSON file
     """
+    from ...utils.provenance import ProvStore, pm, nipype_ns, get_id
     if not filename:
         filename = os.path.join(os.getcwd(), 'workflow_provenance')
 
@@ -10,6 +10,7 @@ from copy import deepcopy
 from glob import glob
 import os
 import getpass
+import gzip
 import shutil
 from socket import gethostname
 import sys
@@ -21,8 +22,11 @@ import numpy as np
 import scipy.sparse as ssp
 
 
-from ...utils.filemanip import savepkl, loadpkl
+from ...utils.filemanip import savepkl, loadpkl, get_related_files
 from ...utils.misc import str2bool
+from ...external.six import string_types
+from ...interfaces.io import (DataSink, XNATSink, SQLiteSink, MySQLSink,
+                              JSONFileSink)
 from ..engine.utils import (nx, dfs_preorder, topological_sort)
 from ..engine import MapNode
 
@@ -94,6 +98,32 @@ def report_nodes_not_run(notrun):
                             'Check log for details'))
 
 
+def _output_files(value):
+    """Returns the existing files referenced by an output value"""
+    files = []
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            files.extend(_output_files(item))
+    elif isinstance(value, dict):
+        for item in list(value.values()):
+            files.extend(_output_files(item))
+    elif isinstance(value, string_types) and os.path.isfile(value):
+        for fname in get_related_files(value):
+            if os.path.isfile(fname):
+                files.append(os.path.realpath(fname))
+    return files
+
+
+def free_disk_gb(path):
+    """Returns the free space (in GB) of the filesystem holding ``path``
+    """
+    path = os.path.abspath(path)
+    while not os.path.exists(path):
+        path = os.path.dirname(path)
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize / float(1024 ** 3)
+
+
 def create_pyscript(node, updatehash=False, store_exception=True):
     # pickle node
     timestamp = strftime('%Y%m%d_%H%M%S')
@@ -114,13 +144,8 @@ def create_pyscript(node, updatehash=False, store_exception=True):
     cmdstr = """import os
 import sys
 
-can_import_matplotlib = True #Silently allow matplotlib to be ignored
-try:
-    import matplotlib
-    matplotlib.use('%s')
-except ImportError:
-    can_import_matplotlib = False
-    pass
+# matplotlib is only imported if the interface of the node needs it
+os.environ.setdefault('MPLBACKEND', '%s')
 
 from nipype import config, logging
 from nipype.utils.filemanip import loadpkl, savepkl
@@ -129,21 +154,20 @@ from traceback import format_exception
 info = None
 pklfile = '%s'
 batchdir = '%s'
-from nipype.utils.filemanip import loadpkl, savepkl
 try:
     if not sys.version_info < (2, 7):
         from collections import OrderedDict
     config_dict=%s
     config.update_config(config_dict)
-    ## Only configure matplotlib if it was successfully imported, matplotlib is an optional component to nipype
-    if can_import_matplotlib:
-        config.update_matplotlib()
     logging.update_logging(config)
     traceback=None
     cwd = os.getcwd()
+    # unpickling the node only imports the modules its interface needs
     info = loadpkl(pklfile)
+    if 'matplotlib' in sys.modules:
+        config.update_matplotlib()
     result = info['node'].run(updatehash=info['updatehash'])
-except Exception, e:
+except Exception as e:
     etype, eval, etr = sys.exc_info()
     traceback = format_exception(etype,eval,etr)
     if info is None or not os.path.exists(info['node'].output_dir()):
@@ -207,11 +231,21 @@ class DistributedPluginBase(PluginBase):
         proc_pending==False
         depidx: a boolean matrix (NxN) storing the dependency structure accross
             processes. Process dependencies are derived from each column.
+        refidx: a matrix (NxN) storing which consumers of a process have not
+            finished yet. Rows are emptied as consumers finish.
         """
         super(DistributedPluginBase, self).__init__(plugin_args=plugin_args)
         self.procs = None
         self.depidx = None
         self.refidx = None
+        self._released = []
+        self._output_consumers = None
+        self._sink_outputs = None
+        self._file_consumers = {}
+        self._job_files = {}
+        self._protected_files = set()
+        self._file_producers = {}
+        self._disk_throttled = False
         self.mapnodes = None
         self.mapnodesubids = None
         self.proc_done = None
@@ -219,6 +253,9 @@ class DistributedPluginBase(PluginBase):
         self.max_jobs = np.inf
         if plugin_args and 'max_jobs' in plugin_args:
             self.max_jobs = plugin_args['max_jobs']
+        self._scratch_dir = None
+        if plugin_args and 'scratch_dir' in plugin_args:
+            self._scratch_dir = plugin_args['scratch_dir']
 
     def run(self, graph, config, updatehash=False):
         """Executes a pre-defined pipeline using distributed approaches
@@ -261,21 +298,55 @@ class DistributedPluginBase(PluginBase):
                 self.pending_tasks.extend(toappend)
             num_jobs = len(self.pending_tasks)
             logger.debug('Number of pending tasks: %d' % num_jobs)
-            if num_jobs < self.max_jobs:
+            if num_jobs >= self.max_jobs:
+                logger.debug('Not submitting')
+            elif not self._disk_space_available(graph):
+                if not self._disk_throttled:
+                    logger.warn(('Free disk space below min_free_disk_gb: '
+                                 'waiting for %d pending tasks before '
+                                 'submitting') % num_jobs)
+                    self._disk_throttled = True
+            else:
+                if self._disk_throttled:
+                    logger.info('Resuming submission of tasks')
+                    self._disk_throttled = False
                 self._send_procs_to_workers(updatehash=updatehash,
                                             graph=graph)
-            else:
-                logger.debug('Not submitting')
             self._wait()
-            
+
         self._remove_node_dirs()
         report_nodes_not_run(notrun)
 
+    def _disk_space_available(self, graph):
+        """Checks the free space in the working directory
+
+        Submission is throttled while free space is below
+        ``min_free_disk_gb`` and there are still tasks running, so that
+        finished tasks can release intermediate files. With nothing running,
+        jobs are always submitted to avoid stalling the workflow.
+        """
+        min_free = float(self._config['execution'].get('min_free_disk_gb',
+                                                       0))
+        if min_free <= 0 or not self.pending_tasks:
+            return True
+        base_dir = self.procs[0].base_dir or os.getcwd()
+        return free_disk_gb(base_dir) >= min_free
 
 
     def _wait(self):
         sleep(float(self._config['execution']['poll_sleep_duration']))
 
+    def _set_scratch_dir(self, node):
+        """Makes the node execute in node-local scratch space
+
+        The directory is only resolved on the host running the node, so it
+        may contain environment variables such as ``$TMPDIR``.
+        """
+        if self._scratch_dir:
+            if node.config is None:
+                node.config = {'execution': {}}
+            node.config['execution']['local_scratch_dir'] = self._scratch_dir
+
     def _get_result(self, taskid):
         raise NotImplementedError
 
@@ -432,7 +503,17 @@ class DistributedPluginBase(PluginBase):
         rowview = self.depidx.getrowview(jobid)
         rowview[rowview.nonzero()] = 0
         if jobid not in self.mapnodesubids:
-            self.refidx[self.refidx[:, jobid].nonzero()[0], jobid] = 0
+            producers = self.refidx[:, jobid].nonzero()[0]
+            self.refidx[producers, jobid] = 0
+            # keep track of processes whose consumers have all finished
+            for idx in producers:
+                if not self.refidx[idx, :].nonzero()[0].size:
+                    self._released.append(idx)
+            if not self.refidx[jobid, :].nonzero()[0].size:
+                self._released.append(jobid)
+            if self._collect_intermediate_files():
+                self._register_intermediate_files(jobid)
+                self._release_intermediate_files(jobid)
 
     def _generate_dependency_list(self, graph):
         """ Generates a dependency list for a list of graphs.
@@ -449,6 +530,29 @@ class DistributedPluginBase(PluginBase):
         self.refidx.astype = np.int
         self.proc_done = np.zeros(len(self.procs), dtype=bool)
         self.proc_pending = np.zeros(len(self.procs), dtype=bool)
+        self._released = []
+        self._file_consumers = {}
+        self._job_files = {}
+        self._protected_files = set()
+        self._file_producers = {}
+        self._generate_output_consumers(graph)
+
+    def _generate_output_consumers(self, graph):
+        """Maps each output of each process to the processes consuming it
+        """
+        index = dict((node, idx) for idx, node in enumerate(self.procs))
+        sinks = (DataSink, XNATSink, SQLiteSink, MySQLSink, JSONFileSink)
+        self._output_consumers = {}
+        self._sink_outputs = set()
+        for u, v, data in graph.edges(data=True):
+            for src, _ in data.get('connect', []):
+                if isinstance(src, tuple):
+                    src = src[0]
+                consumers = self._output_consumers.setdefault(
+                    index[u], {}).setdefault(src, set())
+                consumers.add(index[v])
+                if isinstance(v._interface, sinks):
+                    self._sink_outputs.add((index[u], src))
 
     def _remove_node_deps(self, jobid, crashfile, graph):
         subnodes = [s for s in dfs_preorder(graph, self.procs[jobid])]
@@ -462,19 +566,108 @@ class DistributedPluginBase(PluginBase):
 
     def _remove_node_dirs(self):
         """Removes directories whose outputs have already been used up
+
+        Only processes released since the last call (i.e., whose consumers
+        all finished) are examined.
         """
-        if str2bool(self._config['execution']['remove_node_directories']):
-            for idx in np.nonzero(
-                                 (self.refidx.sum(axis=1) == 0).__array__())[0]:
-                if idx in self.mapnodesubids:
+        released, self._released = self._released, []
+        if not str2bool(self._config['execution']['remove_node_directories']):
+            return
+        for idx in released:
+            if idx in self.mapnodesubids:
+                continue
+            if self.proc_done[idx] and (not self.proc_pending[idx]):
+                outdir = self.procs[idx].output_dir()
+                if not os.path.exists(outdir):
                     continue
-                if self.proc_done[idx] and (not self.proc_pending[idx]):
-                    self.refidx[idx, idx] = -1
-                    outdir = self.procs[idx]._output_directory()
-                    logger.info(('[node dependencies finished] '
-                                 'removing node: %s from directory %s') %
-                                (self.procs[idx]._id, outdir))
-                    shutil.rmtree(outdir)
+                logger.info(('[node dependencies finished] '
+                             'removing node: %s from directory %s') %
+                            (self.procs[idx]._id, outdir))
+                shutil.rmtree(outdir)
+
+    def _collect_intermediate_files(self):
+        value = self._config['execution'].get('remove_intermediate_files',
+                                              'false')
+        return value.lower() == 'compress' or str2bool(value)
+
+    def _register_intermediate_files(self, jobid):
+        """Records the output files of a finished process and their consumers
+
+        Files are only collected if they live in the working directory of the
+        process that created them. Files passed through by a process (e.g.,
+        an IdentityInterface) inherit the consumers of the passing process.
+        Outputs that feed a sink, or that are not consumed by any other
+        process, are never removed.
+        """
+        node = self.procs[jobid]
+        try:
+            result = node.result
+        except Exception:
+            result = None
+        if result is None or not result.outputs:
+            return
+        try:
+            outputs = result.outputs.get()
+        except TypeError:
+            outputs = result.outputs.dictcopy()
+        outdir = os.path.realpath(node.output_dir()) + os.sep
+        consumers = self._output_consumers.get(jobid, {})
+        for field, value in list(outputs.items()):
+            field_consumers = consumers.get(field, set())
+            keep = (not field_consumers or
+                    (jobid, field) in self._sink_outputs)
+            for fname in _output_files(value):
+                if keep:
+                    self._protected_files.add(fname)
+                    continue
+                if not (fname.startswith(outdir) or
+                        fname in self._file_consumers):
+                    continue
+                self._file_producers.setdefault(fname, jobid)
+                self._file_consumers.setdefault(fname, set()).update(
+                    field_consumers)
+                for consumer in field_consumers:
+                    self._job_files.setdefault(consumer, set()).add(fname)
+
+    def _release_intermediate_files(self, jobid):
+        """Removes (or compresses) files whose consumers have all finished
+
+        The hashfiles of the processes that produced the files are removed,
+        so that these processes are rerun (instead of being considered
+        cached) if the workflow is run again.
+        """
+        compress = (self._config['execution']['remove_intermediate_files']
+                    .lower() == 'compress')
+        producers = set()
+        for fname in self._job_files.pop(jobid, []):
+            consumers = self._file_consumers.get(fname)
+            if consumers is None:
+                continue
+            consumers.discard(jobid)
+            if consumers or fname in self._protected_files:
+                continue
+            del self._file_consumers[fname]
+            if not os.path.exists(fname):
+                continue
+            producers.add(self._file_producers.pop(fname))
+            try:
+                if compress and not fname.endswith('.gz'):
+                    logger.debug('Compressing intermediate file %s' % fname)
+                    with open(fname, 'rb') as fin:
+                        with gzip.open(fname + '.gz', 'wb') as fout:
+                            shutil.copyfileobj(fin, fout)
+                    os.unlink(fname)
+                elif not compress:
+                    logger.debug('Removing intermediate file %s' % fname)
+                    os.unlink(fname)
+            except (IOError, OSError) as e:
+                logger.warn('Could not release intermediate file %s: %s' %
+                            (fname, e))
+        for idx in producers:
+            for hashfile in glob(os.path.join(self.procs[idx].output_dir(),
+                                              '_0x*.json')):
+                logger.debug('Removing hashfile %s' % hashfile)
+                os.unlink(hashfile)
 
 
 class SGELikeBatchManagerBase(DistributedPluginBase):
@@ -559,6 +752,7 @@ class SGELikeBatchManagerBase(DistributedPluginBase):
     def _submit_job(self, node, updatehash=False):
         """submit job and return taskid
         """
+        self._set_scratch_dir(node)
         pyscript = create_pyscript(node, updatehash=updatehash)
         batch_dir, name = os.path.split(pyscript)
         name = '.'.join(name.split('.')[:-1])
@@ -126,6 +126,9 @@ class MultiProcPlugin(DistributedPluginBase):
     - non_daemon : boolean flag to execute as non-daemon processes
     - n_procs: maximum number of threads to be executed in parallel
     - memory_gb: maximum memory (in GB) that can be used at once.
+    - scratch_dir: run each node in a temporary directory under this path
+      (e.g. '$TMPDIR') and copy only its outputs back to the working
+      directory
 
     """
 
@@ -180,6 +183,7 @@ class MultiProcPlugin(DistributedPluginBase):
 
     def _submit_job(self, node, updatehash=False):
         self._taskid += 1
+        self._set_scratch_dir(node)
         if hasattr(node.inputs, 'terminal_output'):
             if node.inputs.terminal_output == 'stream':
                 node.inputs.terminal_output = 'allatonce'
@@ -1,6 +1,7 @@
 import logging
 import os
 from tempfile import mkdtemp
+from glob import glob
 from shutil import rmtree
 from multiprocessing import cpu_count
 
@@ -234,3 +235,44 @@ def test_do_not_use_more_threads_then_specified():
           "using more memory than system has (memory is not specified by user)"
 
     os.remove(LOG_FILENAME)
+
+
+def _write_file(in_file, name):
+    import os
+    out_file = os.path.abspath(name)
+    with open(out_file, 'wt') as fp:
+        fp.write('data')
+    return out_file
+
+
+def test_remove_intermediate_files():
+    from nipype.interfaces.utility import Function
+    cur_dir = os.getcwd()
+    temp_dir = mkdtemp(prefix='test_engine_')
+    os.chdir(temp_dir)
+
+    pipe = pe.Workflow(name='pipe')
+    nodes = []
+    for i in range(3):
+        nodes.append(pe.Node(Function(input_names=['in_file', 'name'],
+                                      output_names=['out_file'],
+                                      function=_write_file),
+                             name='mod%d' % i))
+        nodes[-1].inputs.name = 'file%d.txt' % i
+    nodes[0].inputs.in_file = 'none'
+    pipe.connect(nodes[0], 'out_file', nodes[1], 'in_file')
+    pipe.connect(nodes[1], 'out_file', nodes[2], 'in_file')
+    pipe.base_dir = os.getcwd()
+    pipe.config['execution']['poll_sleep_duration'] = 1
+    pipe.config['execution']['remove_intermediate_files'] = 'true'
+    pipe.run(plugin='MultiProc')
+    for i, exists in enumerate([False, False, True]):
+        out_file = os.path.join(temp_dir, 'pipe', 'mod%d' % i,
+                                'file%d.txt' % i)
+        yield assert_equal, os.path.exists(out_file), exists
+        # the producers of removed files are not considered cached
+        hashfiles = glob(os.path.join(temp_dir, 'pipe', 'mod%d' % i,
+                                      '_0x*.json'))
+        yield assert_equal, len(hashfiles), int(exists)
+    os.chdir(cur_dir)
+    rmtree(temp_dir)
@@ -36,6 +36,7 @@ log_size = 16384000
 log_rotate = 4
 
 [execution]
+content_store_dir =
 create_report = true
 crashdump_dir = %s
 display_variable = :1
@@ -43,8 +44,11 @@ hash_method = timestamp
 job_finished_timeout = 5
 keep_inputs = false
 local_hash_check = true
+local_scratch_dir =
 matplotlib_backend = Agg
 plugin = Linear
+min_free_disk_gb = 0
+remove_intermediate_files = false
 remove_node_directories = false
 remove_unnecessary_outputs = true
 try_hard_link_datasink = true
@@ -16,8 +16,8 @@ import os
 import re
 import shutil
 import posixpath
-
-import numpy as np
+import sys
+from tempfile import mkstemp
 
 from .misc import is_container
 from ..external.six import string_types
@@ -174,8 +174,96 @@ def hash_timestamp(afile):
     return md5hex
 
 
+# ioctl request number for FICLONE (linux/fs.h)
+FICLONE = 0x40049409
+
+# staging mechanisms that do not duplicate file data
+LINK_METHODS = ('kept', 'hardlink', 'symlink', 'reflink')
+
+
+def _record_staging(stats, method, filename):
+    """Add the size of ``filename`` to the ``method`` entry of ``stats``"""
+    if stats is None:
+        return
+    try:
+        nbytes = os.stat(filename).st_size
+    except OSError:
+        nbytes = 0
+    stats[method] = stats.get(method, 0) + nbytes
+
+
+def summarize_staging(stats):
+    """Split staging statistics into bytes linked and bytes copied
+
+    Parameters
+    ----------
+    stats : dict
+        mapping of staging method to number of bytes, as filled by
+        :func:`copyfile`
+
+    Returns
+    -------
+    linked : int
+        bytes made available without duplicating data (kept, hard links,
+        symbolic links and copy-on-write clones)
+    copied : int
+        bytes physically duplicated (``copy_file_range`` or plain copy)
+
+    >>> from nipype.utils.filemanip import summarize_staging
+    >>> summarize_staging({'symlink': 10, 'reflink': 5, 'copy': 3})
+    (15, 3)
+
+    """
+    linked = sum([v for k, v in list(stats.items()) if k in LINK_METHODS])
+    copied = sum([v for k, v in list(stats.items())
+                  if k not in LINK_METHODS])
+    return linked, copied
+
+
+def _clone_file(originalfile, newfile):
+    """Create an independent copy of ``originalfile`` at ``newfile``
+
+    A copy-on-write clone (reflink) is attempted first, then an in-kernel
+    ``copy_file_range`` copy. A regular user-space copy is only made when
+    the filesystem supports neither.
+
+    Returns
+    -------
+    method : str
+        one of 'reflink', 'copy_file_range' or 'copy'
+    """
+    with open(originalfile, 'rb') as src, open(newfile, 'wb') as dst:
+        if sys.platform.startswith('linux'):
+            try:
+                import fcntl
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+            except (ImportError, IOError, OSError):
+                pass
+            else:
+                return 'reflink'
+        if hasattr(os, 'copy_file_range'):
+            size = os.fstat(src.fileno()).st_size
+            copied = 0
+            try:
+                while copied < size:
+                    nbytes = os.copy_file_range(src.fileno(), dst.fileno(),
+                                                size - copied)
+                    if nbytes == 0:
+                        break
+                    copied += nbytes
+            except OSError:
+                pass
+            if copied == size:
+                return 'copy_file_range'
+            src.seek(0)
+            dst.seek(0)
+            dst.truncate()
+        shutil.copyfileobj(src, dst)
+    return 'copy'
+
+
 def copyfile(originalfile, newfile, copy=False, create_new=False,
-             hashmethod=None, use_hardlink=False):
+             hashmethod=None, use_hardlink=False, stats=None):
     """Copy or link ``originalfile`` to ``newfile``.
 
     If ``use_hardlink`` is True, and the file can be hard-linked, then a
@@ -184,6 +272,10 @@ def copyfile(originalfile, newfile, copy=False, create_new=False,
     If a hard link is not created and ``copy`` is False, then a symbolic
     link is created.
 
+    When a copy is required, a copy-on-write clone is preferred, followed
+    by an in-kernel ``copy_file_range`` copy, and only then a regular
+    copy.
+
     Parameters
     ----------
     originalfile : str
@@ -196,10 +288,15 @@ def copyfile(originalfile, newfile, copy=False, create_new=False,
     use_hardlink : Bool
         specifies whether to hard-link files, when able
         (Default=False), taking precedence over copy
+    stats : dict
+        if given, the number of bytes staged is accumulated per method
+        ('kept', 'hardlink', 'symlink', 'reflink', 'copy_file_range' or
+        'copy'), including associated files
 
     Returns
     -------
-    None
+    newfile : str
+        path of the staged file
 
     """
     newhash = None
@@ -234,8 +331,8 @@ def copyfile(originalfile, newfile, copy=False, create_new=False,
     keep = False
     if os.path.lexists(newfile):
         if os.path.islink(newfile):
-            if all(os.path.readlink(newfile) == originalfile, not use_hardlink,
-                   not copy):
+            if all((os.path.readlink(newfile) == originalfile,
+                    not use_hardlink, not copy)):
                 keep = True
         elif posixpath.samefile(newfile, originalfile):
             keep = True
@@ -252,6 +349,7 @@ def copyfile(originalfile, newfile, copy=False, create_new=False,
         if keep:
             fmlogger.debug("File: %s already exists, not overwriting, copy:%d"
                            % (newfile, copy))
+            _record_staging(stats, 'kept', newfile)
         else:
             os.unlink(newfile)
 
@@ -269,6 +367,7 @@ def copyfile(originalfile, newfile, copy=False, create_new=False,
             use_hardlink = False  # Disable hardlink for associated files
         else:
             keep = True
+            _record_staging(stats, 'hardlink', newfile)
 
     if not keep and not copy and os.name == 'posix':
         try:
@@ -278,30 +377,28 @@ def copyfile(originalfile, newfile, copy=False, create_new=False,
             copy = True  # Disable symlink for associated files
         else:
             keep = True
+            _record_staging(stats, 'symlink', newfile)
 
     if not keep:
         try:
             fmlogger.debug("Copying File: %s->%s" % (newfile, originalfile))
-            shutil.copyfile(originalfile, newfile)
+            method = _clone_file(originalfile, newfile)
         except shutil.Error as e:
             fmlogger.warn(e.message)
+        else:
+            _record_staging(stats, method, newfile)
 
     # Associated files
-    if originalfile.endswith(".img"):
-        hdrofile = originalfile[:-4] + ".hdr"
-        hdrnfile = newfile[:-4] + ".hdr"
-        matofile = originalfile[:-4] + ".mat"
-        if os.path.exists(matofile):
-            matnfile = newfile[:-4] + ".mat"
-            copyfile(matofile, matnfile, copy, hashmethod=hashmethod,
-                     use_hardlink=use_hardlink)
-        copyfile(hdrofile, hdrnfile, copy, hashmethod=hashmethod,
-                 use_hardlink=use_hardlink)
-    elif originalfile.endswith(".BRIK"):
-        hdrofile = originalfile[:-5] + ".HEAD"
-        hdrnfile = newfile[:-5] + ".HEAD"
-        copyfile(hdrofile, hdrnfile, copy, hashmethod=hashmethod,
-                 use_hardlink=use_hardlink)
+    if originalfile.endswith(".img") or originalfile.endswith(".BRIK"):
+        related = zip(get_related_files(originalfile),
+                      get_related_files(newfile))
+        for relofile, relnfile in related:
+            # .mat files are optional companions of Analyze images
+            if relofile == originalfile or (relofile.endswith('.mat') and
+                                            not os.path.exists(relofile)):
+                continue
+            copyfile(relofile, relnfile, copy, hashmethod=hashmethod,
+                     use_hardlink=use_hardlink, stats=stats)
 
     return newfile
 
@@ -324,7 +421,7 @@ def get_related_files(filename):
     return related_files
 
 
-def copyfiles(filelist, dest, copy=False, create_new=False):
+def copyfiles(filelist, dest, copy=False, create_new=False, stats=None):
     """Copy or symlink files in ``filelist`` to ``dest`` directory.
 
     Parameters
@@ -338,6 +435,8 @@ def copyfiles(filelist, dest, copy=False, create_new=False):
     copy : Bool
         specifies whether to copy or symlink files
         (default=False) but only for posix systems
+    stats : dict
+        accumulates bytes staged per method (see :func:`copyfile`)
 
     Returns
     -------
@@ -349,17 +448,51 @@ def copyfiles(filelist, dest, copy=False, create_new=False):
     for i, f in enumerate(filename_to_list(filelist)):
         if isinstance(f, list):
             newfiles.insert(i, copyfiles(f, dest, copy=copy,
-                                         create_new=create_new))
+                                         create_new=create_new,
+                                         stats=stats))
         else:
             if len(outfiles) > 1:
                 destfile = outfiles[i]
             else:
                 destfile = fname_presuffix(f, newpath=outfiles[0])
-            destfile = copyfile(f, destfile, copy, create_new=create_new)
+            destfile = copyfile(f, destfile, copy, create_new=create_new,
+                                stats=stats)
             newfiles.insert(i, destfile)
     return newfiles
 
 
+def publish_file(filename, writer):
+    """Create filename atomically
+
+    The file is written by ``writer(path)`` to a temporary path in the same
+    directory and then renamed, so that concurrent runs never see a partial
+    file.
+
+    Parameters
+    ----------
+    filename : str
+        file to create; missing parent directories are created
+    writer : callable
+        writes the contents of the file to the path it is given
+    """
+    dirname = os.path.dirname(os.path.abspath(filename))
+    if not os.path.isdir(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+    _, _, ext = split_filename(filename)
+    fd, tmp_file = mkstemp(suffix=ext, dir=dirname)
+    os.close(fd)
+    try:
+        writer(tmp_file)
+    except:
+        os.remove(tmp_file)
+        raise
+    os.rename(tmp_file, filename)
+
+
 def filename_to_list(filename):
     """Returns a list given either a string or a list
     """
@@ -424,6 +557,7 @@ def loadcrash(infile, *args):
     elif '.npz' in infile:
         DeprecationWarning(('npz files will be deprecated in the next '
                             'release. you can use numpy to open them.'))
+        import numpy as np
         data = np.load(infile)
         out = {}
         for k in data.files:
@@ -445,6 +579,18 @@ def loadpkl(infile):
     return pickle.load(pkl_file)
 
 
+def slab_source(in_file):
+    """Return the data of an image ready to be sliced: uncompressed images
+    are read from disk as needed, compressed images are read in memory"""
+    import nibabel as nb
+    import numpy as np
+
+    img = nb.load(in_file)
+    if in_file.endswith('.gz'):
+        return np.asanyarray(img.dataobj)
+    return img.dataobj
+
+
 def savepkl(filename, record):
     if filename.endswith('pklz'):
         pkl_file = gzip.open(filename, 'wb')
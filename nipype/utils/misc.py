@@ -8,10 +8,10 @@ standard_library.install_aliases()
 from future.utils import raise_from
 from builtins import next
 from pickle import dumps, loads
+from importlib import import_module
 import inspect
 
 from distutils.version import LooseVersion
-import numpy as np
 from textwrap import dedent
 import sys
 import re
@@ -108,10 +108,65 @@ def create_function_from_source(function_source, imports=None):
 
 def find_indices(condition):
     "Return the indices where ravel(condition) is true"
+    import numpy as np
     res, = np.nonzero(np.ravel(condition))
     return res
 
 
+def lazy_attributes(module_name, attributes):
+    """Defer the import of attributes of a module until first access
+
+    This keeps ``import nipype`` (and the bootstrap of every cluster job)
+    from importing packages that are not needed.
+
+    Parameters
+    ----------
+    module_name : str
+        name of the module whose attributes are resolved lazily (usually
+        ``__name__``)
+    attributes : dict
+        maps each attribute name to the full name of the module providing
+        it. A subpackage or submodule maps to its own name.
+
+    Examples
+    --------
+    >>> import sys, types
+    >>> from nipype.utils.misc import lazy_attributes
+    >>> sys.modules['lazytest'] = types.ModuleType('lazytest')
+    >>> lazy_attributes('lazytest', {'dedent': 'textwrap'})
+    >>> import lazytest
+    >>> lazytest.dedent('  a')
+    'a'
+    """
+    module = sys.modules[module_name]
+
+    class LazyModule(type(module)):
+
+        def __getattr__(self, name):
+            if name not in attributes:
+                raise AttributeError("module '%s' has no attribute '%s'" %
+                                     (module_name, name))
+            provider = import_module(attributes[name])
+            if attributes[name] == '%s.%s' % (module_name, name):
+                value = provider
+            else:
+                value = getattr(provider, name)
+            setattr(self, name, value)
+            return value
+
+        def __dir__(self):
+            return sorted(set(list(self.__dict__.keys()) +
+                              list(attributes.keys())))
+
+    try:
+        module.__class__ = LazyModule
+    except TypeError:
+        # Python < 3.5 does not allow changing the class of a module
+        lazy = LazyModule(module_name, module.__doc__)
+        lazy.__dict__.update(module.__dict__)
+        sys.modules[module_name] = lazy
+
+
 def is_container(item):
     """Checks if item is a container (list, tuple, dict, set)
 
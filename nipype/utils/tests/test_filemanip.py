@@ -3,16 +3,19 @@
 from builtins import open
 
 import os
+import shutil
 from tempfile import mkstemp, mkdtemp
 import warnings
 
-from ...testing import assert_equal, assert_true, assert_false, TempFATFS
+from ...testing import (assert_equal, assert_true, assert_false,
+                        assert_raises, TempFATFS)
 from ...utils.filemanip import (save_json, load_json,
                                     fname_presuffix, fnames_presuffix,
                                     hash_rename, check_forhash,
                                     copyfile, copyfiles,
                                     filename_to_list, list_to_filename,
-                                    split_filename, get_related_files)
+                                    split_filename, get_related_files,
+                                    summarize_staging, publish_file)
 
 import numpy as np
 
@@ -168,6 +171,36 @@ def test_linkchain():
     os.unlink(orig_hdr)
 
 
+def test_copyfile_stats():
+    orig_img, orig_hdr = _temp_analyze_files()
+    with open(orig_img, 'wb') as fp:
+        fp.write(b'\x01' * 1000)
+    with open(orig_hdr, 'wb') as fp:
+        fp.write(b'\x02' * 348)
+    pth, fname = os.path.split(orig_img)
+    new_img1 = os.path.join(pth, 'stagedfile1.img')
+    new_hdr1 = os.path.join(pth, 'stagedfile1.hdr')
+    new_img2 = os.path.join(pth, 'stagedfile2.img')
+    new_hdr2 = os.path.join(pth, 'stagedfile2.hdr')
+    stats = {}
+    copyfile(orig_img, new_img1, copy=True, stats=stats)
+    yield assert_false, os.path.islink(new_img1)
+    yield assert_false, os.path.samefile(orig_img, new_img1)
+    with open(new_img1, 'rb') as fp:
+        yield assert_equal, fp.read(), b'\x01' * 1000
+    with open(new_hdr1, 'rb') as fp:
+        yield assert_equal, fp.read(), b'\x02' * 348
+    yield assert_equal, sum(stats.values()), 1348
+    yield assert_false, 'symlink' in stats
+    stats = {}
+    copyfile(orig_img, new_img2, copy=False, stats=stats)
+    yield assert_equal, stats, {'symlink': 1348}
+    yield assert_equal, summarize_staging(stats), (1348, 0)
+    for fname in (new_img1, new_hdr1, new_img2, new_hdr2, orig_img,
+                  orig_hdr):
+        os.unlink(fname)
+
+
 def test_copyfallback():
     if os.name is not 'posix':
         return
@@ -227,6 +260,30 @@ def test_json():
     yield assert_equal, sorted(adict.items()), sorted(new_dict.items())
 
 
+def test_publish_file():
+    tmpdir = mkdtemp()
+    name = os.path.join(tmpdir, 'cache', 'data.nii.gz')
+
+    def writer(path):
+        paths.append(path)
+        with open(path, 'w') as fp:
+            fp.write('data')
+
+    paths = []
+    publish_file(name, writer)
+    yield assert_equal, open(name).read(), 'data'
+    yield assert_true, paths[0].endswith('.nii.gz')
+    yield assert_equal, os.path.dirname(paths[0]), os.path.dirname(name)
+
+    def failing_writer(path):
+        raise IOError('disk full')
+
+    yield (assert_raises, IOError, publish_file,
+           os.path.join(tmpdir, 'cache', 'other.nii.gz'), failing_writer)
+    yield assert_equal, os.listdir(os.path.dirname(name)), ['data.nii.gz']
+    shutil.rmtree(tmpdir)
+
+
 def test_related_files():
     file1 = '/path/test.img'
     file2 = '/path/test.hdr'
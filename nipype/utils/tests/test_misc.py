@@ -84,3 +84,24 @@ def test_flatten():
 
     back = unflatten([], [])
     yield assert_equal, back, []
+
+
+def test_lazy_import():
+    import os
+    import subprocess
+    import sys
+    import nipype
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        [os.path.dirname(os.path.dirname(nipype.__file__))] +
+        [p for p in [env.get('PYTHONPATH')] if p])
+    heavy = ['numpy', 'scipy', 'networkx', 'traits', 'nibabel', 'nose']
+    code = ('import sys, nipype; '
+            'print(" ".join(m for m in %r if m in sys.modules))' % heavy)
+    out = subprocess.check_output([sys.executable, '-c', code], env=env)
+    yield assert_equal, out.decode().strip(), ''
+
+    # names exported by the package are loaded on first access
+    code = 'import nipype; print(nipype.Node.__name__)'
+    out = subprocess.check_output([sys.executable, '-c', code], env=env)
+    yield assert_equal, out.decode().strip(), 'Node'
@@ -10,29 +10,41 @@ from ....algorithms.misc import TSNR
 
 def extract_noise_components(realigned_file, noise_mask_file, num_components):
     """Derive components most reflective of physiological noise
+
+    The components are the left singular vectors of the (time x voxels)
+    matrix of normalized noise timecourses. They are computed as the
+    leading eigenvectors of its (time x time) Gram matrix, accumulated over
+    slabs of the image, so that the voxel timecourses are never all held in
+    memory.
     """
     import os
-    from nibabel import load
+    import nibabel as nb
     import numpy as np
-    import scipy as sp
-    imgseries = load(realigned_file)
-    components = None
-    mask = load(noise_mask_file).get_data()
-    voxel_timecourses = imgseries.get_data()[mask > 0]
-    voxel_timecourses[np.isnan(np.sum(voxel_timecourses, axis=1)), :] = 0
-    # remove mean and normalize by variance
-    # voxel_timecourses.shape == [nvoxels, time]
-    X = voxel_timecourses.T
-    stdX = np.std(X, axis=0)
-    stdX[stdX == 0] = 1.
-    stdX[np.isnan(stdX)] = 1.
-    stdX[np.isinf(stdX)] = 1.
-    X = (X - np.mean(X, axis=0)) / stdX
-    u, _, _ = sp.linalg.svd(X, full_matrices=False)
-    if components is None:
-        components = u[:, :num_components]
-    else:
-        components = np.hstack((components, u[:, :num_components]))
+    from nipype.utils.filemanip import slab_source
+    data = slab_source(realigned_file)
+    mask = np.asanyarray(nb.load(noise_mask_file).dataobj)
+    ntime = data.shape[3]
+    slab_size = int(max(1, 2 ** 24 // (data.shape[0] * data.shape[1] * ntime)))
+    gram = np.zeros((ntime, ntime))
+    nvoxels = 0
+    for z in range(0, data.shape[2], slab_size):
+        slab_mask = mask[:, :, z:z + slab_size] > 0
+        if not np.any(slab_mask):
+            continue
+        # voxel_timecourses.shape == [nvoxels, time]
+        voxel_timecourses = np.asarray(
+            data[:, :, z:z + slab_size, :])[slab_mask].astype(np.float64)
+        voxel_timecourses[~np.all(np.isfinite(voxel_timecourses), axis=1), :] = 0
+        # remove mean and normalize by variance
+        voxel_timecourses -= voxel_timecourses.mean(axis=1)[:, None]
+        stdX = np.sqrt((voxel_timecourses ** 2).mean(axis=1))
+        stdX[stdX == 0] = 1.
+        voxel_timecourses /= stdX[:, None]
+        gram += np.dot(voxel_timecourses.T, voxel_timecourses)
+        nvoxels += len(voxel_timecourses)
+    eigvals, eigvecs = np.linalg.eigh(gram)
+    num_components = min(num_components, ntime, nvoxels)
+    components = eigvecs[:, ::-1][:, :num_components]
     components_file = os.path.join(os.getcwd(), 'noise_components.txt')
     np.savetxt(components_file, components, fmt="%.10f")
     return components_file
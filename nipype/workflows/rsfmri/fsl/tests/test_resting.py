@@ -0,0 +1,43 @@
+# emacs: -*- mode: python; py-indent-offset: 4; indent-tabs-mode: nil -*-
+# vi: set ft=python sts=4 ts=4 sw=4 et:
+import os
+from shutil import rmtree
+from tempfile import mkdtemp
+
+import nibabel as nb
+import numpy as np
+from scipy.linalg import svd
+
+from nipype.testing import assert_equal, assert_almost_equal
+from nipype.workflows.rsfmri.fsl.resting import extract_noise_components
+
+
+def test_extract_noise_components():
+    tempdir = mkdtemp()
+    origdir = os.getcwd()
+    os.chdir(tempdir)
+
+    rng = np.random.RandomState(0)
+    timecourses = rng.randn(3, 30) * np.array([[8.], [4.], [2.]])
+    data = (np.dot(rng.randn(6 * 5 * 4, 3), timecourses) +
+            rng.randn(6 * 5 * 4, 30) + 10).reshape((6, 5, 4, 30))
+    data[0, 0, 0, 3] = np.nan
+    mask = rng.rand(6, 5, 4) > 0.3
+    nb.Nifti1Image(data, np.eye(4)).to_filename('func.nii')
+    nb.Nifti1Image(mask.astype(np.uint8), np.eye(4)).to_filename('mask.nii')
+
+    components = np.loadtxt(extract_noise_components('func.nii', 'mask.nii', 2))
+
+    X = data[mask]
+    X[np.isnan(X.sum(axis=1))] = 0
+    X = X.T - X.mean(axis=1)
+    std = X.std(axis=0)
+    std[std == 0] = 1
+    u, _, _ = svd(X / std, full_matrices=False)
+    yield assert_equal, components.shape, (30, 2)
+    # components are defined up to their sign
+    yield (assert_almost_equal, np.abs((components * u[:, :2]).sum(axis=0)),
+           [1, 1], 8)
+
+    os.chdir(origdir)
+    rmtree(tempdir)
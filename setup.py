@@ -417,6 +417,7 @@ def main(**extra_args):
                     'nipype.workflows.misc',
                     'nipype.workflows.rsfmri',
                     'nipype.workflows.rsfmri.fsl',
+                    'nipype.workflows.rsfmri.fsl.tests',
                     'nipype.workflows.smri',
                     'nipype.workflows.smri.ants',
                     'nipype.workflows.smri.freesurfer',